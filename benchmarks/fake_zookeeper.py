@@ -0,0 +1,705 @@
+"""An in-memory stand-in for the zkpython ``zookeeper`` extension module, used by the benchmarks.
+
+Only the parts of the API that pykeeper uses are implemented. Every handle
+gets its own dispatch thread which delivers watch events and asynchronous
+completions in order, mirroring the single completion thread of the C client.
+
+Latency can be injected with :func:`set_latency`, which delays synchronous
+calls and the completion of asynchronous calls by the given amount of seconds.
+
+Install it before importing pykeeper::
+
+    sys.modules['zookeeper'] = fake_zookeeper
+"""
+import collections
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+# the module defines its own ``set``, mirroring zkpython
+_set = set
+
+
+PERM_READ = 1
+PERM_WRITE = 2
+PERM_CREATE = 4
+PERM_DELETE = 8
+PERM_ADMIN = 16
+PERM_ALL = 31
+
+EPHEMERAL = 1
+SEQUENCE = 2
+
+EXPIRED_SESSION_STATE = -112
+AUTH_FAILED_STATE = -113
+CONNECTING_STATE = 1
+ASSOCIATING_STATE = 2
+CONNECTED_STATE = 3
+
+CREATED_EVENT = 1
+DELETED_EVENT = 2
+CHANGED_EVENT = 3
+CHILD_EVENT = 4
+SESSION_EVENT = -1
+NOTWATCHING_EVENT = -2
+
+LOG_LEVEL_ERROR = 1
+LOG_LEVEL_WARN = 2
+LOG_LEVEL_INFO = 3
+LOG_LEVEL_DEBUG = 4
+
+OK = 0
+SYSTEMERROR = -1
+RUNTIMEINCONSISTENCY = -2
+DATAINCONSISTENCY = -3
+CONNECTIONLOSS = -4
+MARSHALLINGERROR = -5
+UNIMPLEMENTED = -6
+OPERATIONTIMEOUT = -7
+BADARGUMENTS = -8
+INVALIDSTATE = -9
+APIERROR = -100
+NONODE = -101
+NOAUTH = -102
+BADVERSION = -103
+NOCHILDRENFOREPHEMERALS = -108
+NODEEXISTS = -110
+NOTEMPTY = -111
+SESSIONEXPIRED = -112
+INVALIDCALLBACK = -113
+INVALIDACL = -114
+AUTHFAILED = -115
+CLOSING = -116
+NOTHING = -117
+SESSIONMOVED = -118
+
+
+class ZooKeeperException(Exception):
+    pass
+
+class SystemErrorException(ZooKeeperException):
+    pass
+
+class RuntimeInconsistencyException(ZooKeeperException):
+    pass
+
+class DataInconsistencyException(ZooKeeperException):
+    pass
+
+class ConnectionLossException(ZooKeeperException):
+    pass
+
+class MarshallingErrorException(ZooKeeperException):
+    pass
+
+class UnimplementedException(ZooKeeperException):
+    pass
+
+class OperationTimeoutException(ZooKeeperException):
+    pass
+
+class BadArgumentsException(ZooKeeperException):
+    pass
+
+class InvalidStateException(ZooKeeperException):
+    pass
+
+class ApiErrorException(ZooKeeperException):
+    pass
+
+class NoNodeException(ZooKeeperException):
+    pass
+
+class NoAuthException(ZooKeeperException):
+    pass
+
+class BadVersionException(ZooKeeperException):
+    pass
+
+class NoChildrenForEphemeralsException(ZooKeeperException):
+    pass
+
+class NodeExistsException(ZooKeeperException):
+    pass
+
+class NotEmptyException(ZooKeeperException):
+    pass
+
+class SessionExpiredException(ZooKeeperException):
+    pass
+
+class InvalidCallbackException(ZooKeeperException):
+    pass
+
+class InvalidACLException(ZooKeeperException):
+    pass
+
+class AuthFailedException(ZooKeeperException):
+    pass
+
+class ClosingException(ZooKeeperException):
+    pass
+
+class NothingException(ZooKeeperException):
+    pass
+
+class SessionMovedException(ZooKeeperException):
+    pass
+
+
+_ERRORS = {
+    SYSTEMERROR: (SystemErrorException, 'system error'),
+    RUNTIMEINCONSISTENCY: (RuntimeInconsistencyException, 'run time inconsistency'),
+    DATAINCONSISTENCY: (DataInconsistencyException, 'data inconsistency'),
+    CONNECTIONLOSS: (ConnectionLossException, 'connection loss'),
+    MARSHALLINGERROR: (MarshallingErrorException, 'marshalling error'),
+    UNIMPLEMENTED: (UnimplementedException, 'unimplemented'),
+    OPERATIONTIMEOUT: (OperationTimeoutException, 'operation timeout'),
+    BADARGUMENTS: (BadArgumentsException, 'bad arguments'),
+    INVALIDSTATE: (InvalidStateException, 'invalid zhandle state'),
+    APIERROR: (ApiErrorException, 'api error'),
+    NONODE: (NoNodeException, 'no node'),
+    NOAUTH: (NoAuthException, 'not authenticated'),
+    BADVERSION: (BadVersionException, 'bad version'),
+    NOCHILDRENFOREPHEMERALS: (NoChildrenForEphemeralsException, 'no children for ephemerals'),
+    NODEEXISTS: (NodeExistsException, 'node exists'),
+    NOTEMPTY: (NotEmptyException, 'not empty'),
+    SESSIONEXPIRED: (SessionExpiredException, 'session expired'),
+    INVALIDCALLBACK: (InvalidCallbackException, 'invalid callback'),
+    INVALIDACL: (InvalidACLException, 'invalid acl'),
+    AUTHFAILED: (AuthFailedException, 'authentication failed'),
+    CLOSING: (ClosingException, 'zookeeper is closing'),
+    NOTHING: (NothingException, '(not error) no server responses to process'),
+    SESSIONMOVED: (SessionMovedException, 'session moved to another server, so operation is ignored'),
+}
+
+
+def zerror(rc):
+    if rc == OK:
+        return 'ok'
+    return _ERRORS.get(rc, (None, 'unknown error'))[1]
+
+
+class _Error(Exception):
+    def __init__(self, rc):
+        Exception.__init__(self, rc)
+        self.rc = rc
+
+
+def _raise(rc):
+    cls, message = _ERRORS.get(rc, (SystemErrorException, 'unknown error'))
+    raise cls(message)
+
+
+_latency = 0.0
+
+
+def set_latency(seconds):
+    """ Set the simulated round trip time for every request. """
+    global _latency
+    _latency = seconds
+
+
+def get_latency():
+    return _latency
+
+
+class _Node(object):
+    __slots__ = ('data', 'acl', 'czxid', 'mzxid', 'pzxid', 'ctime', 'mtime', 'version',
+                 'cversion', 'aversion', 'ephemeral_owner', 'children', 'sequence')
+
+    def __init__(self, data, acl, zxid, ephemeral_owner):
+        now = int(time.time() * 1000)
+        self.data = data
+        self.acl = acl
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = self.cversion = self.aversion = 0
+        self.ephemeral_owner = ephemeral_owner
+        self.children = _set()
+        self.sequence = 0
+
+    def stat(self):
+        return {
+            'czxid': self.czxid,
+            'mzxid': self.mzxid,
+            'ctime': self.ctime,
+            'mtime': self.mtime,
+            'version': self.version,
+            'cversion': self.cversion,
+            'aversion': self.aversion,
+            'ephemeralOwner': self.ephemeral_owner,
+            'dataLength': len(self.data),
+            'numChildren': len(self.children),
+            'pzxid': self.pzxid,
+        }
+
+
+class _Tree(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.zxid = itertools.count(1)
+        self.nodes = {'/': _Node('', [], 0, 0)}
+        self.nodes['/zookeeper'] = _Node('', [], 0, 0)
+        self.nodes['/'].children.add('zookeeper')
+        self.data_watches = collections.defaultdict(list)
+        self.child_watches = collections.defaultdict(list)
+
+    def _parent(self, path):
+        parent, name = path.rsplit('/', 1)
+        return parent or '/', name
+
+    def _validate(self, path):
+        if not path.startswith('/') or (path != '/' and path.endswith('/')) or '//' in path:
+            raise _Error(BADARGUMENTS)
+
+    def _trigger(self, watches, path, event_type, events):
+        for session, fn in watches.pop(path, ()):
+            events.append((session, fn, event_type, path))
+
+    def create(self, session, path, data, acl, flags, events):
+        self._validate(path)
+        with self.lock:
+            parent_path, name = self._parent(path)
+            parent = self.nodes.get(parent_path)
+            if parent is None:
+                raise _Error(NONODE)
+            if parent.ephemeral_owner:
+                raise _Error(NOCHILDRENFOREPHEMERALS)
+            if flags & SEQUENCE:
+                path = '%s%010d' % (path, parent.cversion)
+                name = path.rsplit('/', 1)[1]
+            if path in self.nodes:
+                raise _Error(NODEEXISTS)
+            zxid = next(self.zxid)
+            owner = session.session_id if flags & EPHEMERAL else 0
+            self.nodes[path] = _Node(data, acl, zxid, owner)
+            if owner:
+                session.ephemerals.add(path)
+            parent.children.add(name)
+            parent.cversion += 1
+            parent.pzxid = zxid
+            self._trigger(self.data_watches, path, CREATED_EVENT, events)
+            self._trigger(self.child_watches, parent_path, CHILD_EVENT, events)
+            return path
+
+    def delete(self, path, version, events):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            if version != -1 and node.version != version:
+                raise _Error(BADVERSION)
+            if node.children:
+                raise _Error(NOTEMPTY)
+            self._remove(path, events)
+
+    def _remove(self, path, events):
+        node = self.nodes.pop(path)
+        parent_path, name = self._parent(path)
+        parent = self.nodes[parent_path]
+        parent.children.discard(name)
+        parent.cversion += 1
+        parent.pzxid = next(self.zxid)
+        self._trigger(self.data_watches, path, DELETED_EVENT, events)
+        self._trigger(self.child_watches, path, DELETED_EVENT, events)
+        self._trigger(self.child_watches, parent_path, CHILD_EVENT, events)
+        return node
+
+    def remove_ephemerals(self, session, events):
+        with self.lock:
+            for path in sorted(session.ephemerals, reverse=True):
+                node = self.nodes.get(path)
+                if node is not None and node.ephemeral_owner == session.session_id:
+                    self._remove(path, events)
+            session.ephemerals.clear()
+
+    def exists(self, session, path, watcher):
+        self._validate(path)
+        with self.lock:
+            if watcher is not None:
+                self.data_watches[path].append((session, watcher))
+            node = self.nodes.get(path)
+            if node is None:
+                return None
+            return node.stat()
+
+    def get(self, session, path, watcher):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            if watcher is not None:
+                self.data_watches[path].append((session, watcher))
+            return node.data, node.stat()
+
+    def get_children(self, session, path, watcher):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            if watcher is not None:
+                self.child_watches[path].append((session, watcher))
+            return list(node.children)
+
+    def set(self, path, data, version, events):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            if version != -1 and node.version != version:
+                raise _Error(BADVERSION)
+            node.data = data
+            node.version += 1
+            node.mzxid = next(self.zxid)
+            node.mtime = int(time.time() * 1000)
+            self._trigger(self.data_watches, path, CHANGED_EVENT, events)
+            return node.stat()
+
+    def get_acl(self, path):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            return node.stat(), list(node.acl)
+
+    def set_acl(self, path, version, acl):
+        self._validate(path)
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise _Error(NONODE)
+            if version != -1 and node.aversion != version:
+                raise _Error(BADVERSION)
+            node.acl = list(acl)
+            node.aversion += 1
+
+    def drop_watches(self, session):
+        """ Forgets the watches of ``session``, returning their watcher functions. """
+        dropped = list()
+        with self.lock:
+            for watches in (self.data_watches, self.child_watches):
+                for path in list(watches):
+                    remaining = list()
+                    for entry in watches[path]:
+                        if entry[0] is session:
+                            dropped.append(entry[1])
+                        else:
+                            remaining.append(entry)
+                    if remaining:
+                        watches[path] = remaining
+                    else:
+                        del watches[path]
+        return dropped
+
+
+_tree = _Tree()
+_sessions = dict()
+_session_ids = itertools.count(0x1000)
+_sessions_lock = threading.Lock()
+
+
+def reset():
+    """ Drop all data and close all handles. """
+    global _tree
+    for handle in list(_sessions):
+        close(handle)
+    _tree = _Tree()
+
+
+class _Session(object):
+
+    def __init__(self, handle, servers, watcher):
+        self.handle = handle
+        self.servers = servers
+        self.watcher = watcher
+        self.session_id = next(_session_ids)
+        self.password = '%016x' % self.session_id
+        self.state = CONNECTING_STATE
+        self.ephemerals = _set()
+        self.closed = False
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='fake-zookeeper-%d' % handle)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, callback, *args, **kwargs):
+        delay = kwargs.get('delay', 0)
+        with self._condition:
+            heapq.heappush(self._queue, (time.time() + delay, next(self._sequence), callback, args))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._queue:
+                        if self.closed:
+                            return
+                        self._condition.wait()
+                        continue
+                    due = self._queue[0][0]
+                    now = time.time()
+                    if due > now:
+                        self._condition.wait(due - now)
+                        continue
+                    _, _, callback, args = heapq.heappop(self._queue)
+                    break
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def deliver_session_event(self, state):
+        self.state = state
+        if self.watcher is not None:
+            self.watcher(self.handle, SESSION_EVENT, state, '')
+
+    def deliver_watch(self, fn, event_type, path):
+        fn(self.handle, event_type, self.state, path)
+
+
+def _session(handle):
+    session = _sessions.get(handle)
+    if session is None or session.closed:
+        raise ZooKeeperException('zhandle out of range')
+    return session
+
+
+def _dispatch_events(events):
+    for session, fn, event_type, path in events:
+        if not session.closed:
+            session.schedule(session.deliver_watch, fn, event_type, path)
+
+
+def _check_connected(session):
+    if session.state == EXPIRED_SESSION_STATE:
+        raise _Error(SESSIONEXPIRED)
+    if session.state != CONNECTED_STATE:
+        raise _Error(CONNECTIONLOSS)
+
+
+def _sync(handle, operation):
+    session = _session(handle)
+    if _latency:
+        time.sleep(_latency)
+    events = []
+    try:
+        _check_connected(session)
+        result = operation(session, events)
+    except _Error as e:
+        _raise(e.rc)
+    _dispatch_events(events)
+    return result
+
+
+def _async(handle, operation, completion, failure_args):
+    session = _session(handle)
+    events = []
+    try:
+        _check_connected(session)
+        args = (OK,) + tuple(operation(session, events))
+    except _Error as e:
+        args = (e.rc,) + failure_args
+    _dispatch_events(events)
+    if completion is not None:
+        session.schedule(completion, handle, *args, delay=_latency)
+    return OK
+
+
+def init(servers, watcher=None, recv_timeout=10000, client_id=None):
+    with _sessions_lock:
+        # like zkpython, hand out the lowest free slot, so a closed handle is reused by the next init
+        handle = next(slot for slot in itertools.count() if slot not in _sessions)
+        session = _Session(handle, servers, watcher)
+        _sessions[handle] = session
+    session.schedule(session.deliver_session_event, CONNECTED_STATE, delay=_latency)
+    return handle
+
+
+def close(handle):
+    session = _sessions.pop(handle, None)
+    if session is None:
+        return OK
+    events = []
+    _tree.remove_ephemerals(session, events)
+    _tree.drop_watches(session)
+    _dispatch_events(events)
+    session.stop()
+    return OK
+
+
+def expire_session(handle):
+    """ Expire the session of the given handle, as if the server had timed it out. """
+    session = _session(handle)
+    events = []
+    _tree.remove_ephemerals(session, events)
+    watchers = _tree.drop_watches(session)
+    _dispatch_events(events)
+    session.state = EXPIRED_SESSION_STATE
+    # like the C client, the session event goes to the global watcher first and then to every other watcher
+    session.schedule(session.deliver_session_event, EXPIRED_SESSION_STATE)
+    for fn in watchers:
+        session.schedule(fn, handle, SESSION_EVENT, EXPIRED_SESSION_STATE, '')
+
+
+def disconnect(handle, reconnect_after=None):
+    """ Simulate a connection loss, optionally reconnecting after the given amount of seconds. """
+    session = _session(handle)
+    session.state = CONNECTING_STATE
+    session.schedule(session.deliver_session_event, CONNECTING_STATE)
+    if reconnect_after is not None:
+        session.schedule(session.deliver_session_event, CONNECTED_STATE, delay=reconnect_after)
+
+
+def state(handle):
+    return _session(handle).state
+
+
+def client_id(handle):
+    session = _session(handle)
+    return session.session_id, session.password
+
+
+def recv_timeout(handle):
+    return 10000
+
+
+def is_unrecoverable(handle):
+    return _session(handle).state == EXPIRED_SESSION_STATE
+
+
+def set_watcher(handle, watcher):
+    _session(handle).watcher = watcher
+
+
+def set_debug_level(level):
+    pass
+
+
+_log_stream = None
+
+
+def set_log_stream(stream):
+    global _log_stream
+    _log_stream = stream
+
+
+def deterministic_conn_order(yes_or_no):
+    pass
+
+
+def add_auth(handle, scheme, cert, completion):
+    return OK
+
+
+def create(handle, path, value, acl, flags=0):
+    return _sync(handle, lambda session, events: _tree.create(session, path, value, acl, flags, events))
+
+
+def delete(handle, path, version=-1):
+    _sync(handle, lambda session, events: _tree.delete(path, version, events))
+    return OK
+
+
+def exists(handle, path, watcher=None):
+    return _sync(handle, lambda session, events: _tree.exists(session, path, watcher))
+
+
+def get(handle, path, watcher=None, buffer_len=1024 * 1024):
+    return _sync(handle, lambda session, events: _tree.get(session, path, watcher))
+
+
+def get_children(handle, path, watcher=None):
+    return _sync(handle, lambda session, events: _tree.get_children(session, path, watcher))
+
+
+def set(handle, path, value, version=-1):
+    _sync(handle, lambda session, events: _tree.set(path, value, version, events))
+    return OK
+
+
+def set2(handle, path, value, version=-1):
+    return _sync(handle, lambda session, events: _tree.set(path, value, version, events))
+
+
+def get_acl(handle, path):
+    return _sync(handle, lambda session, events: _tree.get_acl(path))
+
+
+def set_acl(handle, path, version, acl):
+    _sync(handle, lambda session, events: _tree.set_acl(path, version, acl))
+    return OK
+
+
+def acreate(handle, path, value, acl, flags=0, completion=None):
+    return _async(handle, lambda session, events: (_tree.create(session, path, value, acl, flags, events),),
+                  completion, (None,))
+
+
+def adelete(handle, path, version=-1, completion=None):
+    def operation(session, events):
+        _tree.delete(path, version, events)
+        return ()
+    return _async(handle, operation, completion, ())
+
+
+def aexists(handle, path, watcher=None, completion=None):
+    def operation(session, events):
+        stat = _tree.exists(session, path, watcher)
+        if stat is None:
+            raise _Error(NONODE)
+        return (stat,)
+    return _async(handle, operation, completion, (None,))
+
+
+def aget(handle, path, watcher=None, completion=None):
+    return _async(handle, lambda session, events: _tree.get(session, path, watcher), completion, (None, None))
+
+
+def aget_children(handle, path, watcher=None, completion=None):
+    return _async(handle, lambda session, events: (_tree.get_children(session, path, watcher),),
+                  completion, (None,))
+
+
+def aset(handle, path, value, version=-1, completion=None):
+    return _async(handle, lambda session, events: (_tree.set(path, value, version, events),),
+                  completion, (None,))
+
+
+def aget_acl(handle, path, completion=None):
+    def operation(session, events):
+        stat, acl = _tree.get_acl(path)
+        return acl, stat
+    return _async(handle, operation, completion, (None, None))
+
+
+def aset_acl(handle, path, version, acl, completion=None):
+    def operation(session, events):
+        _tree.set_acl(path, version, acl)
+        return ()
+    return _async(handle, operation, completion, ())
+
+
+def _sync_path(handle, path, completion=None):
+    return _async(handle, lambda session, events: (path,), completion, (None,))
+
+# ``async`` is a reserved word on newer pythons, but it is the name zkpython uses.
+globals()['async'] = _sync_path
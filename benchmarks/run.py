@@ -0,0 +1,419 @@
+""" Measures the overhead of pykeeper itself, against an in-memory fake of the zookeeper module.
+
+    $ python benchmarks/run.py --output results.json
+    $ python benchmarks/run.py --compare results.json get cached_get
+
+Every benchmark reports the number of operations it performed and how long they took. With
+``--compare``, the results are compared with those of an earlier run, and the exit status is
+non-zero if any benchmark got slower by more than ``--tolerance``.
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+# use the fake zookeeper module, and the pykeeper in this source tree
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+import fake_zookeeper
+sys.modules['zookeeper'] = fake_zookeeper
+
+import pykeeper
+from pykeeper import client, event, log_stream, shared_cache
+
+
+BENCHMARKS = list()
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+class Timer(object):
+    """ Times the hot part of a benchmark. """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.time() - self._started
+
+
+def connected_client(**kwargs):
+    zk = client.ZooKeeper('fake:2181', **kwargs)
+    zk.connect()
+    zk.wait_until_connected(10)
+    return zk
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise client.TimeoutException()
+        time.sleep(0.0005)
+
+
+def create_nodes(zk, paths):
+    for path in paths:
+        zk.create(path, 'x' * 100)
+
+
+@benchmark
+def get(scale):
+    zk = connected_client()
+    paths = ['/node-{0}'.format(i) for i in range(100)]
+    create_nodes(zk, paths)
+
+    operations = 100 * scale
+    with Timer() as timer:
+        for i in range(operations):
+            zk.get(paths[i % len(paths)])
+    return operations, timer.seconds
+
+
+@benchmark
+def cached_get(scale):
+    zk = connected_client()
+    paths = ['/node-{0}'.format(i) for i in range(100)]
+    create_nodes(zk, paths)
+    zk.cached_get_many(paths)
+
+    operations = 1000 * scale
+    with Timer() as timer:
+        for i in range(operations):
+            zk.cached_get(paths[i % len(paths)])
+    return operations, timer.seconds
+
+
+@benchmark
+def shared_get(scale):
+    """ Reads from a shared tree cache that another instance owns, as a worker process would. """
+    zk = connected_client()
+    paths = ['/shared/node-{0}'.format(i) for i in range(100)]
+    zk.create('/shared', '')
+    create_nodes(zk, paths)
+
+    filename = os.path.join(here, 'shared-{0}.tmp'.format(os.getpid()))
+    owner = shared_cache.SharedTreeCache('fake:2181', '/shared', filename)
+    worker = shared_cache.SharedTreeCache('fake:2181', '/shared', filename)
+    try:
+        owner.start(10)
+        worker.start(10)
+
+        operations = 1000 * scale
+        with Timer() as timer:
+            for i in range(operations):
+                worker.get(paths[i % len(paths)])
+    finally:
+        worker.stop()
+        owner.stop()
+        for name in glob.glob(filename + '*'):
+            os.remove(name)
+    return operations, timer.seconds
+
+
+@benchmark
+def invalidation_storm(scale):
+    """ Changes every cached node at once, until the cache has been emptied and filled again. """
+    zk = connected_client()
+    paths = ['/node-{0}'.format(i) for i in range(100 * scale)]
+    create_nodes(zk, paths)
+    zk.cached_get_many(paths)
+    cache = zk.get_cache('get')
+
+    with Timer() as timer:
+        for path in paths:
+            zk.set(path, 'changed')
+        wait_for(lambda: not len(cache))
+        zk.cached_get_many(paths)
+    return len(paths), timer.seconds
+
+
+@benchmark
+def create_recursive_deep(scale):
+    zk = connected_client()
+    depth = 50
+
+    with Timer() as timer:
+        for i in range(scale):
+            zk.create_recursive('/deep-{0}'.format(i) + '/level' * depth, '')
+    return scale * (depth + 1), timer.seconds
+
+
+@benchmark
+def ensure_paths(scale):
+    """ Bootstraps a layout of services with a few nodes each. """
+    zk = connected_client()
+    paths = ['/services/service-{0}/{1}'.format(i, name)
+             for i in range(20 * scale) for name in ('config', 'members', 'locks')]
+
+    with Timer() as timer:
+        created = zk.ensure_paths(paths)
+    return len(created), timer.seconds
+
+
+@benchmark
+def export_restore(scale):
+    """ Copies a tree of 10 * 10 * scale nodes with a snapshot. """
+    zk = connected_client()
+    zk.ensure_paths(['/tree/{0}/{1}/{2}'.format(i, j, k) for i in range(10) for j in range(10) for k in range(scale)])
+    snapshot = io.BytesIO()
+
+    with Timer() as timer:
+        operations = zk.export('/tree', snapshot)
+        snapshot.seek(0)
+        zk.restore(snapshot, '/copy')
+    return operations * 2, timer.seconds
+
+
+@benchmark
+def warm_start(scale):
+    """ Loads saved caches of 1000 * scale nodes, and revalidates them with a tenth of the nodes changed. """
+    zk = connected_client()
+    paths = ['/node-{0}'.format(i) for i in range(1000 * scale)]
+    create_nodes(zk, paths)
+    zk.cached_get_many(paths)
+
+    filename = os.path.join(here, 'caches-{0}.tmp'.format(os.getpid()))
+    try:
+        zk.save_caches(filename)
+        for path in paths[::10]:
+            zk.set(path, 'changed')
+
+        warm = client.ZooKeeper('fake:2181')
+        with Timer() as timer:
+            warm.load_caches(filename)
+            warm.connect()
+            warm.wait_until_revalidated(60)
+    finally:
+        os.remove(filename)
+    return len(paths), timer.seconds
+
+
+@benchmark
+def ephemeral_restore(scale):
+    """ Expires a session that registered 100 * scale ephemeral nodes, until they've all been re-created. """
+    zk = connected_client(restore_ephemerals=True)
+    zk.create('/members', '')
+    for i in range(100 * scale):
+        zk.create('/members/member-{0}'.format(i), 'x' * 100, flags=fake_zookeeper.EPHEMERAL)
+    restored = list()
+    zk.on_ephemeral_restored += restored.append
+
+    with Timer() as timer:
+        zk._global_watcher(zk.handle, fake_zookeeper.SESSION_EVENT, fake_zookeeper.EXPIRED_SESSION_STATE, '')
+        wait_for(lambda: len(restored) == 100 * scale)
+    return len(restored), timer.seconds
+
+
+@benchmark
+def queue(scale):
+    """ Four consumers draining a queue in batches. """
+    zk = connected_client()
+    items = 500 * scale
+    zk.queue('/queue').put_many(['x' * 100] * items)
+    consumers = [zk.queue('/queue') for i in range(4)]
+
+    def consume(consumer):
+        while consumer.take(20, block=False):
+            pass
+
+    with Timer() as timer:
+        threads = [threading.Thread(target=consume, args=(consumer,)) for consumer in consumers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return items, timer.seconds
+
+
+@benchmark
+def membership_churn(scale):
+    """ Instances of a service restarting one by one, followed by a children watch. """
+    zk = connected_client()
+    instances = ['/members/instance-{0}'.format(i) for i in range(200 * scale)]
+    zk.ensure_paths(instances)
+    members = set(path.rsplit('/', 1)[1] for path in instances)
+
+    def update(diff):
+        members.difference_update(diff.removed)
+        members.update(diff.added)
+
+    watch = zk.children_watch('/members', update, window=0.01)
+    with Timer() as timer:
+        for path in instances:
+            zk.delete(path)
+            zk.create(path + '-restarted', '')
+        wait_for(lambda: len(members) == len(instances) and all(name.endswith('-restarted') for name in list(members)))
+    watch.stop()
+    return len(instances) * 2, timer.seconds
+
+
+@benchmark
+def delete_recursive_wide(scale):
+    zk = connected_client()
+    zk.create('/wide', '')
+    children = ['/wide/child-{0}'.format(i) for i in range(200 * scale)]
+    create_nodes(zk, children)
+
+    with Timer() as timer:
+        zk.delete_recursive('/wide')
+    return len(children) + 1, timer.seconds
+
+
+@benchmark
+def delete_recursive_deep(scale):
+    zk = connected_client()
+    # a binary tree, 2 ** depth - 1 nodes
+    depth = 6 + scale.bit_length()
+    level = ['/deep']
+    nodes = list(level)
+    for i in range(depth - 1):
+        level = [path + suffix for path in level for suffix in ('/a', '/b')]
+        nodes.extend(level)
+    for path in nodes:
+        zk.create(path, '')
+
+    with Timer() as timer:
+        zk.delete_recursive('/deep')
+    return len(nodes), timer.seconds
+
+
+@benchmark
+def event_dispatch(scale):
+    evt = event.Event()
+    counter = [0]
+
+    def handler(value):
+        counter[0] += 1
+
+    for i in range(100):
+        evt += handler
+
+    operations = 1000 * scale
+    with Timer() as timer:
+        for i in range(operations):
+            evt(i)
+    return operations * len(evt), timer.seconds
+
+
+@benchmark
+def log_relay(scale):
+    """ A reconnect storm of the C client, relayed to a logger that discards everything. """
+    read_fd, write_fd = os.pipe()
+    relay = log_stream._Relay(read_fd)
+    thread = threading.Thread(target=relay.run)
+    thread.start()
+
+    line = '2012-01-30 12:00:00,000:123(0x7f):ZOO_ERROR@handle_socket_error_msg@1579: Socket [127.0.0.1:{0}] zk retcode=-4, errno=111(Connection refused): server refused to accept the client\n'
+    lines = 2000 * scale
+    data = ''.join(line.format(2181 + i % 3) for i in range(lines)).encode('ascii')
+
+    with Timer() as timer:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(write_fd, view):]
+        wait_for(lambda: relay.lines == lines)
+
+    relay.stop()
+    thread.join()
+    os.close(write_fd)
+    relay.close()
+    return lines, timer.seconds
+
+
+def run(names, scale, latency, repeat):
+    fake_zookeeper.set_latency(latency)
+    results = list()
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+
+        best = None
+        for i in range(repeat):
+            fake_zookeeper.reset()
+            operations, seconds = func(scale)
+            if best is None or seconds < best[1]:
+                best = operations, seconds
+        fake_zookeeper.reset()
+
+        operations, seconds = best
+        results.append(dict(
+            name=func.__name__,
+            operations=operations,
+            seconds=seconds,
+            ops_per_second=operations / seconds if seconds else None,
+        ))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the names of the benchmarks that are more than ``tolerance`` slower than in ``baseline``. """
+    previous = dict((result['name'], result) for result in baseline['results'])
+    regressions = list()
+    for result in results:
+        before = previous.get(result['name'])
+        if not before or not before['ops_per_second'] or not result['ops_per_second']:
+            continue
+        change = result['ops_per_second'] / before['ops_per_second'] - 1
+        print('{0:<24} {1:>12.0f} ops/s {2:>+8.1%}'.format(result['name'], result['ops_per_second'], change))
+        if change < -tolerance:
+            regressions.append(result['name'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('names', nargs='*', help='the benchmarks to run, all by default: {0}'.format(
+        ', '.join(func.__name__ for func in BENCHMARKS)))
+    parser.add_argument('--scale', type=int, default=10, help='multiplies the size of every benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated round trip time in seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the fastest is reported')
+    parser.add_argument('--output', help='write the results to this file as json')
+    parser.add_argument('--compare', help='compare the results with those in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed by --compare')
+    args = parser.parse_args(argv)
+
+    # the fake doesn't log anything, but don't let the relay benchmark spam the console
+    logging.getLogger('zookeeper').setLevel(logging.CRITICAL)
+
+    results = run(args.names, args.scale, args.latency, args.repeat)
+    report = dict(
+        pykeeper=str(pykeeper.version),
+        python=platform.python_version(),
+        scale=args.scale,
+        latency=args.latency,
+        results=results,
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Slower than the baseline: {0}'.format(', '.join(regressions)))
+            return 1
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
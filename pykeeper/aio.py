@@ -0,0 +1,285 @@
+""" An asyncio interface to zookeeper, built on the asynchronous zkpython calls.
+
+This module requires python 3.7 or newer, and is therefore not imported by ``pykeeper`` itself.
+
+The completions of the asynchronous calls run on the zookeeper completion thread, and are
+handed to the event loop with ``call_soon_threadsafe``, so no executor threads are involved.
+"""
+import asyncio
+import logging
+
+import zookeeper
+
+from pykeeper.client import ZooKeeper, TimeoutException, ZOO_OPEN_ACL_UNSAFE, CACHE_WATCH_KINDS
+
+
+logger = logging.getLogger(__name__)
+
+# the requests that arm each kind of watch
+_WATCH_REQUESTS = {
+    'data': 'aget',
+    'child': 'aget_children',
+    'exists': 'aexists',
+}
+
+
+def _resolve(future, result):
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class _LoopWatcher(object):
+    """ A watcher that calls ``watcher`` on ``loop`` instead of the thread the watch fired on.
+    It compares equal to ``watcher``, so it can be found by :meth:`ZooKeeper.unwatch`. """
+
+    def __init__(self, loop, watcher):
+        self.loop = loop
+        self.watcher = watcher
+
+    def __call__(self, event):
+        self.loop.call_soon_threadsafe(self.watcher, event)
+
+    def __eq__(self, other):
+        if isinstance(other, _LoopWatcher):
+            return self.watcher == other.watcher
+        return self.watcher == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.watcher)
+
+
+class WatchStream(object):
+    """ An asynchronous iterator over the :class:`pykeeper.client.ClientEvent` of the ``kind``
+    watch on ``path``, which is re-armed every time it fires.
+
+    The watch is re-armed from the completion thread, before the event is seen by the iterating
+    task, so slow consumers don't miss changes. A ``data`` watch ends with a ``NoNodeException``
+    when the node is deleted, use an ``exists`` watch to follow a node that comes and goes.
+
+        async with client.watch('/foo') as events:
+            async for event in events:
+                ...
+    """
+
+    _closed_marker = object()
+
+    def __init__(self, client, path, kind='data'):
+        assert kind in _WATCH_REQUESTS, 'unknown watch kind: {0!r}'.format(kind)
+        self.client = client
+        self.path = path
+        self.kind = kind
+
+        self._loop = None
+        self._queue = None
+        self._closed = False
+
+    def close(self):
+        """ Stops watching, ending the iteration after the events that are already queued. """
+        if self._closed:
+            return
+        self._closed = True
+        self.client.unwatch(self.path, self._watcher, self.kind)
+        if self._queue is not None:
+            self._put(self._closed_marker)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._queue is None:
+            if self._closed:
+                raise StopAsyncIteration
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue()
+            self._arm()
+
+        item = await self._queue.get()
+        if item is self._closed_marker:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        return item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _arm(self):
+        request = getattr(self.client, _WATCH_REQUESTS[self.kind])
+        request(self.path, self._armed, watcher=self._watcher)
+
+    def _armed(self, result):
+        if isinstance(result, Exception) and not self._closed:
+            self._put(result)
+
+    def _watcher(self, event):
+        if self._closed:
+            return
+        if event.type != zookeeper.SESSION_EVENT:
+            # zookeeper watches fire once, session events don't use them up
+            self._arm()
+        self._put(event)
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def __repr__(self):
+        return 'WatchStream(path={0!r}, kind={1!r})'.format(self.path, self.kind)
+
+
+class AsyncZooKeeper(object):
+    """ The asyncio counterpart of :class:`pykeeper.client.ZooKeeper`.
+
+    The connection, caches and watches are managed by a :class:`ZooKeeper` (available as
+    ``client``), which is created with ``kwargs``. Watchers passed to the read methods are
+    called on the event loop. An ``AsyncZooKeeper`` should only be used from a single event loop.
+    """
+
+    def __init__(self, servers, **kwargs):
+        self.client = ZooKeeper(servers, **kwargs)
+        # the futures of the cache misses in flight, shared by the tasks missing the same entry
+        self._cache_misses = dict()
+
+    def connect(self):
+        self.client.connect()
+
+    def close(self):
+        self.client.close()
+
+    @property
+    def state_name(self):
+        return self.client.state_name
+
+    async def wait_until_connected(self, timeout=None):
+        if self.client.state_name == 'connected':
+            return
+
+        loop = asyncio.get_running_loop()
+        connected = loop.create_future()
+
+        def waiter(client, state):
+            if state == 'connected':
+                loop.call_soon_threadsafe(_resolve, connected, None)
+
+        try:
+            self.client.on_state += waiter
+
+            # state may have changed between the entry of this method and the on_state listener being added.
+            if self.client.state_name == 'connected':
+                return
+
+            await asyncio.wait_for(connected, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException()
+        finally:
+            self.client.on_state -= waiter
+
+    async def exists(self, path, watcher=None):
+        return await self._read(self.client.aexists, path, watcher)
+
+    async def get_children(self, path, watcher=None):
+        return await self._read(self.client.aget_children, path, watcher)
+
+    async def get(self, path, watcher=None):
+        return await self._read(self.client.aget, path, watcher)
+
+    async def cached_exists(self, path):
+        return await self._cached('exists', path, self.client._exists_request)
+
+    async def cached_get_children(self, path):
+        return list(await self._cached('get_children', path, self.client._get_children_request))
+
+    async def cached_get(self, path):
+        return await self._cached('get', path, self.client._get_request)
+
+    async def create(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        return await self._call(*self.client._create_request(path, value, acl, flags))
+
+    async def delete(self, path, version=-1):
+        return await self._call(*self.client._delete_request(path, version))
+
+    async def set(self, path, value, version=-1):
+        """ Sets the data of ``path``, returning the new stat (like :meth:`ZooKeeper.set2`). """
+        return await self._call(*self.client._set_request(path, value, version))
+
+    async def get_acl(self, path):
+        return await self._call(*self.client._get_acl_request(path))
+
+    async def set_acl(self, path, version, acl):
+        return await self._call(*self.client._set_acl_request(path, version, acl))
+
+    def watch(self, path, kind='data'):
+        """ Returns a :class:`WatchStream` of the events of the ``kind`` watch on ``path``. """
+        return WatchStream(self.client, path, kind)
+
+    def unwatch(self, path, watcher, kind=None):
+        return self.client.unwatch(path, watcher, kind)
+
+    def _call(self, issue, complete):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def completion(handle, rc, *args):
+            try:
+                result = complete(rc, *args)
+            except Exception as e:
+                result = e
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+        try:
+            issue(completion)
+        except Exception as e:
+            _resolve(future, e)
+        return future
+
+    def _read(self, request, path, watcher):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if watcher is not None:
+            watcher = _LoopWatcher(loop, watcher)
+        request(path, lambda result: loop.call_soon_threadsafe(_resolve, future, result), watcher=watcher)
+        return future
+
+    async def _cached(self, cache_name, path, make_request):
+        client = self.client
+        cache = client.get_cache(cache_name)
+
+        if not client.stale_cache_reads and client.cache_is_stale:
+            # rare enough that waiting on a thread is fine
+            await asyncio.get_running_loop().run_in_executor(None, client.wait_until_revalidated)
+
+        retval = cache.get(path, Ellipsis)
+        if retval is not Ellipsis:
+            return retval
+
+        key = (cache_name, path)
+        future = self._cache_misses.get(key)
+        if future is None:
+            kind = CACHE_WATCH_KINDS[cache_name]
+            # the result is stored in the cache on the completion thread, which guarantees that
+            # it is stored before the invalidator can fire.
+            invalidator, store = client._cache_entry(cache_name, cache, path)
+            armed_watcher = client._watches.subscribe(path, kind, invalidator)
+            future = self._cache_misses[key] = self._call(*make_request(path, armed_watcher, store))
+
+            def done(future):
+                del self._cache_misses[key]
+                if future.exception() is not None:
+                    client._watches.unsubscribe(path, kind, invalidator, armed_watcher)
+            future.add_done_callback(done)
+
+        # a cancelled task should not cancel the request the others are waiting for
+        return await asyncio.shield(future)
+
+    def __repr__(self):
+        return 'AsyncZooKeeper(servers={0}, state={1} at {2})'.format(self.client.servers, self.state_name, hex(id(self)))
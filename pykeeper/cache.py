@@ -0,0 +1,231 @@
+import collections
+import sys
+import threading
+
+import zookeeper
+
+from pykeeper.compact import Stat
+
+
+def estimate_size(value):
+    """ Roughly estimates the number of bytes used by a cached value. """
+    size = sys.getsizeof(value)
+    if isinstance(value, Stat):
+        # the fields are packed in a single byte string
+        size += sys.getsizeof(value._packed)
+    elif isinstance(value, dict):
+        # the keys of stat dicts are shared between all the stats, so only count the values
+        size += sum(estimate_size(item) for item in value.values())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class Invalidator(object):
+    """ A zookeeper watcher that removes ``key`` from ``cache`` when it fires.
+
+    The invalidator is cancelled when its entry is evicted or replaced, after which
+    firing it does nothing at all. Session events are ignored, the client revalidates
+    its caches itself if the session expires.
+    """
+    __slots__ = ('cache', 'key', 'active')
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+    def __call__(self, handle, event_type, conn_state, path):
+        if not self.active or event_type == zookeeper.SESSION_EVENT:
+            return
+        self.active = False
+        self.cache.invalidate(self.key, self)
+
+
+class CacheStats(collections.namedtuple('CacheStats', 'entries, bytes, hits, misses, evictions, invalidations')):
+    """ A snapshot of the counters of a cache. """
+
+
+class LRUCache(object):
+    """ A thread-safe cache that evicts the least recently used entries when either
+    ``max_entries`` or ``max_bytes`` is exceeded. The limits default to ``None``, which
+    means unbounded.
+
+    Every entry may have a watcher (such as an :class:`Invalidator`) which is cancelled
+    when the entry is evicted or replaced.
+
+        >>> cache = LRUCache(max_entries=2)
+        >>> cache.put('/a', 1)
+        >>> cache.put('/b', 2)
+        >>> cache.get('/a')
+        1
+        >>> cache.put('/c', 3)
+        >>> cache.get('/b', 'evicted')
+        'evicted'
+        >>> sorted(cache.keys())
+        ['/a', '/c']
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=estimate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch(key, entry)
+            return entry[0]
+
+    def put(self, key, value, watcher=None):
+        with self.lock:
+            if watcher is not None and not getattr(watcher, 'active', True):
+                # the watcher fired before the value could be cached, so the value may already be stale.
+                return
+            self._remove(key)
+            size = self.sizeof(key) + self.sizeof(value)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # would never fit, so don't throw out everything else trying
+                return
+            # make room before inserting, otherwise a new entry could be evicted right away
+            self._evict(1, size)
+            self._insert(key, (value, size, watcher))
+            self._bytes += size
+
+    def invalidate(self, key, watcher=None):
+        """ Removes ``key`` from the cache. If ``watcher`` is given, the entry is only removed
+        if it was cached with that watcher. """
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None or (watcher is not None and entry[2] is not watcher):
+                return
+            self.invalidations += 1
+            self._remove(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._remove(key)
+            if entry is None:
+                return default
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def keys(self):
+        with self.lock:
+            return list(self._entries)
+
+    def items(self):
+        """ Returns a list of ``(key, value)`` without affecting the eviction order or the counters. """
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def stats(self):
+        with self.lock:
+            return CacheStats(len(self._entries), self._bytes, self.hits, self.misses, self.evictions, self.invalidations)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _touch(self, key, entry):
+        del self._entries[key]
+        self._entries[key] = entry
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+
+    def _victim(self):
+        return next(iter(self._entries))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+            if entry[2] is not None:
+                entry[2].cancel()
+        return entry
+
+    def _over_budget(self, extra_entries, extra_bytes):
+        if self.max_entries is not None and len(self._entries) + extra_entries > self.max_entries:
+            return True
+        return self.max_bytes is not None and self._bytes + extra_bytes > self.max_bytes
+
+    def _evict(self, extra_entries=0, extra_bytes=0):
+        while self._entries and self._over_budget(extra_entries, extra_bytes):
+            self._remove(self._victim())
+            self.evictions += 1
+
+
+class LFUCache(LRUCache):
+    """ Like :class:`LRUCache`, but evicts the least frequently used entries first, and the least
+    recently used of those when there is a tie.
+
+        >>> cache = LFUCache(max_entries=2)
+        >>> cache.put('/a', 1)
+        >>> cache.put('/b', 2)
+        >>> cache.get('/a')
+        1
+        >>> cache.put('/c', 3)
+        >>> sorted(cache.keys())
+        ['/a', '/c']
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LFUCache, self).__init__(*args, **kwargs)
+        self._frequencies = dict()
+        self._buckets = collections.defaultdict(collections.OrderedDict)
+        self._min_frequency = 0
+
+    def _touch(self, key, entry):
+        frequency = self._frequencies[key]
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+            if self._min_frequency == frequency:
+                self._min_frequency = frequency + 1
+        self._frequencies[key] = frequency + 1
+        self._buckets[frequency + 1][key] = None
+
+    def _insert(self, key, entry):
+        super(LFUCache, self)._insert(key, entry)
+        self._frequencies[key] = 1
+        self._buckets[1][key] = None
+        self._min_frequency = 1
+
+    def _victim(self):
+        return next(iter(self._buckets[self._min_frequency]))
+
+    def _remove(self, key):
+        entry = super(LFUCache, self)._remove(key)
+        if entry is not None:
+            frequency = self._frequencies.pop(key)
+            bucket = self._buckets[frequency]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[frequency]
+                if self._min_frequency == frequency and self._buckets:
+                    self._min_frequency = min(self._buckets)
+        return entry
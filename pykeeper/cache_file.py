@@ -0,0 +1,98 @@
+""" The file format of :meth:`ZooKeeper.save_caches`.
+
+A cache file starts with :data:`HEADER`, followed by a record per cache entry and an end record.
+Like the records of :mod:`pykeeper.snapshot`, every record has a ``(kind, path length, payload
+length)`` header packed as ``>BHI``, followed by the path and the payload:
+
+* ``get`` entries: the packed :class:`pykeeper.compact.Stat`, followed by the data as stored.
+* ``exists`` entries: the packed stat, or nothing if the node didn't exist.
+* ``get_children`` entries: the names of the children, separated by slashes.
+
+    >>> import io
+    >>> from pykeeper.compact import Stat
+    >>> stat = Stat.from_dict(dict(czxid=1, mzxid=2, ctime=0, mtime=0, version=0, cversion=0, aversion=0,
+    ...                            ephemeralOwner=0, dataLength=4, numChildren=0, pzxid=1))
+    >>> f = io.BytesIO()
+    >>> write(f, [('get', '/a', (b'data', stat)), ('exists', '/b', None), ('get_children', '/', ('a',))])
+    3
+    >>> f.seek(0)
+    0
+    >>> list(read(f)) == [('get', '/a', (b'data', stat)), ('exists', '/b', None), ('get_children', '/', ('a',))]
+    True
+"""
+import struct
+
+from pykeeper.compact import STAT_SIZE, Stat, intern_name
+from pykeeper.snapshot import SnapshotError
+
+
+HEADER = b'PKCACHE\x01'
+
+KINDS = {'get': 1, 'exists': 2, 'get_children': 3}
+# set on the kind of get entries whose data is None
+NO_DATA = 0x40
+END = 0x80
+
+_NAMES = dict((kind, name) for name, kind in KINDS.items())
+_record = struct.Struct('>BHI')
+
+
+def write(fileobj, entries):
+    """ Writes the ``(cache name, path, value)`` tuples in ``entries`` to ``fileobj``, returning their count.
+    The data of ``get`` entries must be a byte string (or ``None``). """
+    fileobj.write(HEADER)
+    count = 0
+    for name, path, value in entries:
+        kind = KINDS[name]
+        if name == 'get':
+            data, stat = value
+            if data is None:
+                kind |= NO_DATA
+                data = b''
+            elif not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            payload = Stat.from_dict(stat)._packed + data
+        elif name == 'exists':
+            payload = b'' if value is None else Stat.from_dict(value)._packed
+        else:
+            payload = '/'.join(value).encode('utf-8')
+
+        path = path.encode('utf-8')
+        fileobj.write(_record.pack(kind, len(path), len(payload)))
+        fileobj.write(path)
+        fileobj.write(payload)
+        count += 1
+    fileobj.write(_record.pack(END, 0, 0))
+    return count
+
+
+def read(fileobj):
+    """ Yields the ``(cache name, path, value)`` tuples of the cache file in ``fileobj``. Raises
+    :class:`pykeeper.snapshot.SnapshotError` if it isn't a cache file or has been truncated. """
+    if _read_exactly(fileobj, len(HEADER)) != HEADER:
+        raise SnapshotError('not a pykeeper cache file')
+
+    while True:
+        kind, path_length, payload_length = _record.unpack(_read_exactly(fileobj, _record.size))
+        if kind & END:
+            return
+        path = intern_name(_read_exactly(fileobj, path_length).decode('utf-8'))
+        payload = _read_exactly(fileobj, payload_length)
+
+        name = _NAMES[kind & ~NO_DATA]
+        if name == 'get':
+            data = None if kind & NO_DATA else payload[STAT_SIZE:]
+            value = data, Stat(payload[:STAT_SIZE])
+        elif name == 'exists':
+            value = Stat(payload) if payload else None
+        else:
+            children = payload.decode('utf-8')
+            value = tuple([intern_name(child) for child in children.split('/')]) if children else ()
+        yield name, path, value
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise SnapshotError('truncated cache file')
+    return data
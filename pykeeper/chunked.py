@@ -0,0 +1,230 @@
+import collections
+import hashlib
+import json
+import operator
+import threading
+import uuid
+
+import zookeeper
+
+from pykeeper.client import ZOO_OPEN_ACL_UNSAFE, _Pipeline, join
+
+
+# comfortably below the default 1MB limit of the server (jute.maxbuffer)
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# keeps the data of a (data, stat) tuple, which is all we need of a chunk
+_data = operator.itemgetter(0)
+
+
+class Manifest(collections.namedtuple('Manifest', 'generation, size, chunks, checksum, version')):
+    """ Describes a chunked value. The chunks are the children ``<generation>-<index>`` of the manifest
+    node. ``version`` is the ``mzxid`` of the manifest node, which changes with every write. """
+
+    def chunk_paths(self, path):
+        return [join(path, '{0}-{1:06d}'.format(self.generation, index)) for index in range(self.chunks)]
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def _parse_manifest(data, stat):
+    if not data:
+        return None
+    if isinstance(data, bytes) and not isinstance(data, str):
+        data = data.decode('utf-8')
+    fields = json.loads(data)
+    return Manifest(fields['generation'], fields['size'], fields['chunks'], fields['checksum'], stat['mzxid'])
+
+
+class ChunkedValues(object):
+    """ Stores values that are too large for a single znode.
+
+    A value is split into chunks of ``chunk_size`` bytes, which are stored as children of a
+    manifest node. Writers create the chunks of a new generation first and then replace the
+    manifest, so readers see either the old or the new value, never a mix. The chunks of the old
+    generation are deleted afterwards, a reader still reading them retries with the new manifest.
+
+    The chunks are read with pipelined requests, keeping at most ``window`` of them in flight.
+    Values must be byte strings, and the paths of chunked values should not have a codec. The
+    manifest is read and written through the client, so it is retried according to its retry policy.
+    """
+
+    def __init__(self, client, chunk_size=DEFAULT_CHUNK_SIZE, window=None, retries=3):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.window = window or client.pipeline_window
+        self.retries = retries
+
+    def manifest(self, path):
+        """ Returns the :class:`Manifest` of ``path``, or ``None`` if no value has been written yet. """
+        try:
+            data, stat = self._get_manifest(path)
+        except zookeeper.NoNodeException:
+            return None
+        return _parse_manifest(data, stat)
+
+    def write(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE]):
+        """ Writes ``value`` to ``path``, returning the new :class:`Manifest`.
+
+        Raises ``BadVersionException`` if another client replaced the value at the same time.
+        """
+        self.client._create_recursive(path, '', acl)
+        data, stat = self._get_manifest(path)
+        previous = _parse_manifest(data, stat)
+
+        chunks = [value[offset:offset + self.chunk_size] for offset in range(0, len(value), self.chunk_size)]
+        generation = uuid.uuid4().hex[:12]
+        manifest = Manifest(generation, len(value), len(chunks), hashlib.sha1(value).hexdigest(), None)
+        chunk_paths = manifest.chunk_paths(path)
+
+        pipeline = _Pipeline(self.window)
+        for chunk_path, chunk in zip(chunk_paths, chunks):
+            pipeline.submit(*self.client._raw_create_request(chunk_path, chunk, acl))
+        try:
+            self._raise_first(pipeline.wait())
+        except Exception:
+            self._delete(chunk_paths)
+            raise
+
+        encoded = json.dumps(dict(generation=manifest.generation, size=manifest.size, chunks=manifest.chunks,
+                                  checksum=manifest.checksum))
+        try:
+            # only replace the manifest we based this write on
+            new_stat = self.client.set2(path, encoded, stat['version'])
+        except zookeeper.BadVersionException:
+            self._delete(chunk_paths)
+            raise
+
+        if previous is not None:
+            self._delete(previous.chunk_paths(path))
+        return manifest._replace(version=new_stat['mzxid'])
+
+    def read(self, path):
+        """ Returns the value of ``path``, or ``None`` if no value has been written yet. """
+        for attempt in range(self.retries + 1):
+            manifest = self.manifest(path)
+            if manifest is None:
+                return None
+
+            pipeline = _Pipeline(self.window)
+            for chunk_path in manifest.chunk_paths(path):
+                pipeline.submit(*self._chunk_request(chunk_path))
+            chunks = pipeline.wait()
+
+            if any(isinstance(chunk, zookeeper.NoNodeException) for chunk in chunks) and attempt < self.retries:
+                # the value was replaced while we were reading it
+                continue
+            self._raise_first(chunks)
+
+            value = b''.join(chunks)
+            if hashlib.sha1(value).hexdigest() != manifest.checksum:
+                raise ChecksumMismatch(path)
+            return value
+
+    def stream(self, path, manifest=None):
+        """ Yields the chunks of the value of ``path`` in order, keeping at most ``window`` chunks in flight.
+
+        The checksum is verified after the last chunk has been yielded. Raises ``NoNodeException`` if
+        the value is replaced while it is streamed, as the chunks yielded already can't be taken back.
+        """
+        manifest = manifest or self.manifest(path)
+        if manifest is None:
+            return
+
+        checksum = hashlib.sha1()
+        pending = collections.deque()
+        chunk_paths = iter(manifest.chunk_paths(path))
+
+        def fetch_next():
+            chunk_path = next(chunk_paths, None)
+            if chunk_path is not None:
+                pending.append(self._get_async(chunk_path))
+
+        for i in range(self.window):
+            fetch_next()
+
+        while pending:
+            chunk = pending.popleft()()
+            fetch_next()
+            if isinstance(chunk, Exception):
+                raise chunk
+            checksum.update(chunk)
+            yield chunk
+
+        if checksum.hexdigest() != manifest.checksum:
+            raise ChecksumMismatch(path)
+
+    def cached_read(self, path):
+        """ Like :meth:`read`, but the value is cached until the manifest changes. The manifest is
+        read with :meth:`ZooKeeper.cached_get`, so cache hits don't make any requests. """
+        try:
+            data, stat = self.client.cached_get(path)
+        except zookeeper.NoNodeException:
+            return None
+        manifest = _parse_manifest(data, stat)
+        if manifest is None:
+            return None
+
+        cache = self.client.get_cache('chunked')
+        entry = cache.get(path)
+        if entry is not None and entry[0] == manifest.version:
+            return entry[1]
+
+        for attempt in range(self.retries + 1):
+            try:
+                value = b''.join(self.stream(path, manifest))
+                break
+            except zookeeper.NoNodeException:
+                # the value was replaced while we were reading it, and the cached manifest hasn't been invalidated yet
+                if attempt == self.retries:
+                    raise
+                manifest = self.manifest(path)
+                if manifest is None:
+                    return None
+
+        cache.put(path, (manifest.version, value))
+        return value
+
+    def delete(self, path):
+        """ Deletes the value and its manifest. """
+        self.client.get_cache('chunked').pop(path)
+        self.client.delete_recursive(path, force=True)
+
+    def _get_async(self, path):
+        """ Starts fetching ``path``, returning a function that waits for the data (or exception). """
+        done = threading.Event()
+        result = list()
+        issue, complete = self._chunk_request(path)
+
+        def completion(handle, rc, *args):
+            result.append(complete(rc, *args))
+            done.set()
+
+        issue(completion)
+
+        def wait():
+            done.wait()
+            return result[0]
+        return wait
+
+    def _get_manifest(self, path):
+        # the manifest is stored as it is, like the chunks
+        return self.client._call('get', zookeeper.get, path, None)
+
+    def _chunk_request(self, path):
+        return self.client._get_request(path, None, _data, decode=False)
+
+    def _delete(self, paths):
+        pipeline = _Pipeline(self.window)
+        for path in paths:
+            pipeline.submit(*self.client._delete_request(path))
+        for result in pipeline.wait():
+            if isinstance(result, Exception) and not isinstance(result, zookeeper.NoNodeException):
+                raise result
+
+    def _raise_first(self, results):
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
@@ -1,10 +1,19 @@
+import itertools
 import logging
+import os
 import threading
-from collections import namedtuple
+import time
+from collections import OrderedDict, namedtuple
 
 import zookeeper
 
-from pykeeper import event
+from pykeeper import cache_file, event, recipes, snapshot, watchers
+from pykeeper.dispatch import InlineDispatcher
+from pykeeper.cache import LRUCache, Invalidator
+from pykeeper.compact import COMPACTORS, intern_name
+from pykeeper.metrics import outcome
+from pykeeper.retry import Backoff, RETRYABLE_ERRORS
+from pykeeper.watches import WatchRegistry, WATCH_KINDS
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +40,54 @@ TYPE_NAME_MAPPING = {
     zookeeper.CHILD_EVENT: "child"
 }
 
+ERROR_EXCEPTION_MAPPING = {
+    zookeeper.SYSTEMERROR: zookeeper.SystemErrorException,
+    zookeeper.RUNTIMEINCONSISTENCY: zookeeper.RuntimeInconsistencyException,
+    zookeeper.DATAINCONSISTENCY: zookeeper.DataInconsistencyException,
+    zookeeper.CONNECTIONLOSS: zookeeper.ConnectionLossException,
+    zookeeper.MARSHALLINGERROR: zookeeper.MarshallingErrorException,
+    zookeeper.UNIMPLEMENTED: zookeeper.UnimplementedException,
+    zookeeper.OPERATIONTIMEOUT: zookeeper.OperationTimeoutException,
+    zookeeper.BADARGUMENTS: zookeeper.BadArgumentsException,
+    zookeeper.INVALIDSTATE: zookeeper.InvalidStateException,
+    zookeeper.APIERROR: zookeeper.ApiErrorException,
+    zookeeper.NONODE: zookeeper.NoNodeException,
+    zookeeper.NOAUTH: zookeeper.NoAuthException,
+    zookeeper.BADVERSION: zookeeper.BadVersionException,
+    zookeeper.NOCHILDRENFOREPHEMERALS: zookeeper.NoChildrenForEphemeralsException,
+    zookeeper.NODEEXISTS: zookeeper.NodeExistsException,
+    zookeeper.NOTEMPTY: zookeeper.NotEmptyException,
+    zookeeper.SESSIONEXPIRED: zookeeper.SessionExpiredException,
+    zookeeper.INVALIDCALLBACK: zookeeper.InvalidCallbackException,
+    zookeeper.INVALIDACL: zookeeper.InvalidACLException,
+    zookeeper.AUTHFAILED: zookeeper.AuthFailedException,
+    zookeeper.CLOSING: zookeeper.ClosingException,
+    zookeeper.NOTHING: zookeeper.NothingException,
+    zookeeper.SESSIONMOVED: zookeeper.SessionMovedException,
+}
+
+# the kind of watch the invalidators of each cache type use
+CACHE_WATCH_KINDS = {
+    'exists': 'exists',
+    'get_children': 'child',
+    'get': 'data',
+}
+
+# the operation that sets each kind of watch
+WATCH_OPERATIONS = {
+    'exists': 'exists',
+    'child': 'get_children',
+    'data': 'get',
+}
+
+# the requests that may be repeated after a connection loss without changing their outcome
+IDEMPOTENT_OPERATIONS = frozenset(['exists', 'get_children', 'get', 'get_acl', 'set', 'set2'])
+
+# the maximum number of asynchronous requests the bulk methods keep in flight by default
+DEFAULT_PIPELINE_WINDOW = 256
+# the records of a snapshot restored per pipeline, bounding the results kept in memory
+RESTORE_BATCH = 10000
+
 ZOO_OPEN_ACL_UNSAFE = {
     "perms": zookeeper.PERM_ALL,
     "scheme": "world",
@@ -43,6 +100,7 @@ class ClientEvent(namedtuple("ClientEvent", 'type, connection_state, path')):
     A client event is returned when a watch deferred fires. It denotes
     some event on the zookeeper client that the watch was requested on.
     """
+    __slots__ = ()
 
     @property
     def type_name(self):
@@ -55,6 +113,35 @@ class ClientEvent(namedtuple("ClientEvent", 'type, connection_state, path')):
         return  "<ClientEvent %s at %r state: %s>" % (
             self.type_name, self.path, self.state_name)
 
+class DeleteProgress(namedtuple('DeleteProgress', 'phase, discovered, deleted, kept')):
+    """
+    Reports the progress of :meth:`ZooKeeper.delete_recursive`. ``kept`` counts the
+    nodes that were not deleted because they are, or have, ephemeral descendants.
+    """
+
+
+class RestoreResult(namedtuple('RestoreResult', 'created, existing, ephemerals')):
+    """
+    Returned by :meth:`ZooKeeper.restore`. ``existing`` counts the nodes that were left
+    alone because they existed already, ``ephemerals`` the ephemeral nodes that were skipped.
+    """
+
+
+class RestoredEphemeral(namedtuple('RestoredEphemeral', 'path, new_path, error')):
+    """
+    Emitted by :attr:`ZooKeeper.on_ephemeral_restored` for every ephemeral node re-created after the
+    session expired. ``new_path`` differs from ``path`` for sequential nodes, and is ``None`` if the
+    node couldn't be re-created, in which case ``error`` is the exception and the node is no longer
+    restored. Nodes that failed because the connection was lost again aren't reported yet, they're
+    retried once we've reconnected.
+    """
+
+
+# what ZooKeeper keeps to re-create an ephemeral node. path is the path the node was created with,
+# which is the prefix of the actual path for sequential nodes. data is already encoded.
+_Ephemeral = namedtuple('_Ephemeral', 'path, data, acl, flags')
+
+
 class TimeoutException(Exception):
     pass
 
@@ -63,26 +150,290 @@ def join(*args):
     return '/'.join(args)
 
 
+def _child_path(path, name):
+    if path == '/':
+        return '/' + name
+    return join(path, name)
+
+
+def _watch_version(kind, result):
+    """ Returns what tells whether the node changed, given the result of a request setting a ``kind`` watch. """
+    if kind == 'child':
+        return hash(frozenset(result))
+    stat = result[1] if kind == 'data' else result
+    return None if stat is None else stat.get('mzxid')
+
+
+def error_to_exception(rc):
+    """ Returns an exception instance for the given zookeeper return code, like
+    the synchronous zkpython calls would have raised. """
+    exception_class = ERROR_EXCEPTION_MAPPING.get(rc, zookeeper.SystemErrorException)
+    return exception_class(zookeeper.zerror(rc))
+
+
+# flags the zookeeper completion thread, which runs the completions as well as the watchers
+_completion_thread = threading.local()
+
+
+class _Pipeline(object):
+    """ Issues asynchronous requests while keeping at most ``window`` of them in flight,
+    collecting the results (or exception instances) in the order they were submitted.
+
+    The requests complete on the zookeeper completion thread, so a pipeline can't be used from
+    there, such as by a watcher run by the :class:`pykeeper.dispatch.InlineDispatcher`.
+    """
+
+    def __init__(self, window):
+        if getattr(_completion_thread, 'flagged', False):
+            raise RuntimeError('bulk requests would wait forever on the zookeeper completion thread, '
+                               'use a dispatcher that runs the watchers on another thread')
+        self.results = list()
+        self._window = threading.Semaphore(window)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._pending = 1
+
+    def submit(self, issue, complete):
+        """ Calls ``issue(completion)``, which should start an asynchronous request. When it completes,
+        the result of ``complete(rc, *args)`` is stored. Blocks while the window is full. """
+        index = len(self.results)
+        self.results.append(None)
+
+        self._window.acquire()
+        with self._lock:
+            self._pending += 1
+
+        def completion(handle, rc, *args):
+            try:
+                self.results[index] = complete(rc, *args)
+            except Exception as e:
+                self.results[index] = e
+            self._finish()
+
+        try:
+            issue(completion)
+        except Exception as e:
+            self.results[index] = e
+            self._finish()
+
+    def _finish(self):
+        self._window.release()
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+
+    def wait(self):
+        """ Waits for all the submitted requests to complete and returns their results. """
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+        self._done.wait()
+        return self.results
+
+
+class _Flight(object):
+    """ A request that other callers may wait for the result of instead of issuing their own. """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _SingleFlight(object):
+    """ Coalesces concurrent requests for the same key into a single request. """
+
+    def __init__(self):
+        self._flights = dict()
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """ Returns ``(flight, leader)``. Only the leader should issue the request and call :meth:`finish`,
+        the others should wait for the flight. """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def finish(self, key, flight, result=None, error=None):
+        with self._lock:
+            del self._flights[key]
+        flight.result = result
+        flight.error = error
+        flight.done.set()
+
+    def do(self, key, func):
+        flight, leader = self.begin(key)
+        if not leader:
+            return flight.wait()
+
+        try:
+            result = func()
+        except Exception as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result)
+        return result
+
+
 class ZooKeeper(object):
 
-    def __init__(self, servers, reconnect=True):
+    def __init__(self, servers, reconnect=True, pipeline_window=DEFAULT_PIPELINE_WINDOW, caches=None, cache_factory=LRUCache,
+                 stale_cache_reads=True, dispatcher=None, metrics=None, codecs=None, reconnect_backoff=None,
+                 retry_policy=None, offline_queue=None, restore_ephemerals=False):
         self.servers = servers
         self.reconnect = reconnect
+        # the delays before reconnecting after the session expired, see pykeeper.retry.Backoff
+        self.reconnect_backoff = reconnect_backoff or Backoff()
+        # a pykeeper.retry.RetryPolicy retrying the synchronous requests after connection losses, or None
+        self.retry_policy = retry_policy
+        # a pykeeper.retry.OfflineQueue holding the requests made while we're not connected, or None
+        self.offline_queue = offline_queue
+        # whether the ephemeral nodes created with create() are re-created after the session expired by default
+        self.restore_ephemerals = restore_ephemerals
+        self.pipeline_window = pipeline_window
+        self.cache_factory = cache_factory
+        # whether cached reads may return possibly stale values while the caches are revalidated after a
+        # session expiry, or should block until the revalidation is done.
+        self.stale_cache_reads = stale_cache_reads
+        # runs the watchers and the on_state/on_event handlers, see pykeeper.dispatch
+        self.dispatcher = dispatcher or InlineDispatcher()
+        # a pykeeper.metrics.Metrics, or None to disable the instrumentation
+        self.metrics = metrics
+        # a pykeeper.codec.Codecs encoding and decoding the values per path, or None to use the raw values.
+        # the cached values are the decoded ones, so they must not be modified.
+        self.codecs = codecs
         self.handle = None
 
-        self._caches = dict()
+        # caches may be configured per cache type, the rest are created on demand using cache_factory
+        self._caches = dict(caches or ())
+        self._caches_lock = threading.Lock()
+        # concurrent cache misses for the same (cache type, path) share a single request
+        self._cache_misses = _SingleFlight()
+        # at most one server watch per (path, kind), shared by all local watchers
+        self._watches = WatchRegistry()
+        # cleared while the caches and watches are lost because the session expired
+        self._revalidated = threading.Event()
+        self._revalidated.set()
+        # set when the caches should be revalidated once we're connected, such as after a session expiry
+        self._revalidate_when_connected = False
+        self._last_event = None
+        self._closed = False
+        # set while the session has expired and we haven't reconnected yet. zkpython reuses the slots of
+        # closed handles, so the new session usually has the same handle as the expired one.
+        self._expired = False
+        # counts the sessions we've connected, telling the reconnect of an expiry whether it's still needed
+        self._session_number = 0
+        # the ephemeral nodes to re-create after the session expired, by path
+        self._ephemerals = OrderedDict()
+        self._ephemerals_lock = threading.Lock()
+        self._restore_ephemerals_when_connected = False
 
         self.on_state = event.Event()
         self.on_event = event.Event()
+        self.on_ephemeral_restored = event.Event()
 
     def connect(self):
-        self.handle = zookeeper.init(self.servers, self._global_watcher)
-        self.on_state(self, self.state_name)
+        self._closed = False
+        self.handle = zookeeper.init(self.servers, self._completion_thread_watcher)
+        self._session_number += 1
+        self._expired = False
+        self._dispatch_handler('on_state', self.on_state, self, self.state_name)
+
+    def get_cache(self, name):
+        """ Returns the cache used by ``cached_<name>``, creating it if necessary. """
+        cache = self._caches.get(name)
+        if cache is None:
+            with self._caches_lock:
+                cache = self._caches.get(name)
+                if cache is None:
+                    cache = self._caches[name] = self.cache_factory()
+        return cache
+
+    def dispatch_stats(self):
+        """ Returns the :class:`pykeeper.dispatch.DispatchStats` of the dispatcher. """
+        return self.dispatcher.stats()
+
+    def cache_stats(self):
+        """ Returns a dict of :class:`pykeeper.cache.CacheStats` per cache type. """
+        return dict((name, cache.stats()) for name, cache in list(self._caches.items()))
+
+    def metrics_snapshot(self):
+        """ Returns a :class:`pykeeper.metrics.MetricsSnapshot`, or ``None`` if the metrics are disabled. """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot(self.cache_stats())
+
+    def export_metrics(self):
+        """ Passes a snapshot of the metrics to the exporter of the metrics, if there is one. """
+        if self.metrics is not None and self.metrics.exporter is not None:
+            self.metrics.exporter(self.metrics_snapshot())
+
+    def _pipeline(self, window=None):
+        return _Pipeline(window or self.pipeline_window)
+
+    def _timed(self, operation, func, *args):
+        metrics = self.metrics
+        if metrics is None:
+            return func(*args)
+
+        started = time.time()
+        try:
+            retval = func(*args)
+        except Exception as e:
+            metrics.observe(operation, outcome(e), time.time() - started)
+            raise
+        metrics.observe(operation, 'ok', time.time() - started)
+        return retval
+
+    def _call(self, operation, func, *args):
+        """ Calls ``func`` with the handle and ``args``. Requests in :data:`IDEMPOTENT_OPERATIONS` are
+        retried according to the retry policy. """
+        if self.retry_policy is None or operation not in IDEMPOTENT_OPERATIONS:
+            return self._attempt(operation, func, *args)
+        return self._retried(operation, func, *args)
+
+    def _retried(self, operation, func, *args):
+        """ Like :meth:`_call`, for requests the caller knows to be safe to repeat. """
+        if self.retry_policy is None:
+            return self._attempt(operation, func, *args)
+        return self.retry_policy.run(lambda attempt: self._attempt(operation, func, *args))
+
+    def _attempt(self, operation, func, *args):
+        if self.offline_queue is not None:
+            self.offline_queue.wait()
+        if self._expired:
+            raise zookeeper.SessionExpiredException('reconnecting after the session expired')
+        # the handle is replaced when we reconnect after the session expired
+        return self._timed(operation, func, self.handle, *args)
+
+    def _dispatch_handler(self, name, handler, *args):
+        # every subscriber separately, so a slow one doesn't hold up the others on a pool dispatcher.
+        # the calls of a subscriber have the same key, so it gets them in order.
+        for callback in handler:
+            key = 'handler-{0:x}'.format(id(callback))
+            if self.metrics is None:
+                self.dispatcher.dispatch(key, callback, *args)
+            else:
+                self.dispatcher.dispatch(key, self._timed, name, callback, *args)
 
     @property
     def state_name(self):
         if self.handle is None:
             return None
+        if self._expired:
+            return 'connecting'
         return STATE_NAME_MAPPING[zookeeper.state(self.handle)]
 
     @property
@@ -91,23 +442,298 @@ class ZooKeeper(object):
             return None
         return zookeeper.client_id(self.handle)
 
+    def _completion_thread_watcher(self, *args):
+        # the session events are the first to run on the completion thread
+        _completion_thread.flagged = True
+        self._global_watcher(*args)
+
     def _global_watcher(self, handle, event_type, conn_state, path):
         assert handle == self.handle, 'unexpected handle'
 
-        event = ClientEvent(event_type, conn_state, path)
-        logger.debug('{0}: Received event {1}'.format(self, event))
-
-        self.on_event(event)
-        self.on_state(self, self.state_name)
+        event = self._client_event(event_type, conn_state, path)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('{0}: Received event {1}'.format(self, event))
+
+        self._dispatch_handler('on_event', self.on_event, event)
+        self._dispatch_handler('on_state', self.on_state, self, self.state_name)
+        if self.metrics is not None:
+            self.metrics.increment('session_events', event.state_name)
+        if self.offline_queue is not None and event.type_name == 'session':
+            if event.state_name == 'connected':
+                self.offline_queue.connected()
+            else:
+                self.offline_queue.disconnected()
 
         if event.state_name == 'expired' and self.reconnect:
             logger.info('{0}: Session expired, reconnecting.'.format(self))
-            self.close()
-            self.connect()
+            if self.metrics is not None:
+                self.metrics.increment('reconnects')
+            # the server has forgotten our watches, so the caches can't be trusted until they've
+            # been revalidated, and the watches must be armed again.
+            self._revalidate_when_connected = True
+            self._revalidated.clear()
+            self._watches.expire()
+            self._restore_ephemerals_when_connected = bool(self._ephemerals)
+            # closing the handle and waiting out the backoff must not hold up the completion thread
+            self._expired = True
+            thread = threading.Thread(target=self._reconnect, args=(self.handle, self._session_number),
+                                      name='pykeeper-reconnect')
+            thread.daemon = True
+            thread.start()
+
+        elif event.state_name == 'connected':
+            # we're on the completion thread, which must not wait for the completion of our requests.
+            self._start_ephemeral_restore()
+            if self._revalidate_when_connected:
+                self._revalidate_when_connected = False
+                self._start_revalidation()
+
+    def _reconnect(self, expired_handle, expired_session_number):
+        zookeeper.close(expired_handle)
+        for attempt in itertools.count():
+            # a random delay even before the first attempt, so the clients of an ensemble that
+            # expired all the sessions don't all reconnect at once.
+            time.sleep(self.reconnect_backoff.delay(attempt))
+            if self._closed or self._session_number != expired_session_number:
+                # closed, or connected again, in the meantime
+                return
+            try:
+                self.connect()
+                return
+            except Exception as e:
+                logger.warning('{0}: Reconnecting failed: {1!r}'.format(self, e))
+
+    def _start_ephemeral_restore(self):
+        with self._ephemerals_lock:
+            if not self._restore_ephemerals_when_connected:
+                return
+            self._restore_ephemerals_when_connected = False
+        thread = threading.Thread(target=self._restore_ephemerals, name='pykeeper-restore-ephemerals')
+        thread.daemon = True
+        thread.start()
+
+    def _restore_ephemerals(self):
+        with self._ephemerals_lock:
+            ephemerals = list(self._ephemerals.items())
+
+        # a single pipelined round of creates, instead of one round trip per node
+        pipeline = _Pipeline(self.pipeline_window)
+        for path, ephemeral in ephemerals:
+            create_path = ephemeral.path if ephemeral.flags & zookeeper.SEQUENCE else path
+            pipeline.submit(*self._raw_create_request(create_path, ephemeral.data, ephemeral.acl, ephemeral.flags))
+
+        retried = 0
+        for (path, ephemeral), result in zip(ephemerals, pipeline.wait()):
+            if isinstance(result, zookeeper.NodeExistsException) and not ephemeral.flags & zookeeper.SEQUENCE:
+                # created by an earlier restore that lost the connection before we got the response
+                try:
+                    if self._owns_ephemeral(path):
+                        result = path
+                except Exception as e:
+                    result = e
+
+            with self._ephemerals_lock:
+                if self._ephemerals.get(path) is not ephemeral:
+                    # deleted while we were restoring it
+                    continue
+                if isinstance(result, RETRYABLE_ERRORS):
+                    # keep it for when we've reconnected
+                    self._restore_ephemerals_when_connected = True
+                    retried += 1
+                    continue
+                del self._ephemerals[path]
+                if not isinstance(result, Exception):
+                    self._ephemerals[result] = ephemeral
+
+            if isinstance(result, Exception):
+                logger.warning('{0}: Unable to restore the ephemeral node {1!r}: {2!r}'.format(self, path, result))
+                restored = RestoredEphemeral(path, None, result)
+            else:
+                restored = RestoredEphemeral(path, result, None)
+            if self.metrics is not None:
+                self.metrics.increment('ephemerals_restored', outcome(result))
+            self._dispatch_handler('on_ephemeral_restored', self.on_ephemeral_restored, restored)
+
+        logger.info('{0}: Restored {1} ephemeral nodes after the session expired.'.format(self, len(ephemerals) - retried))
+        if retried:
+            logger.info('{0}: Retrying to restore {1} ephemeral nodes once reconnected.'.format(self, retried))
+            # we may have reconnected while the requests were failing
+            if self.state_name == 'connected':
+                self._start_ephemeral_restore()
+
+    def ephemerals(self):
+        """ Returns the paths of the ephemeral nodes that will be re-created if the session expires. """
+        with self._ephemerals_lock:
+            return list(self._ephemerals)
+
+    def _start_revalidation(self):
+        thread = threading.Thread(target=self._revalidate, name='pykeeper-revalidate')
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def cache_is_stale(self):
+        """ True while the caches are being revalidated after the session expired. """
+        return not self._revalidated.is_set()
+
+    def save_caches(self, filename):
+        """ Writes the entries of the ``get``, ``exists`` and ``get_children`` caches to ``filename``, so
+        another process can start with warm caches using :meth:`load_caches`. The data is written encoded,
+        and the file is replaced atomically. Returns the number of entries written.
+        """
+        def entries():
+            for name in CACHE_WATCH_KINDS:
+                cache = self._caches.get(name)
+                if cache is None:
+                    continue
+                for path, value in cache.items():
+                    if name == 'get':
+                        value = self._encode(path, value[0]), value[1]
+                    yield name, path, value
+
+        temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                count = cache_file.write(f, entries())
+            os.rename(temporary, filename)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return count
+
+    def load_caches(self, filename):
+        """ Fills the caches with the entries saved by :meth:`save_caches`, returning how many there were.
+
+        The entries are revalidated in bulk as soon as we're connected, the same way the caches are
+        revalidated after a session expiry: a pipelined ``exists`` per cached ``get``, fetching only the data
+        of the nodes whose ``mzxid`` changed. Until then, they're served as they are, or not at all if
+        ``stale_cache_reads`` is false. Entries that are cached already are kept. A missing file is ignored.
+        """
+        if not os.path.exists(filename):
+            return 0
+
+        count = 0
+        with open(filename, 'rb') as f:
+            for name, path, value in cache_file.read(f):
+                if name == 'get':
+                    value = self._decode(path, value[0]), value[1]
+                cache = self.get_cache(name)
+                if path not in cache:
+                    cache.put(path, value)
+                    count += 1
+
+        self._revalidated.clear()
+        self._revalidate_when_connected = True
+        if self.state_name == 'connected':
+            self._revalidate_when_connected = False
+            self._start_revalidation()
+        return count
+
+    def wait_until_revalidated(self, timeout=None):
+        if not self._revalidated.wait(timeout):
+            raise TimeoutException()
+
+    def _revalidate(self):
+        try:
+            # the watches of the cached entries are among them, so entries that changed are invalidated
+            unchanged = self._rearm_watches()
+            for name, cache in list(self._caches.items()):
+                if name in CACHE_WATCH_KINDS:
+                    self._revalidate_cache(name, cache, unchanged)
+            logger.info('{0}: Revalidated the caches after the session expired.'.format(self))
+        except Exception as e:
+            # better to start over than to serve values that may be stale forever
+            logger.exception('{0}: Revalidating the caches failed, clearing them: {1}'.format(self, e))
+            for cache in list(self._caches.values()):
+                cache.clear()
+        finally:
+            self._revalidated.set()
+
+    def _revalidate_cache(self, name, cache, unchanged=frozenset()):
+        kind = CACHE_WATCH_KINDS[name]
+        pipeline = _Pipeline(self.pipeline_window)
+
+        entries = list()
+        for path, value in cache.items():
+            invalidator, store = self._cache_entry(name, cache, path)
+            watcher = self._watches.subscribe(path, kind, invalidator)
+            if (watcher is None and (path, kind) in unchanged
+                    and _watch_version(kind, value) == self._watches.version(path, kind)):
+                # re-armed, and seen to be unchanged, by _rearm_watches
+                cache.put(path, value, invalidator)
+                continue
+            entries.append((path, value, invalidator, watcher))
+
+            if name == 'get_children':
+                # a child watch can only be set by listing the children
+                pipeline.submit(*self._get_children_request(path, watcher, store))
+            elif name == 'exists':
+                pipeline.submit(*self._exists_request(path, watcher, store))
+            else:
+                # the stat is enough to tell whether the data changed, and sets the same watch as a get.
+                pipeline.submit(*self._exists_request(path, watcher))
+
+        refetch = _Pipeline(self.pipeline_window)
+        for (path, value, invalidator, watcher), result in zip(entries, pipeline.wait()):
+            if isinstance(result, Exception) or (name == 'get' and result is None):
+                self._watches.unsubscribe(path, kind, invalidator, watcher)
+                cache.invalidate(path)
+            elif name == 'get':
+                if result['mzxid'] == value[1]['mzxid']:
+                    cache.put(path, value, invalidator)
+                    self._watches.observe(path, kind, result['mzxid'])
+                else:
+                    # the watch is already armed
+                    refetch.submit(*self._get_request(path, None, self._cache_entry_store(name, cache, path, invalidator)))
+
+        for result in refetch.wait():
+            if isinstance(result, Exception):
+                logger.debug('{0}: Unable to refetch a cached value: {1}'.format(self, result))
+
+    def _rearm_watches(self):
+        """ Arms the watches with subscribers again, firing the events the subscribers missed while the
+        session was expired. Returns the ``(path, kind)`` of the watches whose node didn't change. """
+        pipeline = _Pipeline(self.pipeline_window)
+        rearmed = self._watches.rearm()
+        for path, kind, watcher in rearmed:
+            if kind == 'child':
+                pipeline.submit(*self._get_children_request(path, watcher))
+            else:
+                pipeline.submit(*self._exists_request(path, watcher))
+
+        unchanged = set()
+        for (path, kind, watcher), result in zip(rearmed, pipeline.wait()):
+            if isinstance(result, zookeeper.NoNodeException) or (kind == 'data' and result is None):
+                # the node is gone, which the subscribers would have been told if the session hadn't expired.
+                watcher(self.handle, zookeeper.DELETED_EVENT, zookeeper.CONNECTED_STATE, path)
+                continue
+            elif isinstance(result, Exception):
+                # leave the subscribers to be armed by the next request for the same watch
+                self._watches.disarm(path, kind, watcher)
+                continue
+
+            # a watch of which the version wasn't seen, such as one armed by a failed request, fires nothing
+            # data watches are armed with exists, which has the same mzxid as a get
+            seen, version = self._watches.version(path, kind), _watch_version('exists' if kind == 'data' else kind, result)
+            if seen is Ellipsis or seen == version:
+                unchanged.add((path, kind))
+            elif kind == 'child':
+                watcher(self.handle, zookeeper.CHILD_EVENT, zookeeper.CONNECTED_STATE, path)
+            elif version is None:
+                watcher(self.handle, zookeeper.DELETED_EVENT, zookeeper.CONNECTED_STATE, path)
+            elif kind == 'exists' and seen is None:
+                watcher(self.handle, zookeeper.CREATED_EVENT, zookeeper.CONNECTED_STATE, path)
+            else:
+                watcher(self.handle, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, path)
+        return unchanged
 
     def close(self):
+        self._closed = True
+        with self._ephemerals_lock:
+            self._ephemerals.clear()
         if self.handle is not None:
             zookeeper.close(self.handle)
+            self._watches.clear()
 
     def wait_until_connected(self, timeout=None):
         # optimizing for the common case of us already being connected
@@ -135,116 +761,747 @@ class ZooKeeper(object):
             self.on_state -= waiter
 
     def exists(self, path, watcher=None):
-        return zookeeper.exists(self.handle, path, self._wrap_watcher(watcher))
+        return self._watched(zookeeper.exists, path, 'exists', self._wrap_watcher(watcher))
 
     def cached_exists(self, path):
-        cache = self._caches.setdefault('exists', dict())
+        return self._cached('exists', path, zookeeper.exists)
 
-        retval = cache.get(path, Ellipsis)
-        if retval is not Ellipsis:
-            return retval
+    def aexists(self, path, callback, watcher=None):
+        """ Asynchronous :meth:`exists`. ``callback`` is called on the completion thread with the
+        stat (or ``None``), or the exception instance if the request failed. """
+        self._async_watched(self._exists_request, path, 'exists', self._wrap_watcher(watcher), callback)
 
-        def invalidator(event):
-            cache.pop(path, None)
+    def exists_many(self, paths, watcher=None, window=None):
+        """ Like :meth:`exists` for every path in ``paths``, but with the requests pipelined.
 
-        retval = zookeeper.exists(self.handle, path, self._wrap_watcher(invalidator))
-        cache[path] = retval
-        return retval
+        Returns a list with a stat (or ``None``) per path, in input order. Failed requests
+        are represented by their exception instance in the list.
+        """
+        return self._pipelined(paths, self._exists_request, 'exists', watcher, window)
+
+    def cached_exists_many(self, paths, window=None):
+        """ Like :meth:`cached_exists` for every path in ``paths``, with the cache misses pipelined. """
+        return self._cached_pipelined('exists', paths, self._exists_request, window)
+
+    def _exists_request(self, path, watcher, store=None):
+        def issue(completion):
+            zookeeper.aexists(self.handle, path, watcher, completion)
+
+        def complete(rc, stat):
+            if rc == zookeeper.NONODE:
+                stat = None
+            elif rc != zookeeper.OK:
+                return error_to_exception(rc)
+            if store is not None:
+                stat = store(stat)
+            return stat
+
+        return issue, complete
 
     def get_children(self, path, watcher=None):
-        return zookeeper.get_children(self.handle, path, self._wrap_watcher(watcher))
+        return self._watched(zookeeper.get_children, path, 'child', self._wrap_watcher(watcher))
 
     def cached_get_children(self, path):
-        cache = self._caches.setdefault('get_children', dict())
+        # the cache keeps the children as a compact tuple, but callers get a list like get_children returns
+        return list(self._cached('get_children', path, zookeeper.get_children))
 
-        retval = cache.get(path, Ellipsis)
-        if retval is not Ellipsis:
-            return retval
+    def aget_children(self, path, callback, watcher=None):
+        """ Asynchronous :meth:`get_children`. ``callback`` is called on the completion thread with
+        the children, or the exception instance if the request failed. """
+        self._async_watched(self._get_children_request, path, 'child', self._wrap_watcher(watcher), callback)
 
-        def invalidator(event):
-            cache.pop(path, None)
+    def get_children_many(self, paths, watcher=None, window=None):
+        """ Like :meth:`get_children` for every path in ``paths``, but with the requests pipelined.
 
-        retval = zookeeper.get_children(self.handle, path, self._wrap_watcher(invalidator))
-        cache[path] = retval
-        return retval
+        Returns a list with the children per path, in input order. Failed requests
+        are represented by their exception instance in the list.
+        """
+        return self._pipelined(paths, self._get_children_request, 'child', watcher, window)
+
+    def cached_get_children_many(self, paths, window=None):
+        """ Like :meth:`cached_get_children` for every path in ``paths``, with the cache misses pipelined. """
+        results = self._cached_pipelined('get_children', paths, self._get_children_request, window)
+        return [result if isinstance(result, Exception) else list(result) for result in results]
+
+    def _get_children_request(self, path, watcher, store=None):
+        def issue(completion):
+            zookeeper.aget_children(self.handle, path, watcher, completion)
+
+        def complete(rc, children):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            if store is not None:
+                children = store(children)
+            return children
+
+        return issue, complete
 
     def delete(self, path, version=-1):
-        return zookeeper.delete(self.handle, path, version)
+        retval = self._delete(path, version)
+        self._forget_ephemeral(path)
+        return retval
 
-    def delete_recursive(self, path, dry_run=False, force=False):
-        self._delete_recursive(path, dry_run, force)
+    def _forget_ephemeral(self, path):
+        if self._ephemerals:
+            with self._ephemerals_lock:
+                self._ephemerals.pop(path, None)
 
-    def get(self, path, watcher=None):
-        return zookeeper.get(self.handle, path, self._wrap_watcher(watcher))
+    def _delete(self, path, version):
+        if self.retry_policy is None:
+            return self._attempt('delete', zookeeper.delete, path, version)
 
-    def cached_get(self, path):
-        cache = self._caches.setdefault('get', dict())
+        def attempt(number):
+            try:
+                return self._attempt('delete', zookeeper.delete, path, version)
+            except zookeeper.NoNodeException:
+                if not number:
+                    raise
+                # deleted by an earlier attempt, which lost the connection before we got the response
+                return zookeeper.OK
 
-        retval = cache.get(path, Ellipsis)
-        if retval is not Ellipsis:
-            return retval
+        return self.retry_policy.run(attempt)
 
-        def invalidator(event):
-            cache.pop(path, None)
+    def delete_recursive(self, path, dry_run=False, force=False, window=None, progress=None):
+        """ Deletes ``path`` and all its descendants, keeping ephemeral nodes (and their ancestors)
+        unless ``force`` is true.
 
-        retval = zookeeper.get(self.handle, path, self._wrap_watcher(invalidator))
-        cache[path] = retval
-        return retval
+        The tree is discovered and deleted level by level using pipelined requests. If given,
+        ``progress`` is called with a :class:`DeleteProgress` after every level. Returns the
+        final :class:`DeleteProgress`.
+        """
+        return self._delete_recursive(path, dry_run, force, window, progress)
 
-    def create(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE], flags=0):
-        return zookeeper.create(self.handle, path, value, acl, flags)
+    def get(self, path, watcher=None):
+        return self._watched(self._fetch_get, path, 'data', self._wrap_watcher(watcher))
 
-    def create_recursive(self, path, data, acl=[ZOO_OPEN_ACL_UNSAFE]):
+    def cached_get(self, path):
+        return self._cached('get', path, self._fetch_get)
+
+    def aget(self, path, callback, watcher=None):
+        """ Asynchronous :meth:`get`. ``callback`` is called on the completion thread with
+        the ``(data, stat)`` tuple, or the exception instance if the request failed. """
+        self._async_watched(self._get_request, path, 'data', self._wrap_watcher(watcher), callback)
+
+    def get_many(self, paths, watcher=None, window=None):
+        """ Like :meth:`get` for every path in ``paths``, but with the requests pipelined.
+
+        Returns a list with a ``(data, stat)`` tuple per path, in input order. Failed requests
+        are represented by their exception instance in the list.
+        """
+        return self._pipelined(paths, self._get_request, 'data', watcher, window)
+
+    def cached_get_many(self, paths, window=None):
+        """ Like :meth:`cached_get` for every path in ``paths``, with the cache misses pipelined. """
+        return self._cached_pipelined('get', paths, self._get_request, window)
+
+    def _get_request(self, path, watcher, store=None, decode=True):
+        def issue(completion):
+            zookeeper.aget(self.handle, path, watcher, completion)
+
+        def complete(rc, data, stat):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            retval = (self._decode(path, data) if decode else data, stat)
+            if store is not None:
+                retval = store(retval)
+            return retval
+
+        return issue, complete
+
+    def create(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE], flags=0, restore=None):
+        """ Creates ``path``, returning the path of the new node.
+
+        Ephemeral nodes are re-created when the session expires if ``restore`` is true, or if it is
+        ``None`` and :attr:`restore_ephemerals` is true. They are re-created with pipelined requests as soon
+        as the new session is connected, and :attr:`on_ephemeral_restored` is called with a
+        :class:`RestoredEphemeral` for each of them, which has the new path of sequential nodes.
+        Deleting the node with :meth:`delete` stops it from being restored.
+
+        With a retry policy, a create that lost the connection may have created the node anyway. An
+        ephemeral node is retried, and an existing node owned by our session is taken to be the one of
+        the lost attempt. A persistent node can't be told apart from one created by someone else, so
+        the retry raises ``NodeExistsException`` if it exists. Sequential nodes aren't retried, as the
+        name of the node of a lost attempt isn't known: make the prefix unique per call and look for
+        it after a connection loss instead, like :class:`pykeeper.recipes.Lock` does.
+        """
+        data = self._encode(path, value)
+        created_path = self._create(path, data, acl, flags)
+
+        if flags & zookeeper.EPHEMERAL and (self.restore_ephemerals if restore is None else restore):
+            with self._ephemerals_lock:
+                self._ephemerals[created_path] = _Ephemeral(path, data, acl, flags)
+        return created_path
+
+    def _create(self, path, data, acl, flags):
+        if self.retry_policy is None or flags & zookeeper.SEQUENCE:
+            return self._attempt('create', zookeeper.create, path, data, acl, flags)
+
+        def attempt(number):
+            try:
+                return self._attempt('create', zookeeper.create, path, data, acl, flags)
+            except zookeeper.NodeExistsException:
+                if number and flags & zookeeper.EPHEMERAL and self._owns_ephemeral(path):
+                    # created by an earlier attempt, which lost the connection before we got the response
+                    return path
+                raise
+
+        return self.retry_policy.run(attempt)
+
+    def _owns_ephemeral(self, path):
+        stat = self._call('exists', zookeeper.exists, path, None)
+        return stat is not None and stat['ephemeralOwner'] == self.client_id[0]
+
+    def create_recursive(self, path, data, acl=[ZOO_OPEN_ACL_UNSAFE], optimistic=True):
+        """ Creates ``path`` and any missing parents. Existing nodes are left alone.
+
+        If ``optimistic`` is true, the node is created right away, and the parents are only
+        looked at if that fails because they are missing. Otherwise, the existence of every
+        level is checked first, which avoids the writes if the path usually exists already.
+        """
+        self._create_recursive(path, self._encode(path, data), acl, optimistic)
+
+    def _create_recursive(self, path, data, acl, optimistic=True):
+        if not optimistic:
+            return self._create_recursive_checked(path, data, acl)
+
+        try:
+            self._retried('create', zookeeper.create, path, data, acl, 0)
+        except zookeeper.NodeExistsException:
+            pass
+        except zookeeper.NoNodeException:
+            base, name = path.rsplit('/', 1)
+            if not base:
+                raise
+            # the parents are created without a value, which isn't encoded
+            self._create_recursive(base, '', acl)
+            try:
+                self._retried('create', zookeeper.create, path, data, acl, 0)
+            except zookeeper.NodeExistsException:
+                pass
+
+    def _create_recursive_checked(self, path, data, acl):
         if self.exists(path):
             return
         base, name = path.rsplit('/', 1)
         if base:
-            self.create_recursive(base, '', acl)
+            self._create_recursive_checked(base, '', acl)
         if not self.exists(path):
-            self.create(path, data, acl)
+            self._retried('create', zookeeper.create, path, data, acl, 0)
+
+    def ensure_paths(self, paths, acl=[ZOO_OPEN_ACL_UNSAFE], window=None):
+        """ Makes sure every path in ``paths`` exists, creating the missing ones and their parents
+        without a value.
+
+        The paths are merged into a tree first, so shared parents are only looked at once. The
+        existence of every node in the tree is checked with a single pipelined round of requests,
+        and the missing nodes are created level by level, with the creates of a level pipelined.
+        Returns the paths that were created, nodes created by someone else at the same time
+        are not included.
+        """
+        levels = list()
+        for path in paths:
+            parts = path.strip('/').split('/')
+            for depth in range(len(parts)):
+                if len(levels) <= depth:
+                    levels.append(OrderedDict())
+                levels[depth]['/' + '/'.join(parts[:depth + 1])] = None
+
+        nodes = [node for level in levels for node in level]
+        pipeline = _Pipeline(window or self.pipeline_window)
+        for node in nodes:
+            pipeline.submit(*self._exists_request(node, None))
+        missing = set()
+        for node, stat in zip(nodes, pipeline.wait()):
+            if isinstance(stat, Exception):
+                raise stat
+            if stat is None:
+                missing.add(node)
+
+        created = list()
+        for level in levels:
+            level = [node for node in level if node in missing]
+            pipeline = _Pipeline(window or self.pipeline_window)
+            for node in level:
+                pipeline.submit(*self._raw_create_request(node, '', acl))
+            for node, result in zip(level, pipeline.wait()):
+                if isinstance(result, zookeeper.NodeExistsException):
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                created.append(node)
+        return created
 
     def set(self, path, value):
-        return zookeeper.set(self.handle, path, value)
+        return self._call('set', zookeeper.set, path, self._encode(path, value))
 
-    def set2(self, path, value):
-        return zookeeper.set2(self.handle, path, value)
+    def set2(self, path, value, version=-1):
+        """ Sets the data of ``path``, returning the new stat. If ``version`` is given, the data is only
+        set if the node has that version. Such a conditional set isn't retried, as a retry would fail
+        if the earlier attempt succeeded. """
+        if version != -1:
+            return self._attempt('set2', zookeeper.set2, path, self._encode(path, value), version)
+        return self._call('set2', zookeeper.set2, path, self._encode(path, value))
 
     def get_acl(self, path):
-        return zookeeper.get_acl(self.handle, path)
+        return self._call('get_acl', zookeeper.get_acl, path)
 
     def set_acl(self, path, version, acl):
-        return zookeeper.set_acl(self.handle, path, version, acl)
+        return self._call('set_acl', zookeeper.set_acl, path, version, acl)
+
+    def lock(self, path, identifier=''):
+        """ Returns a :class:`pykeeper.recipes.Lock` on ``path``. """
+        return recipes.Lock(self, path, identifier)
+
+    def read_write_lock(self, path, identifier=''):
+        """ Returns a :class:`pykeeper.recipes.ReadWriteLock` on ``path``. """
+        return recipes.ReadWriteLock(self, path, identifier)
+
+    def leader_election(self, path, identifier=''):
+        """ Returns a :class:`pykeeper.recipes.LeaderElection` among the contenders on ``path``. """
+        return recipes.LeaderElection(self, path, identifier)
+
+    def queue(self, path, spread=recipes.DEFAULT_SPREAD):
+        """ Returns a :class:`pykeeper.recipes.Queue` of the items below ``path``. """
+        return recipes.Queue(self, path, spread)
 
     def is_ephemeral(self, path, cache=False):
-        getter = self.get
+        # only the stat is needed, so avoid fetching the data of the node
+        getter = self.exists
         if cache:
-            getter = self.cached_get
-        return bool(getter(path)[1]['ephemeralOwner'])
+            getter = self.cached_exists
+        stat = getter(path)
+        if stat is None:
+            raise error_to_exception(zookeeper.NONODE)
+        return bool(stat['ephemeralOwner'])
+
+    def walk(self, path, window=None, decode=True):
+        """ Yields ``(path, data, stat)`` for ``path`` and all its descendants, parents before
+        their children. Nodes deleted during the walk are skipped.
+
+        Up to ``window`` nodes are fetched at a time with pipelined requests. The nodes still to
+        be fetched are kept depth first, so the memory used depends on the depth and width of
+        the tree, not its size. If ``decode`` is false, the data is yielded as it is stored.
+        """
+        window = window or self.pipeline_window
+        pending = [path]
+        while pending:
+            batch = pending[-window:]
+            del pending[-window:]
+            batch.reverse()
+
+            pipeline = _Pipeline(window)
+            for node_path in batch:
+                pipeline.submit(*self._get_request(node_path, None, decode=decode))
+                pipeline.submit(*self._get_children_request(node_path, None))
+            results = pipeline.wait()
+
+            found = list()
+            for node_path, result, children in zip(batch, results[::2], results[1::2]):
+                if isinstance(result, zookeeper.NoNodeException) or isinstance(children, zookeeper.NoNodeException):
+                    if node_path == path:
+                        raise error_to_exception(zookeeper.NONODE)
+                    continue
+                for value in (result, children):
+                    if isinstance(value, Exception):
+                        raise value
+
+                found.append((node_path, children))
+                data, stat = result
+                yield node_path, data, stat
+
+            # visit the children of the first node of the batch first
+            for node_path, children in reversed(found):
+                pending.extend(_child_path(node_path, name) for name in sorted(children, reverse=True))
+
+    def export(self, path, fileobj, window=None):
+        """ Writes a snapshot of ``path`` and its descendants to ``fileobj``, which should be opened in
+        binary mode. The data is written as it is stored, see :mod:`pykeeper.snapshot` for the format.
+        Returns the number of nodes written. """
+        prefix = len(path.rstrip('/'))
+        records = ((node_path[prefix:].lstrip('/'), data, bool(stat['ephemeralOwner']))
+                   for node_path, data, stat in self.walk(path, window, decode=False))
+        return snapshot.write(fileobj, records)
+
+    def restore(self, fileobj, target, acl=[ZOO_OPEN_ACL_UNSAFE], window=None):
+        """ Recreates the nodes of a snapshot written by :meth:`export` below ``target``, returning a
+        :class:`RestoreResult`. Ephemeral nodes are skipped, and existing nodes are left alone.
+
+        The creates are pipelined in the order of the snapshot, which has parents before their children.
+        ZooKeeper handles the requests of a session in order, so a parent is always created first.
+        """
+        base = target.rsplit('/', 1)[0]
+        if base:
+            self._create_recursive(base, '', acl)
+
+        created = existing = ephemerals = 0
+        records = snapshot.read(fileobj)
+        while True:
+            pipeline = _Pipeline(window or self.pipeline_window)
+            count = 0
+            for relative_path, data, ephemeral in records:
+                if ephemeral:
+                    ephemerals += 1
+                    continue
+                node_path = _child_path(target, relative_path) if relative_path else target
+                pipeline.submit(*self._raw_create_request(node_path, data, acl))
+                count += 1
+                if count == RESTORE_BATCH:
+                    break
+
+            for result in pipeline.wait():
+                if isinstance(result, zookeeper.NodeExistsException):
+                    existing += 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    created += 1
+
+            if count < RESTORE_BATCH:
+                return RestoreResult(created, existing, ephemerals)
+
+    def _delete_recursive(self, path, dry_run, force, window, progress):
+        # discover the tree breadth first, one pipelined round of requests per level. only the stats
+        # are fetched, as they contain everything we need to know about each node.
+        levels = list()
+        children_of = dict()
+        ephemerals = set()
+        discovered = 0
+
+        level = [path]
+        while level:
+            pipeline = _Pipeline(window or self.pipeline_window)
+            for node_path in level:
+                pipeline.submit(*self._exists_request(node_path, None))
+                pipeline.submit(*self._get_children_request(node_path, None))
+            results = pipeline.wait()
+
+            existing = list()
+            next_level = list()
+            for node_path, stat, children in zip(level, results[::2], results[1::2]):
+                if stat is None or isinstance(children, zookeeper.NoNodeException):
+                    # the node was deleted while we were looking at the tree
+                    if node_path == path:
+                        raise error_to_exception(zookeeper.NONODE)
+                    continue
+                for result in (stat, children):
+                    if isinstance(result, Exception):
+                        raise result
+
+                existing.append(node_path)
+                if stat['ephemeralOwner']:
+                    ephemerals.add(node_path)
+
+                children_of[node_path] = [join(node_path, name) for name in children]
+                next_level.extend(children_of[node_path])
+
+            discovered += len(existing)
+            levels.append(existing)
+            level = next_level
+
+            if progress:
+                progress(DeleteProgress('discovering', discovered, 0, 0))
+
+        # delete the leaves first, one pipelined round of deletes per level.
+        kept = set()
+        deleted = 0
+        for level in reversed(levels):
+            pipeline = _Pipeline(window or self.pipeline_window)
+
+            for node_path in level:
+                if any(child in kept for child in children_of[node_path]):
+                    if not dry_run:
+                        logger.debug('{0}: Didn\'t delete {1!r} because it has an ephemeral child.'.format(self, node_path))
+                    kept.add(node_path)
+                    continue
+
+                ephemeral = node_path in ephemerals and not force
+                if dry_run:
+                    if ephemeral:
+                        logger.info('{0}: (dry-run) Not deleting {1!r} because it is an ephemeral.'.format(self, node_path))
+                    else:
+                        logger.info('{0}: (dry-run) Would delete {1!r}.'.format(self, node_path))
+                else:
+                    if ephemeral:
+                        logger.debug('{0}: Not deleting {1!r} because it is an ephemeral.'.format(self, node_path))
+                    else:
+                        logger.debug('{0}: Deleting {1!r}.'.format(self, node_path))
+                        pipeline.submit(*self._delete_request(node_path))
+
+                if ephemeral:
+                    kept.add(node_path)
+                else:
+                    deleted += 1
+
+            for result in pipeline.wait():
+                # someone else deleting the node before us is fine
+                if isinstance(result, Exception) and not isinstance(result, zookeeper.NoNodeException):
+                    raise result
+
+            if progress:
+                progress(DeleteProgress('deleting', discovered, deleted, len(kept)))
+
+        return DeleteProgress('done', discovered, deleted, len(kept))
+
+    def _delete_request(self, path, version=-1):
+        def issue(completion):
+            zookeeper.adelete(self.handle, path, version, completion)
+
+        def complete(rc):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            self._forget_ephemeral(path)
+
+        return issue, complete
+
+    def _create_request(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        return self._raw_create_request(path, self._encode(path, value), acl, flags)
+
+    def _raw_create_request(self, path, value, acl=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        def issue(completion):
+            zookeeper.acreate(self.handle, path, value, acl, flags, completion)
+
+        def complete(rc, created_path):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            return created_path
+
+        return issue, complete
+
+    def _set_request(self, path, value, version=-1):
+        value = self._encode(path, value)
+
+        def issue(completion):
+            zookeeper.aset(self.handle, path, value, version, completion)
+
+        def complete(rc, stat):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            return stat
+
+        return issue, complete
+
+    def _get_acl_request(self, path):
+        def issue(completion):
+            zookeeper.aget_acl(self.handle, path, completion)
+
+        def complete(rc, acl, stat):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
+            # same order as the synchronous get_acl
+            return stat, acl
+
+        return issue, complete
+
+    def _set_acl_request(self, path, version, acl):
+        def issue(completion):
+            zookeeper.aset_acl(self.handle, path, version, acl, completion)
 
-    def _delete_recursive(self, path, dry_run, force):
-        has_ephemeral_child = None
+        def complete(rc):
+            if rc != zookeeper.OK:
+                return error_to_exception(rc)
 
-        for name in list(self.get_children(path)):
-            has_ephemeral_child = self._delete_recursive(join(path, name), dry_run, force)
+        return issue, complete
+
+    def _fetch_get(self, handle, path, watcher):
+        data, stat = zookeeper.get(handle, path, watcher)
+        return self._decode(path, data), stat
 
-        if has_ephemeral_child:
-            if not dry_run:
-                logger.debug('{0}: Didn\'t delete {1!r} because it has an ephemeral child.'.format(self, path))
-            return has_ephemeral_child
+    def _encode(self, path, value):
+        if self.codecs is None:
+            return value
+        return self.codecs.encode(path, value)
 
-        ephemeral = self.is_ephemeral(path) and not force
-        if dry_run:
-            if ephemeral:
-                logger.info('{0}: (dry-run) Not deleting {1!r} because it is an ephemeral.'.format(self, path))
+    def _decode(self, path, data):
+        if self.codecs is None:
+            return data
+        return self.codecs.decode(path, data)
+
+    def _cached(self, cache_name, path, fetch):
+        cache = self.get_cache(cache_name)
+
+        if not self.stale_cache_reads and not self._revalidated.is_set():
+            self._revalidated.wait()
+
+        retval = cache.get(path, Ellipsis)
+        if retval is not Ellipsis:
+            return retval
+
+        def fetch_and_store():
+            key = intern_name(path)
+            invalidator = Invalidator(cache, key)
+            retval = COMPACTORS[cache_name](self._watched(fetch, key, CACHE_WATCH_KINDS[cache_name], invalidator))
+            cache.put(key, retval, invalidator)
+            return retval
+
+        return self._cache_misses.do((cache_name, path), fetch_and_store)
+
+    def _watched(self, fetch, path, kind, subscriber):
+        operation = WATCH_OPERATIONS[kind]
+        if subscriber is None:
+            return self._call(operation, fetch, path, None)
+
+        watcher = self._watches.subscribe(path, kind, subscriber)
+        try:
+            retval = self._call(operation, fetch, path, watcher)
+        except Exception:
+            # zookeeper doesn't leave a watch behind for failed requests
+            self._watches.unsubscribe(path, kind, subscriber, watcher)
+            raise
+        self._watches.observe(path, kind, _watch_version(kind, retval))
+        return retval
+
+    def _async_watched(self, make_request, path, kind, subscriber, callback):
+        watcher = None
+        if subscriber is not None:
+            watcher = self._watches.subscribe(path, kind, subscriber)
+
+        issue, complete = make_request(path, watcher)
+        metrics = self.metrics
+        started = time.time()
+
+        def completion(handle, rc, *args):
+            try:
+                result = complete(rc, *args)
+            except Exception as e:
+                result = e
+            if metrics is not None:
+                metrics.observe('a' + WATCH_OPERATIONS[kind], outcome(result), time.time() - started)
+            if subscriber is not None:
+                if isinstance(result, Exception):
+                    self._watches.unsubscribe(path, kind, subscriber, watcher)
+                else:
+                    self._watches.observe(path, kind, _watch_version(kind, result))
+            callback(result)
+
+        def issue_or_fail():
+            try:
+                issue(completion)
+            except Exception as e:
+                if subscriber is not None:
+                    self._watches.unsubscribe(path, kind, subscriber, watcher)
+                callback(e)
+
+        if self.offline_queue is None:
+            issue_or_fail()
+            return
+        try:
+            self.offline_queue.defer(issue_or_fail)
+        except Exception as e:
+            if subscriber is not None:
+                self._watches.unsubscribe(path, kind, subscriber, watcher)
+            callback(e)
+
+    def _pipelined(self, paths, make_request, kind, watcher, window):
+        pipeline = _Pipeline(window or self.pipeline_window)
+        subscriptions = list()
+        for path in paths:
+            subscriber = self._wrap_watcher(watcher)
+            armed_watcher = None
+            if subscriber is not None:
+                armed_watcher = self._watches.subscribe(path, kind, subscriber)
+            subscriptions.append((path, subscriber, armed_watcher))
+            pipeline.submit(*make_request(path, armed_watcher))
+
+        results = pipeline.wait()
+        self._unsubscribe_failed(kind, subscriptions, results)
+        return results
+
+    def _unsubscribe_failed(self, kind, subscriptions, results):
+        for (path, subscriber, armed_watcher), result in zip(subscriptions, results):
+            if subscriber is None:
+                continue
+            if isinstance(result, Exception):
+                self._watches.unsubscribe(path, kind, subscriber, armed_watcher)
             else:
-                logger.info('{0}: (dry-run) Would delete {1!r}.'.format(self, path))
-        else:
-            if ephemeral:
-                logger.debug('{0}: Not deleting {1!r} because it is an ephemeral.'.format(self, path))
+                self._watches.observe(path, kind, _watch_version(kind, result))
+
+    def _cached_pipelined(self, cache_name, paths, make_request, window):
+        cache = self.get_cache(cache_name)
+        pipeline = _Pipeline(window or self.pipeline_window)
+
+        if not self.stale_cache_reads and not self._revalidated.is_set():
+            self._revalidated.wait()
+
+        kind = CACHE_WATCH_KINDS[cache_name]
+        retvals = list()
+        misses = list()
+        followed = list()
+        subscriptions = list()
+        for path in paths:
+            retval = cache.get(path, Ellipsis)
+            if retval is Ellipsis:
+                key = (cache_name, path)
+                flight, leader = self._cache_misses.begin(key)
+                if leader:
+                    misses.append((len(retvals), key, flight))
+                    # the result is stored in the cache on the completion thread, which guarantees that
+                    # it is stored before the invalidator can fire.
+                    invalidator, store = self._cache_entry(cache_name, cache, path)
+                    armed_watcher = self._watches.subscribe(path, kind, invalidator)
+                    subscriptions.append((path, invalidator, armed_watcher))
+                    pipeline.submit(*make_request(path, armed_watcher, store))
+                else:
+                    followed.append((len(retvals), flight))
+            retvals.append(retval)
+
+        results = pipeline.wait()
+        self._unsubscribe_failed(kind, subscriptions, results)
+        for (index, key, flight), result in zip(misses, results):
+            if isinstance(result, Exception):
+                self._cache_misses.finish(key, flight, error=result)
             else:
-                logger.debug('{0}: Deleting {1!r}.'.format(self, path))
-                self.delete(path)
-        return ephemeral
+                self._cache_misses.finish(key, flight, result)
+            retvals[index] = result
+
+        # the flights we follow may be our own if a path was requested more than once
+        for index, flight in followed:
+            flight.done.wait()
+            retvals[index] = flight.error or flight.result
+        return retvals
+
+    def _cache_entry(self, cache_name, cache, path):
+        path = intern_name(path)
+        invalidator = Invalidator(cache, path)
+        return invalidator, self._cache_entry_store(cache_name, cache, path, invalidator)
+
+    def _cache_entry_store(self, cache_name, cache, path, invalidator):
+        compact = COMPACTORS[cache_name]
+        kind = CACHE_WATCH_KINDS[cache_name]
+
+        def store(retval):
+            # the compact value is returned, so cache hits and misses return the same types
+            retval = compact(retval)
+            cache.put(path, retval, invalidator)
+            self._watches.observe(path, kind, _watch_version(kind, retval))
+            return retval
+
+        return store
+
+    def children_watch(self, path, func, window=watchers.DEFAULT_COALESCE_WINDOW):
+        """ Starts and returns a :class:`pykeeper.watchers.ChildrenWatch`, calling ``func`` with the
+        changes of the children of ``path``. """
+        watch = watchers.ChildrenWatch(self, path, func, window)
+        watch.start()
+        return watch
+
+    def data_watch(self, path, func, window=watchers.DEFAULT_COALESCE_WINDOW):
+        """ Starts and returns a :class:`pykeeper.watchers.DataWatch`, calling ``func`` with the
+        changes of the data of ``path``. """
+        watch = watchers.DataWatch(self, path, func, window)
+        watch.start()
+        return watch
+
+    def unwatch(self, path, watcher, kind=None):
+        """ Stops calling ``watcher`` for the watches it was registered for on ``path`` by
+        :meth:`get` (``kind='data'``), :meth:`get_children` (``'child'``) or :meth:`exists` (``'exists'``).
+        Returns whether the watcher was found. """
+        kinds = WATCH_KINDS if kind is None else (kind,)
+        return any([self._watches.unsubscribe(path, each_kind, watcher) for each_kind in kinds])
+
+    def watch_stats(self):
+        """ Returns a :class:`pykeeper.watches.WatchStats` with the number of armed server
+        watches and the number of local subscribers sharing them. """
+        return self._watches.stats()
 
     def _wrap_watcher(self, watcher):
         if watcher is None:
@@ -254,10 +1511,21 @@ class ZooKeeper(object):
 
     def _watcher_wrapper(self, func):
         def wrapper(handle, event_type, conn_state, path):
-            event = ClientEvent(event_type, conn_state, path)
-            func(event)
+            event = self._client_event(event_type, conn_state, path)
+            if self.metrics is not None:
+                self.metrics.increment('watch_fired', event.type_name)
+            self.dispatcher.dispatch(path, func, event)
 
+        # used by unwatch to find the wrapper of a watcher
+        wrapper.watcher = func
         return wrapper
 
+    def _client_event(self, event_type, conn_state, path):
+        # a fired watch is passed on to all its subscribers, which can share the same (immutable) event
+        event = self._last_event
+        if event is None or event.path != path or event.type != event_type or event.connection_state != conn_state:
+            event = self._last_event = ClientEvent(event_type, conn_state, path)
+        return event
+
     def __repr__(self):
         return 'ZooKeeperClient(servers={0}, state={1} at {2})'.format(self.servers, self.state_name, hex(id(self)))
\ No newline at end of file
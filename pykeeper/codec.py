@@ -0,0 +1,126 @@
+import json
+import pickle
+import zlib
+
+
+# marks compressed values, chosen so it can't be the start of a json document or a pickle
+COMPRESSED_HEADER = b'PKZ\x01'
+
+
+class RawCodec(object):
+    """ Stores values as they are. """
+
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+
+class JsonCodec(object):
+
+    def __init__(self, **dumps_kwargs):
+        self.dumps_kwargs = dumps_kwargs
+
+    def encode(self, value):
+        return json.dumps(value, **self.dumps_kwargs)
+
+    def decode(self, data):
+        if not data:
+            # nodes created without a value
+            return None
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class PickleCodec(object):
+    """ Only use this for data written by trusted clients, unpickling can run arbitrary code. """
+
+    def __init__(self, protocol=2):
+        self.protocol = protocol
+
+    def encode(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def decode(self, data):
+        if not data:
+            return None
+        return pickle.loads(data)
+
+
+class Compressed(object):
+    """ Compresses the values encoded by ``codec`` with zlib if they are at least ``threshold``
+    bytes long. Compressed values start with :data:`COMPRESSED_HEADER`, so values that were
+    stored without compression can still be decoded.
+
+        >>> codec = Compressed(JsonCodec(), threshold=10)
+        >>> data = codec.encode(['spam'] * 100)
+        >>> data.startswith(COMPRESSED_HEADER), len(data) < 100
+        (True, True)
+        >>> codec.decode(data) == ['spam'] * 100
+        True
+        >>> codec.decode('["eggs"]') == ['eggs']
+        True
+    """
+
+    def __init__(self, codec, level=6, threshold=1024):
+        self.codec = codec
+        self.level = level
+        self.threshold = threshold
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if len(data) < self.threshold:
+            return data
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return COMPRESSED_HEADER + zlib.compress(data, self.level)
+
+    def decode(self, data):
+        if isinstance(data, bytes) and data.startswith(COMPRESSED_HEADER):
+            data = zlib.decompress(data[len(COMPRESSED_HEADER):])
+        return self.codec.decode(data)
+
+
+class Codecs(object):
+    """ Chooses the codec of a path by the longest registered prefix, falling back to ``default``.
+
+        >>> codecs = Codecs()
+        >>> codecs.register('/config', JsonCodec())
+        >>> codecs.encode('/config/db', {'port': 5432})
+        '{"port": 5432}'
+        >>> codecs.decode('/config/db', '{"port": 5432}') == {'port': 5432}
+        True
+        >>> codecs.encode('/configuration', 'raw')
+        'raw'
+    """
+
+    def __init__(self, default=None):
+        self.default = default or RawCodec()
+        self._prefixes = dict()
+
+    def register(self, prefix, codec):
+        """ Uses ``codec`` for ``prefix`` and all the paths below it. """
+        self._prefixes[prefix.rstrip('/') or '/'] = codec
+
+    def unregister(self, prefix):
+        self._prefixes.pop(prefix.rstrip('/') or '/', None)
+
+    def lookup(self, path):
+        if not self._prefixes:
+            return self.default
+
+        while True:
+            codec = self._prefixes.get(path)
+            if codec is not None:
+                return codec
+            if path == '/' or not path:
+                return self.default
+            path = path.rsplit('/', 1)[0] or '/'
+
+    def encode(self, path, value):
+        return self.lookup(path).encode(value)
+
+    def decode(self, path, data):
+        return self.lookup(path).decode(data)
@@ -0,0 +1,134 @@
+""" Compact representations of the values kept in the caches.
+
+zkpython returns every stat as a new dict of 11 keys, and every list of children as new strings.
+Caches with many entries store them as packed :class:`Stat` objects and tuples of interned names instead,
+which take a fraction of the memory and share the strings that occur in more than one entry.
+"""
+import operator
+import struct
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # python 2
+    from collections import Mapping
+
+try:
+    from sys import intern
+except ImportError:
+    # python 2
+    intern = intern
+
+
+# the fields of a stat, with the sizes of the java types the server uses for them
+FIELDS = (
+    ('czxid', 'q'), ('mzxid', 'q'), ('ctime', 'q'), ('mtime', 'q'), ('version', 'i'), ('cversion', 'i'),
+    ('aversion', 'i'), ('ephemeralOwner', 'q'), ('dataLength', 'i'), ('numChildren', 'i'), ('pzxid', 'q'),
+)
+
+NAMES = tuple(name for name, code in FIELDS)
+
+_packing = struct.Struct('<' + ''.join(code for name, code in FIELDS))
+STAT_SIZE = _packing.size
+
+# the struct and offset of each field within the packed stat
+_FIELD_FORMATS = dict()
+_offset = 0
+for _name, _code in FIELDS:
+    _FIELD_FORMATS[_name] = (struct.Struct('<' + _code), _offset)
+    _offset += struct.calcsize('<' + _code)
+
+
+class Stat(Mapping):
+    """ An immutable stat, which can be used like the stat dicts of zkpython. The fields are packed
+    into a single bytes object, instead of a dict and an int object per field.
+
+        >>> stat = Stat.from_dict(dict(czxid=1, mzxid=2, ctime=0, mtime=0, version=1, cversion=0, aversion=0,
+        ...                            ephemeralOwner=0, dataLength=3, numChildren=0, pzxid=1))
+        >>> stat.mzxid, stat['mzxid'], stat.get('missing', 'default')
+        (2, 2, 'default')
+        >>> 'version' in stat, stat == dict(stat), len(stat)
+        (True, True, 11)
+    """
+    __slots__ = ('_packed',)
+
+    def __init__(self, packed):
+        object.__setattr__(self, '_packed', packed)
+
+    @classmethod
+    def from_dict(cls, stat):
+        """ Converts a zkpython stat dict. Anything else, such as ``None``, is returned as it is. """
+        if not isinstance(stat, dict):
+            return stat
+        return cls(_packing.pack(*[stat[name] for name in NAMES]))
+
+    def __getitem__(self, key):
+        field_format, offset = _FIELD_FORMATS[key]
+        return field_format.unpack_from(self._packed, offset)[0]
+
+    def __iter__(self):
+        return iter(NAMES)
+
+    def __len__(self):
+        return len(NAMES)
+
+    def __contains__(self, key):
+        return key in _FIELD_FORMATS
+
+    def to_dict(self):
+        return dict(zip(NAMES, _packing.unpack(self._packed)))
+
+    def __eq__(self, other):
+        if isinstance(other, Stat):
+            return self._packed == other._packed
+        return Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._packed)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('stats are immutable')
+
+    def __reduce__(self):
+        return Stat, (self._packed,)
+
+    def __repr__(self):
+        return 'Stat({0})'.format(', '.join('{0}={1!r}'.format(name, value) for name, value in self.items()))
+
+
+for _name in NAMES:
+    setattr(Stat, _name, property(operator.itemgetter(_name)))
+
+
+def intern_name(name):
+    """ Returns the shared copy of ``name``. Unicode names can't be interned on python 2, and are returned as they are. """
+    try:
+        return intern(name)
+    except TypeError:
+        return name
+
+
+def compact_children(children):
+    """ Returns ``children`` as a tuple of interned names. """
+    if not isinstance(children, list):
+        return children
+    return tuple([intern_name(name) for name in children])
+
+
+def compact_get(retval):
+    """ Returns the ``(data, stat)`` of a get with a compact :class:`Stat`. """
+    if not isinstance(retval, tuple):
+        return retval
+    data, stat = retval
+    return data, Stat.from_dict(stat)
+
+
+# converts the values of each cache type before they are cached
+COMPACTORS = {
+    'exists': Stat.from_dict,
+    'get_children': compact_children,
+    'get': compact_get,
+}
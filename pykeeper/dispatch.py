@@ -0,0 +1,183 @@
+import collections
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# what to do when a dispatcher queue is full:
+BLOCK = 'block'  # wait for room, slowing down the zookeeper completion thread
+DROP_NEWEST = 'drop-newest'  # drop the callback being dispatched
+DROP_OLDEST = 'drop-oldest'  # drop the oldest queued callback to make room
+
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+
+class DispatchStats(collections.namedtuple('DispatchStats', 'queued, max_queued, dispatched, dropped, handler_time, max_handler_time')):
+    """
+    Counters of a dispatcher. ``queued`` is the current queue depth, ``max_queued`` the deepest it has
+    been. ``handler_time`` is the total number of seconds spent in callbacks, ``max_handler_time`` the
+    longest a single callback took.
+    """
+
+    @property
+    def mean_handler_time(self):
+        if not self.dispatched:
+            return 0.0
+        return self.handler_time / self.dispatched
+
+
+class _Counters(object):
+
+    def __init__(self):
+        self.dispatched = 0
+        self.dropped = 0
+        self.max_queued = 0
+        self.handler_time = 0.0
+        self.max_handler_time = 0.0
+
+    def run(self, func, args):
+        started = time.time()
+        try:
+            func(*args)
+        except Exception as e:
+            logger.exception('Exception in dispatched callback {0!r}: {1}'.format(func, e))
+        finally:
+            elapsed = time.time() - started
+            self.dispatched += 1
+            self.handler_time += elapsed
+            if elapsed > self.max_handler_time:
+                self.max_handler_time = elapsed
+
+
+class InlineDispatcher(object):
+    """ Runs the callbacks right away, on the thread dispatching them. """
+
+    def __init__(self):
+        self._counters = _Counters()
+
+    def dispatch(self, key, func, *args):
+        self._counters.run(func, args)
+
+    def stats(self):
+        counters = self._counters
+        return DispatchStats(0, 0, counters.dispatched, 0, counters.handler_time, counters.max_handler_time)
+
+    def stop(self, timeout=None):
+        pass
+
+
+class _Worker(object):
+    """ A thread running queued callbacks in order. """
+
+    def __init__(self, name, max_queue, policy):
+        assert policy in POLICIES, 'unknown policy: {0!r}'.format(policy)
+        self.max_queue = max_queue
+        self.policy = policy
+        self.counters = _Counters()
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._running = True
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, func, args):
+        with self._condition:
+            if self.max_queue is not None and len(self._queue) >= self.max_queue:
+                if self.policy == DROP_NEWEST:
+                    self.counters.dropped += 1
+                    return
+                elif self.policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.counters.dropped += 1
+                else:
+                    while self._running and len(self._queue) >= self.max_queue:
+                        self._condition.wait()
+
+            self._queue.append((func, args))
+            if len(self._queue) > self.counters.max_queued:
+                self.counters.max_queued = len(self._queue)
+            self._condition.notify_all()
+
+    def depth(self):
+        return len(self._queue)
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                func, args = self._queue.popleft()
+                # wake up producers waiting for room
+                self._condition.notify_all()
+
+            self.counters.run(func, args)
+
+
+class ThreadDispatcher(object):
+    """ Runs the callbacks on a dedicated thread, in the order they were dispatched.
+
+    At most ``max_queue`` callbacks are queued (``None`` means unbounded), ``policy``
+    decides what happens when the queue is full.
+    """
+
+    def __init__(self, max_queue=10000, policy=BLOCK):
+        self._worker = _Worker('pykeeper-dispatcher', max_queue, policy)
+
+    def dispatch(self, key, func, *args):
+        self._worker.put(func, args)
+
+    def stats(self):
+        counters = self._worker.counters
+        return DispatchStats(self._worker.depth(), counters.max_queued, counters.dispatched, counters.dropped,
+                             counters.handler_time, counters.max_handler_time)
+
+    def stop(self, timeout=None):
+        """ Stops the thread after the queued callbacks have run. """
+        self._worker.stop(timeout)
+
+
+class PoolDispatcher(object):
+    """ Runs the callbacks on a pool of ``workers`` threads. Callbacks dispatched with the same
+    key always run on the same thread, so they run in order. The key of a watcher is the path of
+    the event, every subscriber of ``on_event`` and ``on_state`` of the client has its own key.
+
+    Every thread queues at most ``max_queue`` callbacks, ``policy`` decides what happens
+    when a queue is full.
+    """
+
+    def __init__(self, workers=4, max_queue=10000, policy=BLOCK):
+        self._workers = [_Worker('pykeeper-dispatcher-{0}'.format(i), max_queue, policy) for i in range(workers)]
+
+    def dispatch(self, key, func, *args):
+        self._workers[hash(key) % len(self._workers)].put(func, args)
+
+    def stats(self):
+        all_counters = [worker.counters for worker in self._workers]
+        return DispatchStats(
+            sum(worker.depth() for worker in self._workers),
+            max(counters.max_queued for counters in all_counters),
+            sum(counters.dispatched for counters in all_counters),
+            sum(counters.dropped for counters in all_counters),
+            sum(counters.handler_time for counters in all_counters),
+            max(counters.max_handler_time for counters in all_counters),
+        )
+
+    def stop(self, timeout=None):
+        """ Stops the threads after the queued callbacks have run. """
+        for worker in self._workers:
+            worker.stop(timeout)
@@ -38,5 +38,8 @@ class Event(object):
         for callback in callbacks:
             callback(*args, **kwargs)
 
+    def __iter__(self):
+        return iter(self._callbacks[:])
+
     def __len__(self):
         return len(self._callbacks)
\ No newline at end of file
@@ -1,83 +1,238 @@
+import collections
 import os
 import logging
+import re
+import select
 import threading
+import time
 import zookeeper
 import sys
 
 
 logger = logging.getLogger('zookeeper')
 
+LEVELS = dict(
+    ZOO_INFO = logging.INFO,
+    ZOO_WARN = logging.WARNING,
+    ZOO_ERROR = logging.ERROR,
+    ZOO_DEBUG = logging.DEBUG,
+)
+
+
+class Rule(collections.namedtuple('Rule', 'pattern, level, new_level')):
+    """ Relays the messages matching the regular expression ``pattern`` that the C client
+    logs at ``level`` at ``new_level`` instead. """
+
+
+DEFAULT_RULES = (
+    # this line is definitely misclassified in the C client....
+    Rule('Exceeded deadline by', logging.WARNING, logging.DEBUG),
+    # reclassify failed server connection attemps as INFO instead of ERROR:
+    Rule('server refused to accept the client', logging.ERROR, logging.INFO),
+)
+
+
+class RelayStats(collections.namedtuple('RelayStats', 'lines, logged, repeated, dropped')):
+    """ ``lines`` read from the C client, of which ``logged`` were logged, ``repeated`` were
+    collapsed into summaries and ``dropped`` exceeded the rate limit. """
+
+
+# the C client logs "<timestamp>:<pid>(<thread>):ZOO_<LEVEL>@<function>@<line>: <message>"
+_LINE = re.compile(r'^(?:[^@]*:)?([^@:]*)@(.*)$')
+# messages are considered repeated if they only differ in numbers, such as durations or ports
+_NUMBERS = re.compile(r'\d+')
+
+_CHUNK_SIZE = 64 * 1024
+
 _installed = False
+_relay = None
 _relay_thread = None
-_logging_pipe = None
 
 
-def _relay_log():
-    global _installed, _logging_pipe
-    r, w = _logging_pipe
-    f = os.fdopen(r)
+class _Relay(object):
+    """ Relays the lines of the C client log to the ``zookeeper`` logger.
+
+    Runs of messages that only differ in numbers are collapsed: the first one is logged, the
+    rest are summarized as "(repeated N times)" at least every ``repeat_interval`` seconds. At
+    most ``max_rate`` messages per second are logged, the rest are counted and dropped.
+    """
+
+    def __init__(self, fd, rules=DEFAULT_RULES, max_rate=100, repeat_interval=5.0):
+        self.fd = fd
+        self.rules = [(re.compile(rule.pattern), rule.level, rule.new_level) for rule in rules]
+        self.max_rate = max_rate
+        self.repeat_interval = repeat_interval
 
-    levels = dict(
-        ZOO_INFO = logging.INFO,
-        ZOO_WARN = logging.WARNING,
-        ZOO_ERROR = logging.ERROR,
-        ZOO_DEBUG = logging.DEBUG,
-    )
+        self.lines = 0
+        self.logged = 0
+        self.repeated = 0
+        self.dropped = 0
 
-    while _installed:
+        self._wakeup = os.pipe()
+        self._running = True
+
+        self._last_key = None
+        self._last = None
+        self._repeats = 0
+        self._repeats_since = 0
+
+        self._tokens = max_rate
+        self._tokens_at = time.time()
+        self._unreported_drops = 0
+
+    def run(self):
+        buffered = ''
         try:
-            line = f.readline().strip()
-            if '@' in line:
-                level, message = line.split('@', 1)
-                level = levels.get(level.split(':')[-1])
-
-                # this line is definitely misclassified in the C client....
-                if 'Exceeded deadline by' in line and level == logging.WARNING:
-                    level = logging.DEBUG
-
-                # reclassify failed server connection attemps as INFO instead of ERROR:
-                if 'server refused to accept the client' in line and level == logging.ERROR:
-                    level = logging.INFO
-
-            else:
-                level = None
-                message = '...' # TODO: can we genereate a better logging message
-
-            if level is None:
-                logger.log(logging.INFO, line)
-            else:
-                logger.log(level, message)
+            while self._running:
+                timeout = None
+                if self._repeats:
+                    timeout = max(0, self._repeats_since + self.repeat_interval - time.time())
+
+                readable = select.select([self.fd, self._wakeup[0]], [], [], timeout)[0]
+                if self._wakeup[0] in readable:
+                    break
+
+                if self.fd in readable:
+                    chunk = os.read(self.fd, _CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not isinstance(chunk, str):
+                        chunk = chunk.decode('utf-8', 'replace')
+
+                    lines = (buffered + chunk).split('\n')
+                    buffered = lines.pop()
+                    now = time.time()
+                    for line in lines:
+                        self.handle(line, now)
+
+                self.flush(time.time())
+        finally:
+            self.flush(None)
+
+    def stop(self):
+        self._running = False
+        os.write(self._wakeup[1], b'x')
+
+    def close(self):
+        """ Closes the pipes, which must only be done after :meth:`run` has returned. """
+        for fd in (self.fd, ) + tuple(self._wakeup):
+            os.close(fd)
+
+    def parse(self, line):
+        """ Returns the ``(level, message)`` of a log line. """
+        match = _LINE.match(line)
+        if match is None:
+            return logging.INFO, line
+
+        level = LEVELS.get(match.group(1))
+        if level is None:
+            return logging.INFO, line
+
+        message = match.group(2)
+        for pattern, rule_level, new_level in self.rules:
+            if level == rule_level and pattern.search(message):
+                return new_level, message
+        return level, message
+
+    def handle(self, line, now):
+        line = line.strip()
+        if not line:
+            return
+        self.lines += 1
+
+        try:
+            level, message = self.parse(line)
+            key = (level, _NUMBERS.sub('#', message))
+            if key == self._last_key:
+                self.repeated += 1
+                self._repeats += 1
+                self._last = (level, message)
+                return
+
+            self.flush(None)
+            self._last_key = key
+            self._last = (level, message)
+            self._repeats_since = now
+            self.log(level, message, now)
         except Exception as v:
             logger.exception('Exception occurred while relaying zookeeper log: {0}'.format(v))
 
+    def flush(self, now):
+        """ Logs the summary of the current run of repeated messages, if ``repeat_interval`` has passed
+        since the last summary. If ``now`` is ``None``, it is logged right away. """
+        if not self._repeats:
+            return
+        if now is not None and now - self._repeats_since < self.repeat_interval:
+            return
+
+        level, message = self._last
+        self.log(level, '{0} (repeated {1} times)'.format(message, self._repeats), now or time.time())
+        self._repeats = 0
+        self._repeats_since = now or time.time()
+
+    def log(self, level, message, now):
+        if self.max_rate is not None:
+            self._tokens = min(self.max_rate, self._tokens + (now - self._tokens_at) * self.max_rate)
+            self._tokens_at = now
+            if self._tokens < 1:
+                self.dropped += 1
+                self._unreported_drops += 1
+                return
+            self._tokens -= 1
+
+            if self._unreported_drops:
+                logger.warning('Dropped {0} zookeeper log messages because of the rate limit.'.format(self._unreported_drops))
+                self._unreported_drops = 0
+
+        self.logged += 1
+        if logger.isEnabledFor(level):
+            logger.log(level, message)
+
+    def stats(self):
+        return RelayStats(self.lines, self.logged, self.repeated, self.dropped)
+
 
 def is_installed():
     return _installed
 
-def install():
-    global _installed, _relay_thread, _logging_pipe
+def stats():
+    """ Returns the :class:`RelayStats` of the installed relay, or ``None``. """
+    if _relay is None:
+        return None
+    return _relay.stats()
+
+def install(rules=DEFAULT_RULES, max_rate=100, repeat_interval=5.0):
+    """ Relays the log of the C client to the ``zookeeper`` logger, see :class:`_Relay` for
+    the meaning of the arguments. """
+    global _installed, _relay, _relay_thread
 
     if is_installed():
         return
 
-    _logging_pipe = os.pipe()
+    r, w = os.pipe()
+    _relay = _Relay(r, rules, max_rate, repeat_interval)
 
-    zookeeper.set_log_stream(os.fdopen(_logging_pipe[1], 'w'))
+    zookeeper.set_log_stream(os.fdopen(w, 'w'))
 
-    _relay_thread = threading.Thread(target=_relay_log)
+    _relay_thread = threading.Thread(target=_relay.run, name='pykeeper-log-relay')
     _relay_thread.setDaemon(True) # die along with the interpreter
-    _relay_thread.start()
-
     _installed = True
+    _relay_thread.start()
 
-def uninstall():
+def uninstall(timeout=5):
     if not is_installed():
         return
 
-    global _installed, _relay_thread
+    global _installed, _relay, _relay_thread
 
     _installed = False
     zookeeper.set_log_stream(sys.stderr)
-    # TODO: make sure the thread is actually stopped
 
-    _relay_thread.join()
\ No newline at end of file
+    # the relay is woken up, so it doesn't wait for the C client to log something
+    _relay.stop()
+    _relay_thread.join(timeout)
+    if not _relay_thread.is_alive():
+        _relay.close()
+
+    _relay = None
+    _relay_thread = None
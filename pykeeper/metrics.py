@@ -0,0 +1,149 @@
+import bisect
+import collections
+import threading
+
+
+# upper bounds in seconds of the latency histogram buckets, from 100us to 10s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class HistogramSnapshot(collections.namedtuple('HistogramSnapshot', 'buckets, counts, count, sum, max')):
+    """ ``counts[i]`` is the number of observations of at most ``buckets[i]`` seconds that weren't counted
+    in a smaller bucket, the last count is of the observations larger than all the buckets. """
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def quantile(self, q):
+        """ Returns the upper bound of the bucket containing the ``q`` quantile (``max`` for the last bucket). """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class MetricsSnapshot(collections.namedtuple('MetricsSnapshot', 'latencies, counters, caches')):
+    """
+    ``latencies`` maps ``(operation, outcome)`` to a :class:`HistogramSnapshot`, where the outcome is
+    ``'ok'`` or the name of the exception. ``counters`` maps ``(name, label)`` to a count, ``caches``
+    the cache types to their :class:`pykeeper.cache.CacheStats`.
+    """
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Metrics(object):
+    """ Latency histograms and counters of a :class:`pykeeper.client.ZooKeeper`.
+
+    ``exporter`` is called with a :class:`MetricsSnapshot` by :meth:`pykeeper.client.ZooKeeper.export_metrics`,
+    :func:`to_prometheus` can be used to render it.
+
+        >>> metrics = Metrics()
+        >>> metrics.observe('get', 'ok', 0.003)
+        >>> metrics.increment('watch_fired', 'changed')
+        >>> snapshot = metrics.snapshot()
+        >>> snapshot.latencies[('get', 'ok')].count
+        1
+        >>> snapshot.counters
+        {('watch_fired', 'changed'): 1}
+    """
+
+    def __init__(self, exporter=None, buckets=DEFAULT_BUCKETS):
+        self.exporter = exporter
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._histograms = dict()
+        self._counters = collections.defaultdict(int)
+
+    def observe(self, operation, outcome, seconds):
+        key = (operation, outcome)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+            if seconds > histogram.max:
+                histogram.max = seconds
+
+    def increment(self, name, label='', amount=1):
+        with self._lock:
+            self._counters[(name, label)] += amount
+
+    def snapshot(self, caches=None):
+        with self._lock:
+            latencies = dict((key, HistogramSnapshot(self.buckets, tuple(histogram.counts), histogram.count, histogram.sum, histogram.max))
+                             for key, histogram in self._histograms.items())
+            counters = dict(self._counters)
+        return MetricsSnapshot(latencies, counters, dict(caches or ()))
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def outcome(result):
+    """ Returns the outcome label of a result, which is the name of the exception class for failures. """
+    if isinstance(result, Exception):
+        return type(result).__name__
+    return 'ok'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(snapshot, prefix='pykeeper'):
+    """ Renders a :class:`MetricsSnapshot` in the Prometheus text exposition format. """
+    lines = list()
+
+    name = prefix + '_operation_seconds'
+    lines.append('# TYPE {0} histogram'.format(name))
+    for (operation, result), histogram in sorted(snapshot.latencies.items()):
+        labels = 'operation="{0}",outcome="{1}"'.format(_escape(operation), _escape(result))
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, cumulative))
+        lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labels, histogram.count))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, histogram.sum))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+
+    counter_names = sorted(set(counter for counter, label in snapshot.counters))
+    for counter in counter_names:
+        name = '{0}_{1}_total'.format(prefix, counter)
+        lines.append('# TYPE {0} counter'.format(name))
+        for (other, label), count in sorted(snapshot.counters.items()):
+            if other == counter:
+                lines.append('{0}{{label="{1}"}} {2}'.format(name, _escape(label), count))
+
+    for field in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'invalidations'):
+        if field in ('entries', 'bytes'):
+            name = '{0}_cache_{1}'.format(prefix, field)
+            lines.append('# TYPE {0} gauge'.format(name))
+        else:
+            name = '{0}_cache_{1}_total'.format(prefix, field)
+            lines.append('# TYPE {0} counter'.format(name))
+        for cache_name, stats in sorted(snapshot.caches.items()):
+            lines.append('{0}{{cache="{1}"}} {2}'.format(name, _escape(cache_name), getattr(stats, field)))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,257 @@
+import collections
+import itertools
+import logging
+import threading
+
+from pykeeper.cache import CacheStats
+from pykeeper.client import ZooKeeper
+
+
+logger = logging.getLogger(__name__)
+
+
+# how reads are spread over the sessions of a pool:
+LEAST_OUTSTANDING = 'least-outstanding'  # the session with the fewest requests in flight
+PATH_HASH = 'path-hash'  # always the same session for the same path
+
+ROUTINGS = (LEAST_OUTSTANDING, PATH_HASH)
+
+
+class SessionStats(collections.namedtuple('SessionStats', 'servers, state, outstanding, requests')):
+    """ The load of one session of a :class:`ZooKeeperPool`. ``outstanding`` is the number of
+    requests in flight, ``requests`` the total number of requests routed to the session. """
+
+
+def split_servers(servers):
+    """ Splits a connection string into one connection string per server, keeping the chroot.
+
+        >>> split_servers('zk1:2181,zk2:2181/app')
+        ['zk1:2181/app', 'zk2:2181/app']
+    """
+    hosts, slash, chroot = servers.partition('/')
+    return [host + slash + chroot for host in hosts.split(',') if host]
+
+
+class _Session(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def begin(self, count=1):
+        with self._lock:
+            self.outstanding += count
+            self.requests += count
+
+    def end(self, count=1):
+        with self._lock:
+            self.outstanding -= count
+
+    def call(self, name, *args, **kwargs):
+        self.begin()
+        try:
+            return getattr(self.client, name)(*args, **kwargs)
+        finally:
+            self.end()
+
+    def call_many(self, name, paths, *args, **kwargs):
+        self.begin(len(paths))
+        try:
+            return getattr(self.client, name)(paths, *args, **kwargs)
+        finally:
+            self.end(len(paths))
+
+    def call_async(self, name, path, callback, watcher=None):
+        self.begin()
+
+        def completed(result):
+            self.end()
+            callback(result)
+
+        try:
+            getattr(self.client, name)(path, completed, watcher=watcher)
+        except Exception:
+            self.end()
+            raise
+
+    def stats(self):
+        return SessionStats(self.client.servers, self.client.state_name, self.outstanding, self.requests)
+
+
+class ZooKeeperPool(object):
+    """ Spreads reads over ``size`` sessions, each with its own connection and I/O thread.
+
+    The first session is the primary, which handles all writes, and all reads that set a
+    watch, so that watches and ephemeral nodes all belong to a single session. Reads without a
+    watch are routed according to ``routing``, cached reads always by path, so every path is
+    cached (and watched) by a single session. Sessions that aren't connected are skipped.
+
+    With ``pin_servers``, the secondary sessions are each connected to a single server of
+    ``servers``, in turn, instead of letting zookeeper pick one. The rest of ``kwargs`` is
+    passed on to every :class:`pykeeper.client.ZooKeeper`. Every session needs its own offline
+    queue and caches, so instead of ``offline_queue`` and ``caches``, pass ``offline_queue_factory``
+    and ``caches_factory``, which are called once per session.
+
+    Methods that aren't routed are those of the primary, such as ``create``, ``set`` or ``on_state``.
+    Note that reads on a secondary session may not see the latest writes of the primary yet,
+    like any two zookeeper sessions.
+    """
+
+    def __init__(self, servers, size=4, routing=LEAST_OUTSTANDING, pin_servers=False, offline_queue_factory=None,
+                 caches_factory=None, **kwargs):
+        assert size >= 1, 'a pool needs at least one session'
+        assert routing in ROUTINGS, 'unknown routing: {0!r}'.format(routing)
+        # a session that disconnects would hold up the requests of the others on a shared queue
+        assert 'offline_queue' not in kwargs, 'sessions cannot share an offline queue, pass offline_queue_factory'
+        assert 'caches' not in kwargs, 'sessions cannot share caches, pass caches_factory'
+        self.servers = servers
+        self.routing = routing
+
+        secondary_servers = [servers] * (size - 1)
+        if pin_servers:
+            pinned = split_servers(servers)
+            secondary_servers = [pinned[i % len(pinned)] for i in range(size - 1)]
+
+        def session(session_servers):
+            session_kwargs = dict(kwargs)
+            if offline_queue_factory is not None:
+                session_kwargs['offline_queue'] = offline_queue_factory()
+            if caches_factory is not None:
+                session_kwargs['caches'] = caches_factory()
+            return _Session(ZooKeeper(session_servers, **session_kwargs))
+
+        self._sessions = [session(servers)]
+        self._sessions.extend(session(session_servers) for session_servers in secondary_servers)
+        self._primary = self._sessions[0]
+        self.primary = self._primary.client
+        self._turns = itertools.count()
+
+    def connect(self):
+        for session in self._sessions:
+            session.client.connect()
+
+    def close(self):
+        for session in self._sessions:
+            session.client.close()
+
+    def wait_until_connected(self, timeout=None):
+        """ Waits until the primary is connected. The other sessions are used as they connect. """
+        self.primary.wait_until_connected(timeout)
+
+    def session_stats(self):
+        """ Returns a :class:`SessionStats` per session, the primary first. """
+        return [session.stats() for session in self._sessions]
+
+    def cache_stats(self):
+        """ Returns a dict of :class:`pykeeper.cache.CacheStats` per cache type, summed over the sessions. """
+        totals = dict()
+        for session in self._sessions:
+            for name, stats in session.client.cache_stats().items():
+                if name in totals:
+                    stats = CacheStats(*[total + value for total, value in zip(totals[name], stats)])
+                totals[name] = stats
+        return totals
+
+    def exists(self, path, watcher=None):
+        return self._read(path, watcher).call('exists', path, watcher)
+
+    def get_children(self, path, watcher=None):
+        return self._read(path, watcher).call('get_children', path, watcher)
+
+    def get(self, path, watcher=None):
+        return self._read(path, watcher).call('get', path, watcher)
+
+    def aexists(self, path, callback, watcher=None):
+        self._read_async('aexists', path, callback, watcher)
+
+    def aget_children(self, path, callback, watcher=None):
+        self._read_async('aget_children', path, callback, watcher)
+
+    def aget(self, path, callback, watcher=None):
+        self._read_async('aget', path, callback, watcher)
+
+    def exists_many(self, paths, watcher=None, window=None):
+        return self._read_many('exists_many', paths, watcher, window)
+
+    def get_children_many(self, paths, watcher=None, window=None):
+        return self._read_many('get_children_many', paths, watcher, window)
+
+    def get_many(self, paths, watcher=None, window=None):
+        return self._read_many('get_many', paths, watcher, window)
+
+    def cached_exists(self, path):
+        return self._by_path(path).call('cached_exists', path)
+
+    def cached_get_children(self, path):
+        return self._by_path(path).call('cached_get_children', path)
+
+    def cached_get(self, path):
+        return self._by_path(path).call('cached_get', path)
+
+    def cached_exists_many(self, paths, window=None):
+        return self._cached_many('cached_exists_many', paths, window)
+
+    def cached_get_children_many(self, paths, window=None):
+        return self._cached_many('cached_get_children_many', paths, window)
+
+    def cached_get_many(self, paths, window=None):
+        return self._cached_many('cached_get_many', paths, window)
+
+    def is_ephemeral(self, path, cache=False):
+        if cache:
+            return self._by_path(path).call('is_ephemeral', path, cache)
+        return self._read(path, None).call('is_ephemeral', path)
+
+    def _connected(self):
+        return [session for session in self._sessions if session.client.state_name == 'connected'] or [self._primary]
+
+    def _by_path(self, path):
+        # every session must be considered, so a path doesn't move between sessions (and caches) while they connect
+        session = self._sessions[hash(path) % len(self._sessions)]
+        if session.client.state_name != 'connected':
+            return self._primary
+        return session
+
+    def _read(self, path, watcher):
+        if watcher is not None:
+            return self._primary
+        if self.routing == PATH_HASH:
+            return self._by_path(path)
+        # start at the next session every time, so idle sessions take turns instead of the first one getting everything
+        sessions = self._connected()
+        start = next(self._turns) % len(sessions)
+        return min(sessions[start:] + sessions[:start], key=lambda session: session.outstanding)
+
+    def _read_async(self, name, path, callback, watcher):
+        self._read(path, watcher).call_async(name, path, callback, watcher)
+
+    def _read_many(self, name, paths, watcher, window):
+        paths = list(paths)
+        if watcher is not None:
+            return self._primary.call_many(name, paths, watcher, window)
+        # one session per batch, so the requests are pipelined on a single connection
+        return self._read(paths[0] if paths else '', None).call_many(name, paths, None, window)
+
+    def _cached_many(self, name, paths, window):
+        paths = list(paths)
+        batches = collections.OrderedDict()
+        for index, path in enumerate(paths):
+            batches.setdefault(self._by_path(path), list()).append(index)
+
+        retvals = [None] * len(paths)
+        for session, indexes in batches.items():
+            results = session.call_many(name, [paths[index] for index in indexes], window)
+            for index, result in zip(indexes, results):
+                retvals[index] = result
+        return retvals
+
+    def __getattr__(self, name):
+        # everything else is handled by the primary
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def __repr__(self):
+        return 'ZooKeeperPool(servers={0}, size={1} at {2})'.format(self.servers, len(self._sessions), hex(id(self)))
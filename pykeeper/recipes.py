@@ -0,0 +1,433 @@
+import collections
+import logging
+import random
+import threading
+import time
+import uuid
+
+import zookeeper
+
+from pykeeper import event
+from pykeeper.metrics import outcome
+from pykeeper.retry import RETRYABLE_ERRORS
+
+
+logger = logging.getLogger(__name__)
+
+# the number of items at the head of a queue that consumers spread their takes over
+DEFAULT_SPREAD = 16
+
+
+def _sequence(name):
+    # the server appends a 10 digit sequence number to the names of sequential nodes
+    return name[-10:]
+
+
+class Lock(object):
+    """ A distributed lock on ``path``.
+
+    Every contender creates an ephemeral sequential node below ``path``, and the contender with the
+    lowest sequence number holds the lock. The others only watch the node right before their own
+    with ``exists``, so releasing the lock wakes up a single contender instead of all of them.
+
+    If the session expires, the node of the contender is lost. A contender that is waiting creates
+    a new node once the client has reconnected. If the lock was held, :attr:`acquired` becomes false
+    and ``on_lost`` is called with the lock.
+
+        >>> lock = client.lock('/locks/resource') # doctest: +SKIP
+        >>> with lock: # doctest: +SKIP
+        ...     pass
+    """
+    kind = 'lock'
+
+    def __init__(self, client, path, identifier=''):
+        self.client = client
+        self.path = path.rstrip('/')
+        self.identifier = identifier
+
+        self.acquired = False
+        # the path of our node, while we're contending for the lock
+        self.node = None
+        # the number of contenders before us when we last looked
+        self.position = None
+        # how long the last successful acquire waited
+        self.acquire_latency = None
+        self.on_lost = event.Event()
+
+        # part of the name of our node, so we can find it if the create was interrupted
+        self._prefix = '{0}-{1}-'.format(self.kind, uuid.uuid4().hex)
+        self._wakeup = threading.Event()
+        self._cancelled = False
+
+    def acquire(self, blocking=True, timeout=None):
+        """ Acquires the lock, returning whether it was. Waits at most ``timeout`` seconds if given,
+        or not at all if ``blocking`` is false. """
+        if self.acquired:
+            raise RuntimeError('{0!r} is already acquired'.format(self))
+
+        started = time.time()
+        deadline = None if timeout is None else started + timeout
+        self._cancelled = False
+        if self._on_state not in self.client.on_state:
+            self.client.on_state += self._on_state
+        try:
+            self.acquired = self._acquire(blocking, deadline)
+        except Exception as e:
+            self._observe(outcome(e), started)
+            self.release()
+            raise
+
+        if not self.acquired:
+            self._observe('timeout', started)
+            self.release()
+            return False
+
+        self.acquire_latency = time.time() - started
+        self._observe('ok', started)
+        return True
+
+    def release(self):
+        """ Releases the lock, or gives up waiting for it. """
+        self.acquired = False
+        if self._on_state in self.client.on_state:
+            self.client.on_state -= self._on_state
+
+        node, self.node = self.node, None
+        self.position = None
+        if node is not None:
+            try:
+                self.client.delete(node)
+            except zookeeper.NoNodeException:
+                pass
+
+    def cancel(self):
+        """ Makes a blocked :meth:`acquire` give up, returning false. """
+        self._cancelled = True
+        self._wakeup.set()
+
+    def contenders(self):
+        """ Returns the identifiers of the contenders, the holder of the lock first. """
+        nodes = self._contenders()
+        results = self.client.get_many(['/'.join((self.path, name)) for name in nodes])
+        contenders = list()
+        for result in results:
+            if isinstance(result, zookeeper.NoNodeException):
+                # contenders that have left in the meantime are left out
+                continue
+            if isinstance(result, Exception):
+                raise result
+            contenders.append(result[0])
+        return contenders
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _acquire(self, blocking, deadline):
+        while True:
+            self._wakeup.clear()
+            if self._cancelled:
+                return False
+
+            try:
+                if self.node is None:
+                    self.node = self._create()
+
+                name = self.node.rsplit('/', 1)[1]
+                nodes = self._contenders()
+                if name not in nodes:
+                    # the session expired, taking our node with it
+                    self.node = None
+                    continue
+
+                index = nodes.index(name)
+                self.position = index
+                blocking_nodes = [node for node in nodes[:index] if self._blocks(node)]
+                if not blocking_nodes:
+                    return True
+                if not blocking:
+                    return False
+
+                predecessor = '/'.join((self.path, blocking_nodes[-1]))
+                if not self.client.exists(predecessor, self._predecessor_watcher):
+                    # it's already gone
+                    self.client.unwatch(predecessor, self._predecessor_watcher, 'exists')
+                    continue
+
+                if not self._wakeup.wait(self._remaining(deadline)):
+                    self.client.unwatch(predecessor, self._predecessor_watcher, 'exists')
+                    return False
+
+            except RETRYABLE_ERRORS as e:
+                logger.debug('{0!r}: Retrying after {1!r}.'.format(self, e))
+                try:
+                    self.client.wait_until_connected(self._remaining(deadline))
+                except Exception:
+                    return False
+
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    def _create(self):
+        while True:
+            try:
+                # the node isn't restored by the client when the session expires, we create a new one instead
+                return self.client.create('/'.join((self.path, self._prefix)), self.identifier,
+                                          flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE, restore=False)
+            except zookeeper.NoNodeException:
+                self.client.create_recursive(self.path, '')
+            except zookeeper.ConnectionLossException:
+                # the node may have been created without us being told
+                self.client.wait_until_connected()
+                for name in self.client.get_children(self.path):
+                    if name.startswith(self._prefix):
+                        return '/'.join((self.path, name))
+
+    def _contenders(self):
+        """ Returns the names of the nodes of the contenders of the lock, in order. """
+        return sorted(self.client.get_children(self.path), key=_sequence)
+
+    def _blocks(self, name):
+        """ Whether the node ``name`` before ours keeps us from acquiring the lock. """
+        return True
+
+    def _predecessor_watcher(self, event):
+        self._wakeup.set()
+
+    def _on_state(self, client, state):
+        if state != 'expired':
+            return
+        # the node is gone along with the session
+        self._wakeup.set()
+        if self.acquired:
+            logger.warning('{0!r}: Lost the lock because the session expired.'.format(self))
+            self.acquired = False
+            self.node = None
+            self.on_lost(self)
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0)
+
+    def _observe(self, result, started):
+        if self.client.metrics is not None:
+            self.client.metrics.observe('{0}_acquire'.format(self.kind), result, time.time() - started)
+
+    def __repr__(self):
+        return '{0}(path={1!r}, acquired={2})'.format(self.__class__.__name__, self.path, self.acquired)
+
+
+class ReadLock(Lock):
+    """ The shared side of a :class:`ReadWriteLock`, which only waits for the writers before it. """
+    kind = 'read'
+
+    def _blocks(self, name):
+        return not name.startswith(self.kind)
+
+
+class WriteLock(Lock):
+    """ The exclusive side of a :class:`ReadWriteLock`. """
+    kind = 'write'
+
+
+class ReadWriteLock(object):
+    """ A distributed lock on ``path`` that may be held by any number of readers, or a single writer.
+    Contenders are served in order, so a waiting writer keeps readers that come after it waiting. """
+
+    def __init__(self, client, path, identifier=''):
+        self.read_lock = ReadLock(client, path, identifier)
+        self.write_lock = WriteLock(client, path, identifier)
+
+
+class _Candidate(Lock):
+    kind = 'candidate'
+
+
+class LeaderElection(object):
+    """ Elects a leader among the contenders on ``path``, in the order they volunteered.
+
+    The election is a :class:`Lock`, so only the next candidate in line is told when the leader leaves.
+    """
+
+    def __init__(self, client, path, identifier=''):
+        self.lock = _Candidate(client, path, identifier)
+
+    @property
+    def is_leader(self):
+        return self.lock.acquired
+
+    @property
+    def on_lost(self):
+        """ Called with the lock if the leadership is lost because the session expired. """
+        return self.lock.on_lost
+
+    def run(self, func, *args, **kwargs):
+        """ Waits until elected, and then calls ``func``, giving up the leadership when it returns.
+        Returns what ``func`` returned, or ``None`` if the election was cancelled. """
+        if not self.lock.acquire():
+            return None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        """ Stops waiting to be elected. """
+        self.lock.cancel()
+
+    def contenders(self):
+        """ Returns the identifiers of the candidates, the leader first. """
+        return self.lock.contenders()
+
+
+class QueueStats(collections.namedtuple('QueueStats', 'depth, put, taken, conflicts')):
+    """
+    Returned by :meth:`Queue.stats`. ``depth`` is the number of items in the queue when it was last
+    listed, ``conflicts`` counts the items another consumer took before us.
+    """
+
+
+class Queue(object):
+    """ A distributed queue of the sequential nodes below ``path``.
+
+    Items are taken in order of priority, lower first, and then in the order they were put. To keep
+    consumers from all racing for the same item, every take starts at a random offset within the
+    first ``spread`` items, so the order is only approximate for items that are close together.
+
+    An item is claimed by fetching and deleting it in one pipelined round trip. ZooKeeper handles the
+    requests of a session in order, so the item is ours if the delete succeeds. Consumers waiting for
+    items share a single child watch of the client instead of polling.
+    """
+
+    def __init__(self, client, path, spread=DEFAULT_SPREAD):
+        self.client = client
+        self.path = path.rstrip('/')
+        self.spread = spread
+
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._depth = None
+        self._put = self._taken = self._conflicts = 0
+
+    def put(self, value, priority=0):
+        """ Adds ``value`` to the queue. Priorities range from 0 (the first to be taken) to 999. """
+        self.put_many([value], priority)
+
+    def put_many(self, values, priority=0, window=None):
+        """ Adds all of ``values`` to the queue, in order, with the creates pipelined. """
+        name = self._item_name(priority)
+        for attempt in range(2):
+            pipeline = self.client._pipeline(window)
+            for value in values:
+                pipeline.submit(*self.client._create_request(name, value, flags=zookeeper.SEQUENCE))
+            results = pipeline.wait()
+
+            if attempt == 0 and results and isinstance(results[0], zookeeper.NoNodeException):
+                # nothing has been created, as the parent is missing
+                self.client.create_recursive(self.path, '')
+                continue
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            with self._lock:
+                self._put += len(values)
+            return
+
+    def take(self, n=1, block=True, timeout=None):
+        """ Removes and returns up to ``n`` items from the queue. If the queue is empty, waits at
+        most ``timeout`` seconds for items if given, or not at all if ``block`` is false. """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._wakeup.clear()
+            children = self._children()
+            if children:
+                items = self._claim(children, n)
+                if items:
+                    return items
+                # others took them all, look again
+                continue
+
+            if not block:
+                return []
+            # only watch once the queue looks empty, the watch is shared by all the consumers of the client
+            if self._children(self._children_watcher):
+                self.client.unwatch(self.path, self._children_watcher, 'child')
+                continue
+            if not self._wakeup.wait(self._remaining(deadline)):
+                self.client.unwatch(self.path, self._children_watcher, 'child')
+                return []
+
+    def depth(self):
+        """ Returns the number of items in the queue. """
+        return len(self._children())
+
+    def stats(self):
+        """ Returns the :class:`QueueStats` of this consumer and producer. """
+        with self._lock:
+            return QueueStats(self._depth, self._put, self._taken, self._conflicts)
+
+    def _children(self, watcher=None):
+        try:
+            children = sorted(self.client.get_children(self.path, watcher))
+        except zookeeper.NoNodeException:
+            if watcher is None:
+                children = []
+            else:
+                # a child watch can only be set on a node that exists
+                self.client.create_recursive(self.path, '')
+                return self._children(watcher)
+        with self._lock:
+            self._depth = len(children)
+        return children
+
+    def _claim(self, children, n):
+        offset = random.randrange(min(len(children), self.spread))
+        candidates = children[offset:offset + n]
+        if len(candidates) < n:
+            candidates += children[:min(offset, n - len(candidates))]
+
+        pipeline = self.client._pipeline()
+        for name in candidates:
+            path = '/'.join((self.path, name))
+            pipeline.submit(*self.client._get_request(path, None))
+            pipeline.submit(*self.client._delete_request(path))
+        results = pipeline.wait()
+
+        claimed = list()
+        for name, result, deleted in sorted(zip(candidates, results[::2], results[1::2])):
+            for value in (result, deleted):
+                if isinstance(value, Exception) and not isinstance(value, zookeeper.NoNodeException):
+                    raise value
+            if isinstance(result, Exception) or isinstance(deleted, Exception):
+                continue
+            claimed.append(result[0])
+
+        conflicts = len(candidates) - len(claimed)
+        with self._lock:
+            self._depth = max(self._depth - len(candidates), 0)
+            self._taken += len(claimed)
+            self._conflicts += conflicts
+        if conflicts and self.client.metrics is not None:
+            self.client.metrics.increment('queue_conflicts', self.path, conflicts)
+        return claimed
+
+    def _item_name(self, priority):
+        if not 0 <= priority <= 999:
+            raise ValueError('priorities range from 0 to 999, not {0!r}'.format(priority))
+        # the server appends the sequence number, so the names sort by priority and then by age
+        return '{0}/{1:03d}-'.format(self.path, priority)
+
+    def _children_watcher(self, event):
+        self._wakeup.set()
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0)
+
+    def __repr__(self):
+        return 'Queue(path={0!r})'.format(self.path)
@@ -0,0 +1,162 @@
+""" Backoff and retries for requests that failed because the connection to zookeeper was lost. """
+import collections
+import itertools
+import logging
+import random
+import threading
+import time
+
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+# errors after which a request may be retried once the client has reconnected
+RETRYABLE_ERRORS = (zookeeper.ConnectionLossException, zookeeper.OperationTimeoutException,
+                    zookeeper.SessionExpiredException, zookeeper.InvalidStateException)
+
+# how long a request is retried by default, in seconds
+DEFAULT_DEADLINE = 30.0
+
+# how long requests wait in an offline queue for the client to reconnect by default, in seconds
+DEFAULT_QUEUE_TIMEOUT = 30.0
+
+
+class Backoff(object):
+    """ Exponential backoff with jitter.
+
+    The delay before attempt ``n`` (counting from 0) is ``initial * multiplier ** n``, at most ``maximum``,
+    reduced by a random fraction of up to ``jitter`` of it. With the default ``jitter`` of 1, the delay is
+    anywhere between 0 and the ceiling, so clients that lost their connection at the same time don't
+    reconnect and retry in lockstep.
+
+        >>> backoff = Backoff(initial=0.1, maximum=1, jitter=0)
+        >>> [backoff.delay(attempt) for attempt in range(6)]
+        [0.1, 0.2, 0.4, 0.8, 1, 1]
+        >>> 0 <= Backoff(initial=0.1).delay(0) <= 0.1
+        True
+    """
+
+    def __init__(self, initial=0.1, maximum=30.0, multiplier=2, jitter=1.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        # the exponent is capped, as the ceiling has long reached the maximum anyway
+        ceiling = min(self.maximum, self.initial * self.multiplier ** min(attempt, 64))
+        if not self.jitter:
+            return ceiling
+        return ceiling * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return 'Backoff(initial={0!r}, maximum={1!r}, multiplier={2!r}, jitter={3!r})'.format(
+            self.initial, self.maximum, self.multiplier, self.jitter)
+
+
+class RetryPolicy(object):
+    """ Retries requests that failed with one of ``errors`` until they succeed, or until ``deadline`` seconds
+    have passed since the first attempt, waiting according to ``backoff`` between the attempts.
+
+    :class:`pykeeper.client.ZooKeeper` only retries requests that are safe to repeat: reads, unconditional
+    writes, and deletes, which succeed if an earlier attempt deleted the node. Ephemeral creates succeed if
+    our session owns the node already, sequential creates aren't retried, see
+    :meth:`pykeeper.client.ZooKeeper.create`.
+
+        >>> attempts = list()
+        >>> def flaky(attempt):
+        ...     attempts.append(attempt)
+        ...     if attempt < 2:
+        ...         raise zookeeper.ConnectionLossException('connection loss')
+        ...     return 'done'
+        >>> RetryPolicy(backoff=Backoff(initial=0.001)).run(flaky)
+        'done'
+        >>> attempts
+        [0, 1, 2]
+    """
+
+    def __init__(self, deadline=DEFAULT_DEADLINE, backoff=None, errors=RETRYABLE_ERRORS):
+        self.deadline = deadline
+        self.backoff = backoff or Backoff()
+        self.errors = errors
+
+    def run(self, func):
+        """ Calls ``func`` with the number of the attempt, starting at 0, until it doesn't raise one
+        of the retryable errors. Once the deadline has passed, the last error is raised. """
+        deadline = time.time() + self.deadline
+        for attempt in itertools.count():
+            try:
+                return func(attempt)
+            except self.errors as e:
+                delay = self.backoff.delay(attempt)
+                if time.time() + delay >= deadline:
+                    raise
+                logger.debug('Retrying in {0:.3f}s after attempt {1} failed: {2!r}'.format(delay, attempt, e))
+                time.sleep(delay)
+
+    def __repr__(self):
+        return 'RetryPolicy(deadline={0!r}, backoff={1!r})'.format(self.deadline, self.backoff)
+
+
+class OfflineQueue(object):
+    """ Holds requests made while the client isn't connected, until it has (re)connected.
+
+    Synchronous requests wait at most ``timeout`` seconds, asynchronous requests are issued once the
+    client has connected. At most ``max_size`` requests are held, further requests fail right away
+    with a :class:`zookeeper.ConnectionLossException`, as do those that time out.
+    """
+
+    def __init__(self, max_size=1000, timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._waiting = 0
+        self._deferred = collections.deque()
+
+    def __len__(self):
+        return self._waiting + len(self._deferred)
+
+    def wait(self):
+        """ Blocks until the client has connected. """
+        if self._connected.is_set():
+            return
+        with self._lock:
+            if self._connected.is_set():
+                return
+            if len(self) >= self.max_size:
+                raise zookeeper.ConnectionLossException('offline queue is full')
+            self._waiting += 1
+        try:
+            if not self._connected.wait(self.timeout):
+                raise zookeeper.ConnectionLossException('not connected within {0}s'.format(self.timeout))
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def defer(self, func):
+        """ Calls ``func`` once the client has connected, right away if it is. """
+        with self._lock:
+            if not self._connected.is_set():
+                if len(self) >= self.max_size:
+                    raise zookeeper.ConnectionLossException('offline queue is full')
+                self._deferred.append(func)
+                return
+        func()
+
+    def connected(self):
+        """ Releases the waiting requests and issues the deferred ones, in the order they were made. """
+        with self._lock:
+            self._connected.set()
+            deferred, self._deferred = self._deferred, collections.deque()
+        for func in deferred:
+            try:
+                func()
+            except Exception as e:
+                logger.exception('Issuing a deferred request failed: {0!r}'.format(e))
+
+    def disconnected(self):
+        with self._lock:
+            self._connected.clear()
@@ -0,0 +1,455 @@
+""" A mirror of a subtree shared by the processes of a host, such as the workers of a pre-fork server.
+
+One process, the owner, holds the session and the watches, and publishes the mirror in a
+generation file. A generation file is written once and never changed, so the workers map it
+and read from it without any locking, and the values they get are views of the mapping rather
+than copies. The current generation is kept in a small memory-mapped control file.
+
+A generation file starts with a header packed as ``>8sQIII``: :data:`HEADER`, the generation,
+the number of nodes, the number of changed paths and the offset of the changed paths. It is
+followed by an index entry per node, sorted by path and packed as ``>IIIIII``: the offset and
+length of the path, the offset and length of the data (the packed stat comes right before the
+data), and the offset and count of the indexes of the children. The changed paths are the paths
+that were added, updated or removed since the previous generation, each prefixed by its length.
+"""
+import collections
+import errno
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from pykeeper import event
+from pykeeper.client import TimeoutException, ZooKeeper
+from pykeeper.compact import STAT_SIZE, Stat
+from pykeeper.tree_cache import TreeCache
+
+
+logger = logging.getLogger(__name__)
+
+HEADER = b'PKSHARE\x01'
+CONTROL_HEADER = b'PKSHCTL\x01'
+
+# the length of the data of nodes without data
+NO_DATA = 0xffffffff
+
+# how long the owner waits after a change before publishing, so a burst of changes is published once
+DEFAULT_PUBLISH_WINDOW = 0.05
+
+# how often the readers look for new generations, and try to take over if the owner is gone
+DEFAULT_POLL_INTERVAL = 0.1
+
+# how long a process that got the lock waits for its session, before giving the lock up again
+DEFAULT_CONNECT_TIMEOUT = 10.0
+
+_header = struct.Struct('>8sQIII')
+_entry = struct.Struct('>IIIIII')
+_path_entry = struct.Struct('>II')
+_index = struct.Struct('>I')
+_length = struct.Struct('>H')
+_control = struct.Struct('>8sQ')
+
+
+class SharedChange(collections.namedtuple('SharedChange', 'generation, paths')):
+    """ Emitted by :class:`SharedTreeCache` when a new generation has been published. ``paths`` is a
+    sorted list of the paths that changed, or ``None`` if generations were skipped, in which case
+    any path may have changed. """
+
+
+def write_generation(fileobj, generation, nodes, changed=()):
+    """ Writes a generation file with the ``(path, data, stat)`` tuples in ``nodes``, which must
+    include the parents of every node. The data must be a byte string (or ``None``).
+
+        >>> import io
+        >>> f = io.BytesIO()
+        >>> stat = Stat.from_dict(dict(czxid=1, mzxid=1, ctime=0, mtime=0, version=0, cversion=0, aversion=0,
+        ...                            ephemeralOwner=0, dataLength=1, numChildren=1, pzxid=1))
+        >>> write_generation(f, 7, [('/a', b'x', stat), ('/a/b', None, stat)], ['/a/b'])
+        2
+        >>> generation = Generation(f.getvalue())
+        >>> generation.generation, generation.changed, generation.get_children('/a')
+        (7, ['/a/b'], ['b'])
+        >>> data, node_stat = generation.get('/a')
+        >>> data.tobytes() == b'x', node_stat == stat
+        (True, True)
+        >>> generation.get('/a/b')[0] is None, generation.get('/c')
+        (True, None)
+    """
+    nodes = sorted(((path.encode('utf-8'), data, stat) for path, data, stat in nodes), key=lambda node: node[0])
+    positions = dict((path, i) for i, (path, data, stat) in enumerate(nodes))
+
+    children = collections.defaultdict(list)
+    for path, data, stat in nodes:
+        parent = path.rsplit(b'/', 1)[0] or b'/'
+        if parent != path and parent in positions:
+            children[parent].append(positions[path])
+
+    changed = [path.encode('utf-8') for path in sorted(changed)]
+
+    offset = _header.size + _entry.size * len(nodes)
+    entries, blobs = list(), list()
+    for path, data, stat in nodes:
+        if data is not None and not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        path_offset = offset
+        stat_offset = path_offset + len(path)
+        data_offset = stat_offset + STAT_SIZE
+        children_offset = data_offset + len(data or b'')
+        indexes = children[path]
+        offset = children_offset + _index.size * len(indexes)
+
+        entries.append(_entry.pack(path_offset, len(path), data_offset, NO_DATA if data is None else len(data),
+                                   children_offset, len(indexes)))
+        blobs.extend([path, Stat.from_dict(stat)._packed, data or b''])
+        blobs.extend(_index.pack(index) for index in indexes)
+
+    fileobj.write(_header.pack(HEADER, generation, len(nodes), len(changed), offset))
+    fileobj.write(b''.join(entries))
+    fileobj.write(b''.join(blobs))
+    for path in changed:
+        fileobj.write(_length.pack(len(path)))
+        fileobj.write(path)
+    return len(nodes)
+
+
+class Generation(object):
+    """ Reads a generation file from ``buffer``, such as a memory map, without copying the data. """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        header, self.generation, self.count, self._changed_count, self._changed_offset = _header.unpack_from(buffer, 0)
+        if header != HEADER:
+            raise ValueError('not a pykeeper generation file')
+
+    @property
+    def changed(self):
+        paths = list()
+        offset = self._changed_offset
+        for i in range(self._changed_count):
+            length, = _length.unpack_from(self.buffer, offset)
+            offset += _length.size
+            paths.append(self.view[offset:offset + length].tobytes().decode('utf-8'))
+            offset += length
+        return paths
+
+    def get(self, path):
+        """ Returns ``(data, stat)`` for ``path``, with the data as a :class:`memoryview`, or ``None``
+        if ``path`` isn't in the tree. """
+        index = self._find(path)
+        if index is None:
+            return None
+        path_offset, path_length, data_offset, data_length, children_offset, children_count = self._entry(index)
+        stat = Stat(self.view[data_offset - STAT_SIZE:data_offset].tobytes())
+        if data_length == NO_DATA:
+            return None, stat
+        return self.view[data_offset:data_offset + data_length], stat
+
+    def get_children(self, path):
+        """ Returns the sorted names of the children of ``path``, or ``None`` if it isn't in the tree. """
+        index = self._find(path)
+        if index is None:
+            return None
+        path_offset, path_length, data_offset, data_length, children_offset, children_count = self._entry(index)
+
+        names = list()
+        for i in range(children_count):
+            child, = _index.unpack_from(self.buffer, children_offset + i * _index.size)
+            child_path = self._path(child)
+            names.append(child_path[child_path.rindex(b'/') + 1:].decode('utf-8'))
+        return names
+
+    def walk(self):
+        """ Yields ``(path, data, stat)`` for every node, sorted by path. """
+        for i in range(self.count):
+            path = self._path(i).decode('utf-8')
+            data, stat = self.get(path)
+            yield path, data, stat
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, index):
+        return _entry.unpack_from(self.buffer, _header.size + index * _entry.size)
+
+    def _path(self, index):
+        path_offset, path_length = _path_entry.unpack_from(self.buffer, _header.size + index * _entry.size)
+        return self.buffer[path_offset:path_offset + path_length]
+
+    def _find(self, path):
+        key = path.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._path(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._path(low) == key:
+            return low
+        return None
+
+
+class SharedTreeCache(object):
+    """ A mirror of the subtree rooted at ``path``, shared by every process using the same ``filename``.
+
+    Every process creates its own :class:`SharedTreeCache` (after forking) and calls :meth:`start`.
+    The process that gets the lock on ``filename + '.lock'`` becomes the owner: it connects a
+    :class:`pykeeper.client.ZooKeeper` to ``servers`` (with the rest of ``kwargs``), mirrors the
+    subtree with a :class:`pykeeper.tree_cache.TreeCache`, and publishes a new generation at most
+    once per ``publish_window`` seconds while the tree changes. The other processes only read, so
+    a host has a single session and a single set of watches however many workers it runs.
+
+    Every ``poll_interval`` seconds, the readers look for a new generation, emitting a
+    :class:`SharedChange` on ``on_change`` if there is one, and try to take the lock. If the owner
+    dies or stops, the lock is released and a reader takes over, continuing from the last generation.
+    A process that gets the lock but isn't connected within ``connect_timeout`` seconds releases it
+    again, and keeps on reading.
+
+    Reads check the control file for a new generation, which is a single read from shared memory.
+    The data is returned as a :class:`memoryview` of the generation file, which stays valid (and
+    unchanged) as long as it is referenced, even after newer generations have been published.
+    The data is returned as stored, without being decoded by the codecs of the client.
+    """
+
+    def __init__(self, servers, path, filename, publish_window=DEFAULT_PUBLISH_WINDOW,
+                 poll_interval=DEFAULT_POLL_INTERVAL, connect_timeout=DEFAULT_CONNECT_TIMEOUT, **kwargs):
+        self.servers = servers
+        self.path = path.rstrip('/') or '/'
+        self.filename = filename
+        self.publish_window = publish_window
+        self.poll_interval = poll_interval
+        self.connect_timeout = connect_timeout
+        self.client_kwargs = kwargs
+
+        self.on_change = event.Event()
+        self.initialized = threading.Event()
+
+        self.client = None
+        self.tree = None
+        self._lock_file = None
+        self._control = None
+        self._current = None
+        self._changed = set()
+        self._changed_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    @property
+    def is_owner(self):
+        return self._lock_file is not None
+
+    @property
+    def generation(self):
+        """ The generation we're reading, 0 if nothing has been published yet. """
+        current = self._refresh()
+        return current.generation if current is not None else 0
+
+    def start(self, timeout=None):
+        """ Starts reading, or owning if nobody else is, waiting at most ``timeout`` seconds
+        for a generation to be published. """
+        self._running = True
+        try:
+            self._try_to_own()
+        except TimeoutException as e:
+            # the lock has been released, and taking over is tried again while reading
+            logger.warning('{0}: Unable to own the shared cache: {1}'.format(self, e))
+        self._thread = threading.Thread(target=self._run, name='pykeeper-shared-cache')
+        self._thread.daemon = True
+        self._thread.start()
+        self.initialized.wait(timeout)
+
+    def stop(self):
+        """ Stops reading, handing over to another process if we're the owner. """
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.is_owner:
+            self.tree.stop()
+            self.client.close()
+            self.tree = self.client = None
+            lock_file, self._lock_file = self._lock_file, None
+            lock_file.close()
+
+    def get(self, path):
+        """ Returns ``(data, stat)`` for ``path``, or ``None`` if it isn't in the tree. """
+        current = self._refresh()
+        return current.get(path) if current is not None else None
+
+    def get_children(self, path):
+        """ Returns the sorted names of the children of ``path``, or ``None`` if it isn't in the tree. """
+        current = self._refresh()
+        return current.get_children(path) if current is not None else None
+
+    def walk(self):
+        """ Yields ``(path, data, stat)`` for every node, sorted by path. """
+        current = self._refresh()
+        return current.walk() if current is not None else iter(())
+
+    def __contains__(self, path):
+        current = self._refresh()
+        return current is not None and path in current
+
+    def __len__(self):
+        current = self._refresh()
+        return len(current) if current is not None else 0
+
+    def _generation_filename(self, generation):
+        return '{0}.{1}'.format(self.filename, generation)
+
+    def _published_generation(self):
+        if self._control is None:
+            try:
+                with open(self.filename, 'rb') as f:
+                    self._control = mmap.mmap(f.fileno(), _control.size, access=mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError):
+                # nothing has been published yet
+                return 0
+        header, generation = _control.unpack_from(self._control, 0)
+        return generation if header == CONTROL_HEADER else 0
+
+    def _refresh(self):
+        current = self._current
+        generation = self._published_generation()
+        if generation and (current is None or current.generation != generation):
+            try:
+                with open(self._generation_filename(generation), 'rb') as f:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # replaced by an even newer generation, which the next read will see
+                return current
+            # a single assignment, so concurrent readers see either the old or the new generation
+            current = self._current = Generation(mapping)
+            self.initialized.set()
+        return current
+
+    def _try_to_own(self):
+        lock_file = open(self.filename + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+        try:
+            self.client = ZooKeeper(self.servers, **self.client_kwargs)
+            self.client.connect()
+            if not self._wait_until_connected():
+                raise TimeoutException('not connected within {0}s'.format(self.connect_timeout))
+            self.tree = TreeCache(self.client, self.path)
+            self.tree.on_event += self._on_tree_event
+            self.tree.start()
+            self._publish()
+        except Exception:
+            if self.client is not None:
+                self.client.close()
+            self.tree = self.client = None
+            lock_file.close()
+            raise
+
+        self._lock_file = lock_file
+        logger.info('{0}: Owning the shared cache.'.format(self))
+        return True
+
+    def _wait_until_connected(self):
+        deadline = time.time() + self.connect_timeout
+        while self._running:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                # a little at a time, so stop() doesn't have to wait for the whole timeout
+                self.client.wait_until_connected(min(remaining, self.poll_interval))
+                return True
+            except TimeoutException:
+                pass
+        return False
+
+    def _on_tree_event(self, tree_event):
+        with self._changed_lock:
+            self._changed.add(tree_event.path)
+        self._wakeup.set()
+
+    def _publish(self):
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+
+        previous = self._published_generation()
+        generation = previous + 1
+        nodes = [(path, self.client._encode(path, data), stat) for path, data, stat in self.tree.walk()]
+
+        filename = self._generation_filename(generation)
+        with open(filename + '.tmp', 'wb') as f:
+            write_generation(f, generation, nodes, changed)
+        os.rename(filename + '.tmp', filename)
+
+        if self._control is None or self._control.size() < _control.size or previous == 0:
+            with open(self.filename + '.tmp', 'wb') as f:
+                f.write(_control.pack(CONTROL_HEADER, generation))
+            os.rename(self.filename + '.tmp', self.filename)
+            self._control = None
+        else:
+            # readers map the control file, so it's updated in place
+            with open(self.filename, 'r+b') as f:
+                control = mmap.mmap(f.fileno(), _control.size)
+                try:
+                    _control.pack_into(control, 0, CONTROL_HEADER, generation)
+                finally:
+                    control.close()
+
+        # readers that still map older generations keep them, as they've been mapped before being removed
+        for name in glob.glob(self.filename + '.[0-9]*'):
+            suffix = name[len(self.filename) + 1:]
+            if suffix.isdigit() and int(suffix) < generation - 1:
+                os.remove(name)
+
+        self._refresh()
+        logger.debug('{0}: Published generation {1} with {2} nodes.'.format(self, generation, len(nodes)))
+
+    def _run(self):
+        last = self.generation
+        while self._running:
+            if self.is_owner:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                if not self._running:
+                    break
+                if self._changed:
+                    # let a burst of changes settle
+                    time.sleep(self.publish_window)
+                    try:
+                        self._publish()
+                    except Exception as e:
+                        logger.exception('{0}: Publishing failed: {1}'.format(self, e))
+            else:
+                self._wakeup.wait(self.poll_interval)
+                if not self._running:
+                    break
+                try:
+                    self._try_to_own()
+                except Exception as e:
+                    if self._running:
+                        logger.exception('{0}: Taking over failed: {1}'.format(self, e))
+
+            current = self._refresh()
+            if current is not None and current.generation != last:
+                paths = current.changed if current.generation == last + 1 else None
+                last = current.generation
+                self.on_change(SharedChange(last, paths))
+
+    def __repr__(self):
+        return 'SharedTreeCache(path={0!r}, filename={1!r}, owner={2})'.format(self.path, self.filename, self.is_owner)
@@ -0,0 +1,72 @@
+""" A compact format for the snapshots written by :meth:`ZooKeeper.export`.
+
+A snapshot starts with :data:`HEADER`, followed by a record per node and an end record. Every
+record is a ``(flags, path length, data length)`` header packed as ``>BHI``, followed by the path
+and the data. Paths are relative to the exported node, which has the empty path, and parents
+always come before their children.
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> write(f, [('', b'root', False), ('a', b'', False), ('a/session', b'', True)])
+    3
+    >>> len(f.getvalue())
+    50
+    >>> f.seek(0)
+    0
+    >>> [(path, data, ephemeral) for path, data, ephemeral in read(f)] == [
+    ...     ('', b'root', False), ('a', b'', False), ('a/session', b'', True)]
+    True
+"""
+import struct
+
+
+HEADER = b'PKSNAP\x01\n'
+
+EPHEMERAL = 0x01
+END = 0x80
+
+_record = struct.Struct('>BHI')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write(fileobj, records):
+    """ Writes the ``(path, data, ephemeral)`` tuples in ``records`` to ``fileobj``, returning their count. """
+    fileobj.write(HEADER)
+    count = 0
+    for path, data, ephemeral in records:
+        path = path.encode('utf-8')
+        if data is None:
+            data = b''
+        elif not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        fileobj.write(_record.pack(EPHEMERAL if ephemeral else 0, len(path), len(data)))
+        fileobj.write(path)
+        fileobj.write(data)
+        count += 1
+    fileobj.write(_record.pack(END, 0, 0))
+    return count
+
+
+def read(fileobj):
+    """ Yields the ``(path, data, ephemeral)`` tuples of the snapshot in ``fileobj``. Raises
+    :class:`SnapshotError` if it isn't a snapshot or has been truncated. """
+    if _read_exactly(fileobj, len(HEADER)) != HEADER:
+        raise SnapshotError('not a pykeeper snapshot')
+
+    while True:
+        flags, path_length, data_length = _record.unpack(_read_exactly(fileobj, _record.size))
+        if flags & END:
+            return
+        path = _read_exactly(fileobj, path_length).decode('utf-8')
+        data = _read_exactly(fileobj, data_length)
+        yield path, data, bool(flags & EPHEMERAL)
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise SnapshotError('truncated snapshot')
+    return data
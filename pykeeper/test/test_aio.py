@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+
+import zookeeper
+
+from pykeeper import aio, client, log_stream, watches
+
+
+class AsyncZooKeeperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = aio.AsyncZooKeeper('localhost:22181')
+        log_stream.install()
+
+        self.client.connect()
+        self.run_async(self.client.wait_until_connected(timeout=10))
+
+        sync_client = self.client.client
+        if sync_client.exists('/pykeeper'):
+            sync_client.delete_recursive('/pykeeper', force=True)
+        sync_client.create('/pykeeper', '')
+
+    def tearDown(self):
+        self.client.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+    def test_crud(self):
+        async def crud():
+            self.assertEquals(await self.client.create('/pykeeper/foo', 'bar'), '/pykeeper/foo')
+            data, stat = await self.client.get('/pykeeper/foo')
+            self.assertEquals(data, 'bar')
+
+            stat = await self.client.set('/pykeeper/foo', 'baz')
+            self.assertEquals(stat['version'], 1)
+            self.assertEquals(await self.client.get_children('/pykeeper'), ['foo'])
+
+            stat, acl = await self.client.get_acl('/pykeeper/foo')
+            self.assertEquals(acl, [client.ZOO_OPEN_ACL_UNSAFE])
+
+            await self.client.delete('/pykeeper/foo')
+            self.assertEquals(await self.client.exists('/pykeeper/foo'), None)
+
+            with self.assertRaises(zookeeper.NoNodeException):
+                await self.client.get('/pykeeper/foo')
+
+        self.run_async(crud())
+
+    def test_watcher_is_called_on_the_loop(self):
+        async def watch():
+            loop = asyncio.get_running_loop()
+            fired = loop.create_future()
+
+            def watcher(event):
+                self.assertTrue(asyncio.get_running_loop() is loop)
+                fired.set_result(event)
+
+            await self.client.exists('/pykeeper/foo', watcher=watcher)
+            await self.client.create('/pykeeper/foo', '')
+            event = await fired
+            self.assertEquals(event.type_name, 'created')
+
+        self.run_async(watch())
+
+    def test_watch_stream_is_rearmed(self):
+        async def watch():
+            await self.client.create('/pykeeper/foo', '')
+            async with self.client.watch('/pykeeper/foo') as events:
+                # the first event can only be awaited once the stream is armed
+                next_event = asyncio.ensure_future(events.__anext__())
+                while not self.client.client.watch_stats().armed:
+                    await asyncio.sleep(0.01)
+
+                await self.client.set('/pykeeper/foo', '1')
+                self.assertEquals((await next_event).type_name, 'changed')
+                await self.client.set('/pykeeper/foo', '2')
+                self.assertEquals((await events.__anext__()).type_name, 'changed')
+
+                await self.client.delete('/pykeeper/foo')
+                self.assertEquals((await events.__anext__()).type_name, 'deleted')
+                with self.assertRaises(zookeeper.NoNodeException):
+                    await events.__anext__()
+
+        self.run_async(watch())
+
+    def test_cached_get_coalesces_concurrent_misses(self):
+        async def cached():
+            await self.client.create('/pykeeper/foo', 'bar')
+            results = await asyncio.gather(*[self.client.cached_get('/pykeeper/foo') for i in range(10)])
+            self.assertEquals(set(data for data, stat in results), set(['bar']))
+            self.assertEquals(self.client.client.cache_stats()['get'].entries, 1)
+            self.assertEquals(self.client.client.watch_stats(), watches.WatchStats(armed=1, subscribed=1))
+
+            await self.client.set('/pykeeper/foo', 'baz')
+            while '/pykeeper/foo' in self.client.client.get_cache('get'):
+                await asyncio.sleep(0.01)
+            data, stat = await self.client.cached_get('/pykeeper/foo')
+            self.assertEquals(data, 'baz')
+
+        self.run_async(cached())
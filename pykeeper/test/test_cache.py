@@ -0,0 +1,96 @@
+import unittest
+
+from pykeeper import cache, compact
+
+
+class LRUCacheTest(unittest.TestCase):
+    cache_class = cache.LRUCache
+
+    def test_max_entries(self):
+        c = self.cache_class(max_entries=2)
+        c.put('/a', 'a')
+        c.put('/b', 'b')
+        c.put('/c', 'c')
+
+        self.assertEquals(len(c), 2)
+        self.assertEquals(c.get('/a'), None)
+        self.assertEquals(c.stats().evictions, 1)
+
+    def test_max_bytes(self):
+        c = self.cache_class(max_bytes=100, sizeof=len)
+        c.put('/a', 'x' * 40)
+        c.put('/b', 'x' * 40)
+        self.assertEquals(len(c), 2)
+
+        c.put('/c', 'x' * 40)
+        self.assertEquals(len(c), 2)
+        self.assertEquals(c.stats().bytes, 2 * (40 + 2))
+
+    def test_least_recently_used_is_evicted(self):
+        c = self.cache_class(max_entries=2)
+        c.put('/a', 'a')
+        c.put('/b', 'b')
+        c.get('/a')
+        c.put('/c', 'c')
+
+        self.assertEquals(sorted(c.keys()), ['/a', '/c'])
+
+    def test_stats(self):
+        c = self.cache_class()
+        c.put('/a', 'a')
+        c.get('/a')
+        c.get('/b')
+        c.invalidate('/a')
+
+        stats = c.stats()
+        self.assertEquals((stats.entries, stats.hits, stats.misses, stats.invalidations), (0, 1, 1, 1))
+
+    def test_evicted_invalidator_is_cancelled(self):
+        c = self.cache_class(max_entries=1)
+        invalidator = cache.Invalidator(c, '/a')
+        c.put('/a', 'a', invalidator)
+        c.put('/b', 'b')
+
+        self.assertFalse(invalidator.active)
+
+        # firing a cancelled invalidator should not touch the cache
+        c.put('/a', 'fresh')
+        invalidator(0, 0, 0, '/a')
+        self.assertEquals(c.get('/a'), 'fresh')
+
+    def test_invalidator_fired_before_put(self):
+        c = self.cache_class()
+        invalidator = cache.Invalidator(c, '/a')
+        invalidator(0, 0, 0, '/a')
+
+        # the value may be stale, so it should not be cached
+        c.put('/a', 'stale', invalidator)
+        self.assertNotIn('/a', c)
+
+
+class LFUCacheTest(LRUCacheTest):
+    cache_class = cache.LFUCache
+
+    def test_least_frequently_used_is_evicted(self):
+        c = self.cache_class(max_entries=2)
+        c.put('/a', 'a')
+        c.put('/b', 'b')
+        c.get('/a')
+        c.get('/a')
+        c.get('/b')
+        c.put('/c', 'c')
+
+        self.assertEquals(sorted(c.keys()), ['/a', '/c'])
+
+
+
+class EstimateSizeTest(unittest.TestCase):
+
+    def test_packed_stats_are_counted(self):
+        stat = compact.Stat.from_dict(dict(czxid=1, mzxid=2, ctime=0, mtime=0, version=0, cversion=0, aversion=0,
+                                           ephemeralOwner=0, dataLength=4, numChildren=0, pzxid=1))
+        self.assertTrue(cache.estimate_size(stat) >= compact.STAT_SIZE)
+        self.assertTrue(cache.estimate_size((b'data', stat)) > cache.estimate_size(b'data') + compact.STAT_SIZE)
+
+
+__doctests__ = [cache]
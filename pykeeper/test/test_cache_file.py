@@ -0,0 +1,32 @@
+import io
+import unittest
+
+from pykeeper import cache_file, compact, snapshot
+
+
+STAT = compact.Stat.from_dict(dict(czxid=1, mzxid=2, ctime=3, mtime=4, version=5, cversion=6, aversion=7,
+                                   ephemeralOwner=8, dataLength=9, numChildren=2, pzxid=10))
+
+
+class CacheFileTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        entries = [('get', '/a', (b'\x00\xff' * 1000, STAT)), ('get', '/empty', (None, STAT)),
+                   ('exists', '/a', STAT), ('exists', '/missing', None),
+                   ('get_children', u'/\xe6', (u'\xe6', 'b')), ('get_children', '/leaf', ())]
+        f = io.BytesIO()
+        self.assertEquals(cache_file.write(f, entries), 6)
+
+        f.seek(0)
+        self.assertEquals(list(cache_file.read(f)), entries)
+
+    def test_truncated_files_are_detected(self):
+        f = io.BytesIO()
+        cache_file.write(f, [('exists', '/a', STAT)])
+
+        truncated = io.BytesIO(f.getvalue()[:-1])
+        self.assertRaises(snapshot.SnapshotError, list, cache_file.read(truncated))
+        self.assertRaises(snapshot.SnapshotError, list, cache_file.read(io.BytesIO(b'garbage')))
+
+
+__doctests__ = [cache_file]
@@ -0,0 +1,96 @@
+import os
+import time
+import unittest
+import mock
+
+import zookeeper
+
+from pykeeper import chunked, client, log_stream, retry
+
+
+class ChunkedValuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.ZooKeeper('localhost:22181')
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+        self.values = chunked.ChunkedValues(self.client, chunk_size=1000, window=4)
+        self.value = os.urandom(10500)
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def test_write_and_read(self):
+        self.assertEquals(self.values.read('/pykeeper/value'), None)
+
+        manifest = self.values.write('/pykeeper/value', self.value)
+        self.assertEquals((manifest.size, manifest.chunks), (10500, 11))
+        self.assertEquals(len(self.client.get_children('/pykeeper/value')), 11)
+
+        self.assertEquals(self.values.read('/pykeeper/value'), self.value)
+        self.assertEquals(list(self.values.stream('/pykeeper/value')),
+                          [self.value[offset:offset + 1000] for offset in range(0, 10500, 1000)])
+
+    def test_rewriting_replaces_the_chunks(self):
+        self.values.write('/pykeeper/value', self.value)
+        manifest = self.values.write('/pykeeper/value', b'small')
+
+        self.assertEquals(self.client.get_children('/pykeeper/value'), ['{0}-000000'.format(manifest.generation)])
+        self.assertEquals(self.values.read('/pykeeper/value'), b'small')
+
+    def test_concurrent_write_is_rejected(self):
+        self.values.write('/pykeeper/value', self.value)
+
+        with mock.patch.object(chunked.zookeeper, 'set2') as mocked_set2:
+            # as if another client replaced the manifest after we read it
+            mocked_set2.side_effect = zookeeper.BadVersionException('bad version')
+            self.assertRaises(zookeeper.BadVersionException, self.values.write, '/pykeeper/value', b'newer')
+
+        # the chunks of the rejected write have been removed
+        self.assertEquals(len(self.client.get_children('/pykeeper/value')), 11)
+        self.assertEquals(self.values.read('/pykeeper/value'), self.value)
+
+    def test_manifest_requests_are_retried(self):
+        self.client.retry_policy = retry.RetryPolicy(deadline=5, backoff=retry.Backoff(initial=0.001))
+        self.values.write('/pykeeper/value', self.value)
+
+        real_get = zookeeper.get
+        calls = list()
+
+        def lossy(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise zookeeper.ConnectionLossException('connection loss')
+            return real_get(*args)
+
+        with mock.patch.object(client.zookeeper, 'get', side_effect=lossy):
+            self.assertEquals(self.values.read('/pykeeper/value'), self.value)
+        self.assertEquals(len(calls), 2)
+
+    def test_corrupted_chunks_are_detected(self):
+        manifest = self.values.write('/pykeeper/value', self.value)
+        self.client.set(manifest.chunk_paths('/pykeeper/value')[3], b'garbage')
+
+        self.assertRaises(chunked.ChecksumMismatch, self.values.read, '/pykeeper/value')
+        self.assertRaises(chunked.ChecksumMismatch, list, self.values.stream('/pykeeper/value'))
+
+    def test_cached_read_keys_on_the_manifest_version(self):
+        self.values.write('/pykeeper/value', self.value)
+        value = self.values.cached_read('/pykeeper/value')
+        self.assertEquals(value, self.value)
+        self.assertTrue(self.values.cached_read('/pykeeper/value') is value)
+
+        self.values.write('/pykeeper/value', b'newer')
+        # the manifest cache entry is invalidated by a watch
+        deadline = time.time() + 1
+        while self.values.cached_read('/pykeeper/value') != b'newer' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.values.cached_read('/pykeeper/value'), b'newer')
@@ -1,3 +1,7 @@
+import io
+import os
+import shutil
+import tempfile
 import threading
 import unittest
 import time
@@ -5,7 +9,7 @@ import mock
 
 import zookeeper
 
-from pykeeper import client, log_stream
+from pykeeper import client, log_stream, retry, watches
 
 
 class ClientTest(unittest.TestCase):
@@ -52,6 +56,34 @@ class ConnectionTest(ClientTest):
         # the session id should have changed
         self.assertNotEquals(first_client_id, self.client.client_id)
 
+        # the new session is usable, even though it usually reuses the handle of the expired one
+        self.assertEqual(self.client.state_name, 'connected')
+        self.assertNotEqual(self.client.exists('/'), None)
+
+
+class DispatchTest(ClientTest):
+
+    def test_subscribers_are_dispatched_separately(self):
+        dispatched = list()
+
+        class RecordingDispatcher(object):
+            def dispatch(self, key, func, *args):
+                dispatched.append((key, func))
+
+        self.client.dispatcher = RecordingDispatcher()
+        first, second = list(), list()
+        self.client.on_event += first.append
+        self.client.on_event += second.append
+
+        for i in range(2):
+            self.client._dispatch_handler('on_event', self.client.on_event, None)
+
+        # so a slow subscriber doesn't hold up the others, while every subscriber gets its calls in order
+        self.assertEquals(len(dispatched), 4)
+        keys = dict((key, func) for key, func in dispatched)
+        self.assertEquals(len(keys), 2)
+        self.assertEquals(set(keys.values()), set([first.append, second.append]))
+
 
 class GetChildrenTest(ClientTest):
 
@@ -208,6 +240,157 @@ class GetTest(ClientTest):
             self.assertEquals(mocked_get.call_count, 1)
 
 
+    def test_cached_get_is_revalidated_after_expiry(self):
+        self.client.create('/pykeeper/get', 'foo')
+        self.client.create('/pykeeper/changed', 'foo')
+
+        self.client.cached_get('/pykeeper/get')
+        self.client.cached_get('/pykeeper/changed')
+
+        # expire the session
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.assertTrue(self.client.cache_is_stale)
+
+        self.client.wait_until_connected(timeout=10)
+        self.client.wait_until_revalidated(timeout=10)
+        self.assertFalse(self.client.cache_is_stale)
+
+        # the data of unchanged nodes should not be fetched again
+        with mock.patch.object(client.zookeeper, 'get') as mocked_get:
+            data, stat = self.client.cached_get('/pykeeper/get')
+            self.assertEquals(data, 'foo')
+            self.assertEquals(mocked_get.call_count, 0)
+
+        # the invalidation watches should have been armed again
+        self.client.set('/pykeeper/changed', 'bar')
+        time.sleep(0.01)
+
+        data, stat = self.client.cached_get('/pykeeper/changed')
+        self.assertEquals(data, 'bar')
+
+    def test_watchers_are_told_about_changes_missed_while_expired(self):
+        self.client.reconnect_backoff = retry.Backoff(initial=0.2, jitter=0)
+        self.client.create('/pykeeper/get', 'foo')
+        self.client.create('/pykeeper/same', 'foo')
+
+        events = list()
+        self.client.get('/pykeeper/get', watcher=events.append)
+        self.client.get('/pykeeper/same', watcher=events.append)
+        self.client.get_children('/pykeeper', watcher=events.append)
+        self.client.exists('/pykeeper/created', watcher=events.append)
+
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        other = client.ZooKeeper('localhost:22181')
+        other.connect()
+        other.wait_until_connected(timeout=10)
+        other.set('/pykeeper/get', 'bar')
+        other.create('/pykeeper/created', '')
+        other.close()
+
+        self.client.wait_until_connected(timeout=10)
+        self.client.wait_until_revalidated(timeout=10)
+        deadline = time.time() + 1
+        while len(events) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(sorted((event.type_name, event.path) for event in events),
+                          [('changed', '/pykeeper/get'), ('child', '/pykeeper'), ('created', '/pykeeper/created')])
+
+    def test_saved_caches_are_loaded_and_revalidated(self):
+        self.client.create('/pykeeper/get', b'foo')
+        self.client.create('/pykeeper/changed', b'foo')
+        self.client.create('/pykeeper/deleted', b'foo')
+
+        for path in ('/pykeeper/get', '/pykeeper/changed', '/pykeeper/deleted'):
+            self.client.cached_get(path)
+        self.client.cached_get_children('/pykeeper')
+        self.client.cached_exists('/pykeeper/missing')
+
+        filename = os.path.join(tempfile.mkdtemp(), 'caches')
+        self.addCleanup(shutil.rmtree, os.path.dirname(filename))
+        self.assertEquals(self.client.save_caches(filename), 5)
+
+        self.client.set('/pykeeper/changed', b'bar')
+        self.client.delete('/pykeeper/deleted')
+
+        loaded = client.ZooKeeper('localhost:22181')
+        self.addCleanup(loaded.close)
+        self.assertEquals(loaded.load_caches(filename), 5)
+        self.assertTrue(loaded.cache_is_stale)
+
+        loaded.connect()
+        loaded.wait_until_connected(timeout=10)
+        loaded.wait_until_revalidated(timeout=10)
+
+        # only the data of the changed node should have been fetched again
+        with mock.patch.object(client.zookeeper, 'get') as mocked_get:
+            mocked_get.side_effect = AssertionError('should be cached')
+            self.assertEquals(loaded.cached_get('/pykeeper/get')[0], b'foo')
+            self.assertEquals(loaded.cached_get('/pykeeper/changed')[0], b'bar')
+            self.assertEquals(loaded.cached_exists('/pykeeper/missing'), None)
+
+        self.assertFalse('/pykeeper/deleted' in loaded.get_cache('get'))
+        self.assertEquals(sorted(loaded.cached_get_children('/pykeeper')), ['changed', 'get'])
+
+        # the invalidation watches should be armed
+        self.client.set('/pykeeper/get', b'baz')
+        time.sleep(0.01)
+        self.assertEquals(loaded.cached_get('/pykeeper/get')[0], b'baz')
+
+    def test_loading_a_missing_cache_file(self):
+        self.assertEquals(self.client.load_caches(os.path.join(tempfile.gettempdir(), 'pykeeper-missing-caches')), 0)
+        self.assertFalse(self.client.cache_is_stale)
+
+    def test_watchers_share_a_single_watch(self):
+        self.client.create('/pykeeper/get', 'foo')
+
+        event = threading.Event()
+        watch_results = list()
+        def watcher(client_event):
+            watch_results.append(client_event)
+            event.set()
+        def unwatched(client_event):
+            watch_results.append(client_event)
+
+        self.client.get('/pykeeper/get', watcher=watcher)
+        self.client.get('/pykeeper/get', watcher=unwatched)
+        self.client.cached_get('/pykeeper/get')
+        self.assertEquals(self.client.watch_stats(), watches.WatchStats(armed=1, subscribed=3))
+
+        self.assertTrue(self.client.unwatch('/pykeeper/get', unwatched))
+        self.assertEquals(self.client.watch_stats(), watches.WatchStats(armed=1, subscribed=2))
+
+        self.client.set('/pykeeper/get', 'bar')
+        event.wait(timeout=1)
+        time.sleep(0.01)
+
+        self.assertEquals(len(watch_results), 1)
+        self.assertEquals(watch_results[0].type_name, 'changed')
+        self.assertEquals(self.client.watch_stats(), watches.WatchStats(armed=0, subscribed=0))
+
+    def test_cached_get_coalesces_concurrent_misses(self):
+        self.client.create('/pykeeper/get', 'foo')
+
+        real_get = client.zookeeper.get
+        def slow_get(*args):
+            time.sleep(0.1)
+            return real_get(*args)
+
+        with mock.patch.object(client.zookeeper, 'get') as mocked_get:
+            mocked_get.side_effect = slow_get
+
+            results = list()
+            threads = [threading.Thread(target=lambda: results.append(self.client.cached_get('/pykeeper/get')))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # only a single request should have been made
+            self.assertEquals(mocked_get.call_count, 1)
+            self.assertEquals([data for data, stat in results], ['foo'] * 10)
+
+
 class ExistsTest(ClientTest):
 
     def setUp(self):
@@ -280,4 +463,486 @@ class ExistsTest(ClientTest):
             # make sure our mock actually may be used
             stat = self.client.cached_exists('/pykeeper/exists')
             self.assertEquals(stat, mocked_stat)
-            self.assertEquals(mocked_exists.call_count, 1)
\ No newline at end of file
+            self.assertEquals(mocked_exists.call_count, 1)
+
+class GetManyTest(ClientTest):
+
+    def setUp(self):
+        super(GetManyTest, self).setUp()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper')
+
+        self.client.create('/pykeeper', '')
+        for i in range(10):
+            self.client.create('/pykeeper/node-{0}'.format(i), str(i))
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper')
+        super(GetManyTest, self).tearDown()
+
+    def test_get_many(self):
+        paths = ['/pykeeper/node-{0}'.format(i) for i in range(10)] + ['/pykeeper/missing']
+
+        results = self.client.get_many(paths, window=3)
+        self.assertEquals([data for data, stat in results[:-1]], [str(i) for i in range(10)])
+
+        # errors are returned in place of the result
+        self.assertIsInstance(results[-1], zookeeper.NoNodeException)
+
+    def test_get_many_refuses_to_wait_on_the_completion_thread(self):
+        results = list()
+        done = threading.Event()
+
+        def watcher(event):
+            try:
+                results.append(self.client.get_many(['/pykeeper/node-0']))
+            except Exception as e:
+                results.append(e)
+            done.set()
+
+        # the watcher runs on the completion thread, which would never complete the requests
+        self.client.get('/pykeeper/node-0', watcher=watcher)
+        self.client.set('/pykeeper/node-0', 'changed')
+        done.wait(5)
+        self.assertEquals(len(results), 1)
+        self.assertIsInstance(results[0], RuntimeError)
+
+    def test_exists_and_get_children_many(self):
+        stats = self.client.exists_many(['/pykeeper/node-0', '/pykeeper/missing'])
+        self.assertTrue(stats[0])
+        self.assertEquals(stats[1], None)
+
+        children = self.client.get_children_many(['/pykeeper', '/pykeeper/node-0'])
+        self.assertEquals(sorted(children[0]), ['node-{0}'.format(i) for i in range(10)])
+        self.assertEquals(children[1], [])
+
+    def test_cached_get_many(self):
+        results = self.client.cached_get_many(['/pykeeper/node-0', '/pykeeper/node-1'])
+        self.assertEquals([data for data, stat in results], ['0', '1'])
+
+        with mock.patch.object(client.zookeeper, 'aget') as mocked_aget:
+            results = self.client.cached_get_many(['/pykeeper/node-0', '/pykeeper/node-1'])
+            self.assertEquals([data for data, stat in results], ['0', '1'])
+            self.assertEquals(mocked_aget.call_count, 0)
+
+        # changing the node should invalidate the cache
+        self.client.set('/pykeeper/node-1', 'changed')
+        time.sleep(0.01)
+
+        results = self.client.cached_get_many(['/pykeeper/node-0', '/pykeeper/node-1'])
+        self.assertEquals([data for data, stat in results], ['0', 'changed'])
+
+
+class DeleteRecursiveTest(ClientTest):
+
+    def setUp(self):
+        super(DeleteRecursiveTest, self).setUp()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+        self.client.create('/pykeeper', '')
+        for i in range(3):
+            self.client.create('/pykeeper/{0}'.format(i), '')
+            for j in range(3):
+                self.client.create('/pykeeper/{0}/{1}'.format(i, j), 'data')
+
+        self.client.create('/pykeeper/1/ephemeral', '', flags=zookeeper.EPHEMERAL)
+
+    def tearDown(self):
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        super(DeleteRecursiveTest, self).tearDown()
+
+    def test_dry_run(self):
+        result = self.client.delete_recursive('/pykeeper', dry_run=True)
+        self.assertEquals(result.discovered, 14)
+        self.assertEquals(len(self.client.get_children('/pykeeper')), 3)
+
+    def test_ephemerals_are_kept(self):
+        reported = list()
+        result = self.client.delete_recursive('/pykeeper', window=2, progress=reported.append)
+
+        self.assertEquals(result, client.DeleteProgress('done', 14, 11, 3))
+        self.assertEquals(reported[-1].deleted, 11)
+
+        # the ephemeral and its ancestors should be left
+        self.assertEquals(self.client.get_children('/pykeeper'), ['1'])
+        self.assertEquals(self.client.get_children('/pykeeper/1'), ['ephemeral'])
+
+    def test_force(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.assertFalse(self.client.exists('/pykeeper'))
+
+
+class CreateRecursiveTest(ClientTest):
+
+    def setUp(self):
+        super(CreateRecursiveTest, self).setUp()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        super(CreateRecursiveTest, self).tearDown()
+
+    def test_create_recursive(self):
+        for optimistic in (True, False):
+            path = '/pykeeper/{0}/a/b'.format(optimistic)
+            self.client.create_recursive(path, 'data', optimistic=optimistic)
+            self.assertEquals(self.client.get(path)[0], 'data')
+            self.assertEquals(self.client.get(path.rsplit('/', 1)[0])[0], '')
+
+            # existing nodes are left alone
+            self.client.create_recursive(path, 'other', optimistic=optimistic)
+            self.assertEquals(self.client.get(path)[0], 'data')
+
+    def test_ensure_paths(self):
+        self.client.create_recursive('/pykeeper/b', '')
+
+        created = self.client.ensure_paths(['/pykeeper/a/1', '/pykeeper/a/2', '/pykeeper/b/1', '/pykeeper/b'], window=2)
+        self.assertEquals(created, ['/pykeeper/a', '/pykeeper/a/1', '/pykeeper/a/2', '/pykeeper/b/1'])
+        self.assertEquals(sorted(self.client.get_children('/pykeeper/a')), ['1', '2'])
+
+        self.assertEquals(self.client.ensure_paths(['/pykeeper/a/1']), [])
+
+
+class WalkTest(ClientTest):
+
+    def setUp(self):
+        super(WalkTest, self).setUp()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+        self.client.ensure_paths(['/pykeeper/source/a/1', '/pykeeper/source/a/2', '/pykeeper/source/b'])
+        self.client.set('/pykeeper/source/a/1', 'data')
+        self.client.create('/pykeeper/source/b/ephemeral', '', flags=zookeeper.EPHEMERAL)
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        super(WalkTest, self).tearDown()
+
+    def test_walk(self):
+        walked = [path for path, data, stat in self.client.walk('/pykeeper/source', window=2)]
+        self.assertEquals(sorted(walked), ['/pykeeper/source', '/pykeeper/source/a', '/pykeeper/source/a/1',
+                                           '/pykeeper/source/a/2', '/pykeeper/source/b', '/pykeeper/source/b/ephemeral'])
+        # parents come before their children
+        for path in walked[1:]:
+            self.assertTrue(walked.index(path.rsplit('/', 1)[0]) < walked.index(path))
+
+        self.assertRaises(zookeeper.NoNodeException, list, self.client.walk('/pykeeper/missing'))
+
+    def test_export_and_restore(self):
+        f = io.BytesIO()
+        self.assertEquals(self.client.export('/pykeeper/source', f), 6)
+
+        f.seek(0)
+        result = self.client.restore(f, '/pykeeper/copies/copy', window=2)
+        self.assertEquals(result, client.RestoreResult(5, 0, 1))
+        self.assertEquals(self.client.get('/pykeeper/copies/copy/a/1')[0], b'data')
+        self.assertEquals(self.client.get_children('/pykeeper/copies/copy/b'), [])
+
+        # restoring again leaves the existing nodes alone
+        f.seek(0)
+        self.assertEquals(self.client.restore(f, '/pykeeper/copies/copy'), client.RestoreResult(0, 5, 1))
+
+
+class RetryTest(ClientTest):
+
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.client.retry_policy = retry.RetryPolicy(deadline=5, backoff=retry.Backoff(initial=0.001))
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        self.client.create('/pykeeper', '')
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        super(RetryTest, self).tearDown()
+
+    def lose_the_response(self, name):
+        """ Makes the first request of ``name`` succeed, but fail with a connection loss. """
+        real = getattr(zookeeper, name)
+        calls = list()
+
+        def lossy(*args):
+            calls.append(args)
+            retval = real(*args)
+            if len(calls) == 1:
+                raise zookeeper.ConnectionLossException('connection loss')
+            return retval
+
+        patcher = mock.patch.object(client.zookeeper, name, side_effect=lossy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_idempotent_requests_are_retried(self):
+        self.client.create('/pykeeper/node', 'data')
+
+        calls = self.lose_the_response('get')
+        self.assertEquals(self.client.get('/pykeeper/node')[0], 'data')
+        self.assertEquals(len(calls), 2)
+
+    def test_retried_deletes_succeed(self):
+        self.client.create('/pykeeper/node', 'data')
+
+        calls = self.lose_the_response('delete')
+        self.assertEquals(self.client.delete('/pykeeper/node'), zookeeper.OK)
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(self.client.exists('/pykeeper/node'), None)
+
+    def test_retried_ephemeral_creates_find_the_node_of_the_lost_attempt(self):
+        calls = self.lose_the_response('create')
+        self.assertEquals(self.client.create('/pykeeper/node', 'data', flags=zookeeper.EPHEMERAL), '/pykeeper/node')
+        # the node of the retry existed already, and is owned by our session
+        self.assertEquals(len(calls), 2)
+
+    def test_retried_persistent_creates_cannot_tell_whose_node_exists(self):
+        calls = self.lose_the_response('create')
+        self.assertRaises(zookeeper.NodeExistsException, self.client.create, '/pykeeper/node', '')
+        self.assertEquals(len(calls), 2)
+
+    def test_retried_ephemeral_creates_leave_the_nodes_of_other_sessions_alone(self):
+        other = client.ZooKeeper('localhost:22181')
+        other.connect()
+        other.wait_until_connected(timeout=10)
+        self.addCleanup(other.close)
+
+        real_create = zookeeper.create
+        calls = list()
+
+        def other_session_was_first(handle, path, value, acl, flags):
+            calls.append(path)
+            if len(calls) == 1:
+                real_create(other.handle, path, value, acl, flags)
+                raise zookeeper.ConnectionLossException('connection loss')
+            return real_create(handle, path, value, acl, flags)
+
+        with mock.patch.object(client.zookeeper, 'create', side_effect=other_session_was_first):
+            self.assertRaises(zookeeper.NodeExistsException, self.client.create, '/pykeeper/node', '', flags=zookeeper.EPHEMERAL)
+        self.assertEquals(len(calls), 2)
+
+    def test_retried_creates_leave_the_nodes_of_others_alone(self):
+        real_create = zookeeper.create
+        calls = list()
+
+        def someone_else_was_first(handle, path, value, acl, flags):
+            calls.append(path)
+            if len(calls) == 1:
+                real_create(handle, path, 'other', acl, flags)
+                raise zookeeper.ConnectionLossException('connection loss')
+            return real_create(handle, path, value, acl, flags)
+
+        with mock.patch.object(client.zookeeper, 'create', side_effect=someone_else_was_first):
+            self.assertRaises(zookeeper.NodeExistsException, self.client.create, '/pykeeper/node', 'data')
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(self.client.get('/pykeeper/node')[0], 'other')
+
+    def test_sequential_creates_are_not_retried(self):
+        self.client.create('/pykeeper/item-', 'data', flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+
+        # the node of the lost attempt can't be told apart from the nodes of others with the same prefix
+        calls = self.lose_the_response('create')
+        self.assertRaises(zookeeper.ConnectionLossException,
+                          self.client.create, '/pykeeper/item-', 'data', flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(len(self.client.get_children('/pykeeper')), 2)
+
+    def test_other_requests_are_not_retried(self):
+        with mock.patch.object(client.zookeeper, 'set_acl') as mocked_set_acl:
+            mocked_set_acl.side_effect = zookeeper.ConnectionLossException('connection loss')
+            self.assertRaises(zookeeper.ConnectionLossException, self.client.set_acl, '/pykeeper', 0, [])
+            self.assertEquals(mocked_set_acl.call_count, 1)
+
+    def test_reconnecting_happens_off_the_completion_thread(self):
+        self.client.reconnect_backoff = retry.Backoff(initial=0.2, jitter=0)
+        first_client_id = self.client.client_id
+
+        started = time.time()
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.assertTrue(time.time() - started < 0.1)
+        self.assertEquals(self.client.state_name, 'connecting')
+
+        # requests made while reconnecting are retried until they succeed on the new session
+        self.assertEquals(self.client.get('/pykeeper')[0], '')
+        self.assertTrue(time.time() - started >= 0.2)
+        self.assertNotEquals(self.client.client_id, first_client_id)
+
+
+class OfflineQueueTest(ClientTest):
+
+    def test_requests_wait_until_connected(self):
+        self.client.offline_queue = retry.OfflineQueue(max_size=2, timeout=10)
+        results = list()
+        self.client.aexists('/', results.append)
+        # the queue is full
+        self.client.aexists('/', results.append)
+        self.client.aexists('/', results.append)
+        self.assertEquals(len(results), 1)
+        self.assertTrue(isinstance(results[0], zookeeper.ConnectionLossException))
+
+        # synchronous requests wait as well
+        waiter = threading.Thread(target=lambda: results.append(self.client.get_children('/')))
+        self.client.offline_queue.max_size = 3
+        waiter.start()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        waiter.join(1)
+        deadline = time.time() + 1
+        while len(results) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(len(results), 4)
+        self.assertFalse(any(isinstance(result, Exception) for result in results[1:]))
+
+
+class EphemeralRestoreTest(ClientTest):
+
+    def setUp(self):
+        super(EphemeralRestoreTest, self).setUp()
+        self.client.reconnect_backoff = retry.Backoff(initial=0.01)
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        self.client.create('/pykeeper', '')
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        super(EphemeralRestoreTest, self).tearDown()
+
+    def test_ephemerals_are_restored_after_expiry(self):
+        restored = list()
+        self.client.on_ephemeral_restored += restored.append
+
+        self.client.create('/pykeeper/service', b'address', flags=zookeeper.EPHEMERAL, restore=True)
+        member = self.client.create('/pykeeper/member-', b'', flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE, restore=True)
+        self.client.create('/pykeeper/unrestored', b'', flags=zookeeper.EPHEMERAL)
+        self.client.create('/pykeeper/deleted', b'', flags=zookeeper.EPHEMERAL, restore=True)
+        self.client.delete('/pykeeper/deleted')
+        self.assertEquals(self.client.ephemerals(), ['/pykeeper/service', member])
+
+        with mock.patch.object(client.zookeeper, 'create') as mocked_create:
+            self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+            self.client.wait_until_connected(timeout=10)
+
+            deadline = time.time() + 1
+            while len(restored) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            # the nodes are created asynchronously, in a single pipelined round
+            self.assertEquals(mocked_create.call_count, 0)
+
+        self.assertEquals(len(restored), 2)
+        self.assertEquals(restored[0], client.RestoredEphemeral('/pykeeper/service', '/pykeeper/service', None))
+        self.assertEquals(restored[1].path, member)
+        new_member = restored[1].new_path
+        self.assertNotEquals(new_member, member)
+        self.assertTrue(new_member.startswith('/pykeeper/member-'))
+
+        session_id = self.client.client_id[0]
+        self.assertEquals(self.client.get('/pykeeper/service')[0], b'address')
+        self.assertEquals(self.client.exists('/pykeeper/service')['ephemeralOwner'], session_id)
+        self.assertEquals(self.client.exists(new_member)['ephemeralOwner'], session_id)
+        self.assertEquals(self.client.exists('/pykeeper/unrestored'), None)
+        self.assertEquals(self.client.exists('/pykeeper/deleted'), None)
+        self.assertEquals(self.client.ephemerals(), ['/pykeeper/service', new_member])
+
+    def test_ephemerals_deleted_with_pipelined_deletes_are_not_restored(self):
+        self.client.restore_ephemerals = True
+        self.client.create('/pykeeper/svc', '')
+        self.client.create('/pykeeper/svc/member', b'', flags=zookeeper.EPHEMERAL)
+        self.client.create('/pykeeper/other', b'', flags=zookeeper.EPHEMERAL)
+
+        self.client.delete_recursive('/pykeeper/svc/member', force=True)
+        self.assertEquals(self.client.ephemerals(), ['/pykeeper/other'])
+
+        restored = list()
+        self.client.on_ephemeral_restored += restored.append
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.client.wait_until_connected(timeout=10)
+
+        deadline = time.time() + 1
+        while not restored and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals([each.path for each in restored], ['/pykeeper/other'])
+        self.assertEquals(self.client.exists('/pykeeper/svc/member'), None)
+
+    def test_ephemerals_are_retried_after_a_connection_loss(self):
+        restored = list()
+        self.client.on_ephemeral_restored += restored.append
+        self.client.create('/pykeeper/service', b'address', flags=zookeeper.EPHEMERAL, restore=True)
+
+        real_acreate = zookeeper.acreate
+        calls = list()
+
+        def lossy(handle, path, value, acl, flags, completion):
+            calls.append(path)
+            if len(calls) > 1:
+                return real_acreate(handle, path, value, acl, flags, completion)
+            # the node is created, but we aren't told
+            return real_acreate(handle, path, value, acl, flags,
+                                lambda handle, rc, created_path: completion(handle, zookeeper.CONNECTIONLOSS, None))
+
+        with mock.patch.object(client.zookeeper, 'acreate', side_effect=lossy):
+            self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+            self.client.wait_until_connected(timeout=10)
+
+            deadline = time.time() + 1
+            while not restored and time.time() < deadline:
+                time.sleep(0.01)
+
+        # the node of the lost attempt is found by the retry
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(restored, [client.RestoredEphemeral('/pykeeper/service', '/pykeeper/service', None)])
+        self.assertEquals(self.client.ephemerals(), ['/pykeeper/service'])
+
+    def test_ephemerals_that_cannot_be_restored_are_reported(self):
+        restored = list()
+        self.client.on_ephemeral_restored += restored.append
+        self.client.restore_ephemerals = True
+
+        self.client.create('/pykeeper/parent', '')
+        self.client.create('/pykeeper/parent/service', b'', flags=zookeeper.EPHEMERAL)
+        self.client.create('/pykeeper/opted-out', b'', flags=zookeeper.EPHEMERAL, restore=False)
+
+        self.assertEquals(self.client.ephemerals(), ['/pykeeper/parent/service'])
+
+        # someone else removes the parent
+        other = client.ZooKeeper('localhost:22181')
+        other.connect()
+        other.wait_until_connected(timeout=10)
+        other.delete_recursive('/pykeeper/parent', force=True)
+        other.close()
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.client.wait_until_connected(timeout=10)
+
+        deadline = time.time() + 1
+        while not restored and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(len(restored), 1)
+        self.assertEquals(restored[0][:2], ('/pykeeper/parent/service', None))
+        self.assertTrue(isinstance(restored[0].error, zookeeper.NoNodeException))
+        self.assertEquals(self.client.ephemerals(), [])
@@ -0,0 +1,79 @@
+import unittest
+
+from pykeeper import client, codec, log_stream
+
+
+class CodecsTest(unittest.TestCase):
+
+    def test_longest_prefix_wins(self):
+        codecs = codec.Codecs()
+        json_codec, pickle_codec = codec.JsonCodec(), codec.PickleCodec()
+        codecs.register('/app', json_codec)
+        codecs.register('/app/sessions/', pickle_codec)
+
+        self.assertTrue(codecs.lookup('/app') is json_codec)
+        self.assertTrue(codecs.lookup('/app/config') is json_codec)
+        self.assertTrue(codecs.lookup('/app/sessions/1') is pickle_codec)
+        self.assertTrue(codecs.lookup('/application') is codecs.default)
+        self.assertTrue(codecs.lookup('/') is codecs.default)
+
+    def test_compression(self):
+        compressed = codec.Compressed(codec.PickleCodec(), threshold=100)
+        small, large = dict(a=1), dict(a='x' * 1000)
+
+        self.assertFalse(compressed.encode(small).startswith(codec.COMPRESSED_HEADER))
+        data = compressed.encode(large)
+        self.assertTrue(data.startswith(codec.COMPRESSED_HEADER))
+        self.assertTrue(len(data) < 100)
+
+        self.assertEquals(compressed.decode(data), large)
+        self.assertEquals(compressed.decode(compressed.encode(small)), small)
+
+    def test_empty_values(self):
+        self.assertEquals(codec.JsonCodec().decode(''), None)
+        self.assertEquals(codec.PickleCodec().decode(''), None)
+
+
+class ClientCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        codecs = codec.Codecs()
+        codecs.register('/pykeeper/json', codec.Compressed(codec.JsonCodec(), threshold=100))
+        self.client = client.ZooKeeper('localhost:22181', codecs=codecs)
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        self.client.create('/pykeeper', '')
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def test_values_are_encoded_and_decoded(self):
+        self.client.create_recursive('/pykeeper/json/a', dict(spam='eggs'))
+        self.assertEquals(self.client.get('/pykeeper/json/a')[0], dict(spam='eggs'))
+        # the parents are created without a value
+        self.assertEquals(self.client.get('/pykeeper/json')[0], None)
+
+        self.client.set('/pykeeper/json/a', ['x' * 1000])
+        self.assertEquals(self.client.get('/pykeeper/json/a')[0], ['x' * 1000])
+        self.assertEquals(self.client.get_many(['/pykeeper/json/a'])[0][0], ['x' * 1000])
+
+        # other paths are left alone
+        self.client.create('/pykeeper/raw', 'raw')
+        self.assertEquals(self.client.get('/pykeeper/raw')[0], 'raw')
+
+    def test_cached_get_caches_the_decoded_value(self):
+        self.client.create_recursive('/pykeeper/json/a', dict(spam='eggs'))
+
+        value = self.client.cached_get('/pykeeper/json/a')[0]
+        self.assertEquals(value, dict(spam='eggs'))
+        self.assertTrue(self.client.cached_get('/pykeeper/json/a')[0] is value)
+
+
+__doctests__ = [codec]
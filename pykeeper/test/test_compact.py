@@ -0,0 +1,48 @@
+import pickle
+import unittest
+
+from pykeeper import compact
+
+
+STAT = dict(czxid=2 ** 40, mzxid=2 ** 40 + 1, ctime=1327924800000, mtime=1327924800001, version=3, cversion=-1,
+            aversion=0, ephemeralOwner=-2 ** 62, dataLength=100, numChildren=2, pzxid=2 ** 40 + 2)
+
+
+class StatTest(unittest.TestCase):
+
+    def test_dict_compatibility(self):
+        stat = compact.Stat.from_dict(STAT)
+
+        self.assertEquals(stat, STAT)
+        self.assertEquals(dict(stat), STAT)
+        self.assertEquals(sorted(stat.keys()), sorted(STAT.keys()))
+        for name, value in STAT.items():
+            self.assertEquals(stat[name], value)
+            self.assertEquals(getattr(stat, name), value)
+        self.assertRaises(KeyError, lambda: stat['missing'])
+
+    def test_immutable_and_hashable(self):
+        stat = compact.Stat.from_dict(STAT)
+        self.assertRaises(AttributeError, setattr, stat, 'version', 4)
+
+        self.assertEquals(len(set([stat, compact.Stat.from_dict(STAT)])), 1)
+        self.assertEquals(pickle.loads(pickle.dumps(stat)), stat)
+
+    def test_other_values_are_left_alone(self):
+        self.assertEquals(compact.Stat.from_dict(None), None)
+        stat = compact.Stat.from_dict(STAT)
+        self.assertTrue(compact.Stat.from_dict(stat) is stat)
+
+
+class ChildrenTest(unittest.TestCase):
+
+    def test_names_are_shared(self):
+        first = compact.compact_children([''.join(['child-', str(i)]) for i in range(3)])
+        second = compact.compact_children([''.join(['child-', str(i)]) for i in range(3)])
+
+        self.assertEquals(first, ('child-0', 'child-1', 'child-2'))
+        for a, b in zip(first, second):
+            self.assertTrue(a is b)
+
+
+__doctests__ = [compact]
@@ -0,0 +1,118 @@
+import threading
+import unittest
+
+from pykeeper import dispatch
+
+
+class InlineDispatcherTest(unittest.TestCase):
+
+    def test_runs_right_away(self):
+        dispatcher = dispatch.InlineDispatcher()
+        calls = list()
+        dispatcher.dispatch('/foo', calls.append, 1)
+        self.assertEquals(calls, [1])
+        self.assertEquals(dispatcher.stats().dispatched, 1)
+
+    def test_exceptions_are_logged_and_swallowed(self):
+        dispatcher = dispatch.InlineDispatcher()
+
+        def fail():
+            raise ValueError('boom')
+
+        dispatcher.dispatch('/foo', fail)
+        self.assertEquals(dispatcher.stats().dispatched, 1)
+
+
+class ThreadDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = list()
+
+    def blocked(self):
+        self.release.wait(5)
+
+    def test_preserves_order(self):
+        dispatcher = dispatch.ThreadDispatcher()
+        done = threading.Event()
+        for i in range(100):
+            dispatcher.dispatch('/foo/{0}'.format(i), self.calls.append, i)
+        dispatcher.dispatch('', done.set)
+        done.wait(5)
+        dispatcher.stop(5)
+
+        self.assertEquals(self.calls, list(range(100)))
+        self.assertEquals(dispatcher.stats().dispatched, 101)
+
+    def test_drop_newest(self):
+        dispatcher = dispatch.ThreadDispatcher(max_queue=2, policy=dispatch.DROP_NEWEST)
+        started = threading.Event()
+        dispatcher.dispatch('', lambda: (started.set(), self.blocked()))
+        started.wait(5)
+
+        for i in range(4):
+            dispatcher.dispatch('', self.calls.append, i)
+        self.assertEquals(dispatcher.stats().queued, 2)
+
+        self.release.set()
+        dispatcher.stop(5)
+        self.assertEquals(self.calls, [0, 1])
+        self.assertEquals(dispatcher.stats().dropped, 2)
+
+    def test_drop_oldest(self):
+        dispatcher = dispatch.ThreadDispatcher(max_queue=2, policy=dispatch.DROP_OLDEST)
+        started = threading.Event()
+        dispatcher.dispatch('', lambda: (started.set(), self.blocked()))
+        started.wait(5)
+
+        for i in range(4):
+            dispatcher.dispatch('', self.calls.append, i)
+
+        self.release.set()
+        dispatcher.stop(5)
+        self.assertEquals(self.calls, [2, 3])
+        self.assertEquals(dispatcher.stats().dropped, 2)
+        self.assertEquals(dispatcher.stats().max_queued, 2)
+
+    def test_block_waits_for_room(self):
+        dispatcher = dispatch.ThreadDispatcher(max_queue=1, policy=dispatch.BLOCK)
+        started = threading.Event()
+        dispatcher.dispatch('', lambda: (started.set(), self.blocked()))
+        started.wait(5)
+        dispatcher.dispatch('', self.calls.append, 0)
+
+        producer = threading.Thread(target=dispatcher.dispatch, args=('', self.calls.append, 1))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+
+        self.release.set()
+        producer.join(5)
+        dispatcher.stop(5)
+        self.assertEquals(self.calls, [0, 1])
+        self.assertEquals(dispatcher.stats().dropped, 0)
+
+
+class PoolDispatcherTest(unittest.TestCase):
+
+    def test_preserves_order_per_key(self):
+        dispatcher = dispatch.PoolDispatcher(workers=4)
+        calls = dict()
+        lock = threading.Lock()
+
+        def record(key, i):
+            with lock:
+                calls.setdefault(key, list()).append(i)
+
+        keys = ['/foo/{0}'.format(i) for i in range(8)]
+        for i in range(50):
+            for key in keys:
+                dispatcher.dispatch(key, record, key, i)
+        dispatcher.stop(5)
+
+        for key in keys:
+            self.assertEquals(calls[key], list(range(50)))
+        stats = dispatcher.stats()
+        self.assertEquals(stats.dispatched, 400)
+        self.assertEquals(stats.queued, 0)
+        self.assertTrue(stats.handler_time >= stats.max_handler_time)
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+import unittest
+
+from pykeeper import log_stream
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class RelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        log_stream.logger.addHandler(self.handler)
+        self.level = log_stream.logger.level
+        log_stream.logger.setLevel(logging.DEBUG)
+
+        read_fd, self.write_fd = os.pipe()
+        self.relay = log_stream._Relay(read_fd, max_rate=None, repeat_interval=10)
+
+    def tearDown(self):
+        log_stream.logger.removeHandler(self.handler)
+        log_stream.logger.setLevel(self.level)
+        os.close(self.write_fd)
+        self.relay.close()
+
+    def line(self, level, message):
+        return '2012-01-30 12:00:00,000:123(0x7f):{0}@zookeeper_interest@1461: {1}'.format(level, message)
+
+    def test_levels_and_rules(self):
+        self.relay.handle(self.line('ZOO_INFO', 'Initiating client connection'), 0)
+        self.relay.handle(self.line('ZOO_WARN', 'Exceeded deadline by 11ms'), 0)
+        self.relay.handle(self.line('ZOO_ERROR', 'server refused to accept the client'), 0)
+        self.relay.handle('no level here', 0)
+
+        self.assertEquals(self.handler.records, [
+            (logging.INFO, 'zookeeper_interest@1461: Initiating client connection'),
+            (logging.DEBUG, 'zookeeper_interest@1461: Exceeded deadline by 11ms'),
+            (logging.INFO, 'zookeeper_interest@1461: server refused to accept the client'),
+            (logging.INFO, 'no level here'),
+        ])
+
+    def test_custom_rules(self):
+        relay = log_stream._Relay(None, rules=[log_stream.Rule('^zookeeper_interest', logging.INFO, logging.DEBUG)])
+        self.assertEquals(relay.parse(self.line('ZOO_INFO', 'foo'))[0], logging.DEBUG)
+        self.assertEquals(relay.parse(self.line('ZOO_WARN', 'Exceeded deadline by 11ms'))[0], logging.WARNING)
+        for fd in relay._wakeup:
+            os.close(fd)
+
+    def test_repeated_messages_are_collapsed(self):
+        for i in range(5):
+            self.relay.handle(self.line('ZOO_ERROR', 'connect to 127.0.0.1:{0} failed'.format(2180 + i)), 0)
+        self.assertEquals(len(self.handler.records), 1)
+
+        # a summary is logged when the interval has passed
+        self.relay.flush(11)
+        self.assertEquals(self.handler.records[-1][1], 'zookeeper_interest@1461: connect to 127.0.0.1:2184 failed (repeated 4 times)')
+
+        # ... or when another message is logged
+        self.relay.handle(self.line('ZOO_ERROR', 'connect to 127.0.0.1:2185 failed'), 12)
+        self.relay.handle(self.line('ZOO_INFO', 'connected'), 12)
+        self.assertEquals([message for level, message in self.handler.records[-2:]],
+                          ['zookeeper_interest@1461: connect to 127.0.0.1:2185 failed (repeated 1 times)', 'zookeeper_interest@1461: connected'])
+        self.assertEquals(self.relay.stats(), log_stream.RelayStats(lines=7, logged=4, repeated=5, dropped=0))
+
+    def test_rate_limit(self):
+        self.relay.max_rate = self.relay._tokens = 2
+        for i in range(5):
+            self.relay.handle('message {0}'.format('x' * i), self.relay._tokens_at)
+        self.assertEquals(len(self.handler.records), 2)
+        self.assertEquals(self.relay.stats().dropped, 3)
+
+        self.relay.handle('later', self.relay._tokens_at + 1)
+        self.assertEquals(self.handler.records[-2:], [
+            (logging.WARNING, 'Dropped 3 zookeeper log messages because of the rate limit.'),
+            (logging.INFO, 'later'),
+        ])
+
+    def test_chunks_are_split_into_lines(self):
+        os.write(self.write_fd, (self.line('ZOO_INFO', 'first') + '\n' + self.line('ZOO_INFO', 'sec')).encode('ascii'))
+        os.write(self.write_fd, 'ond\n'.encode('ascii'))
+
+        thread = threading.Thread(target=self.relay.run)
+        thread.start()
+        deadline = time.time() + 5
+        while self.relay.lines < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.relay.stop()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEquals([message for level, message in self.handler.records],
+                          ['zookeeper_interest@1461: first', 'zookeeper_interest@1461: second'])
+
+
+class InstallTest(unittest.TestCase):
+
+    def test_uninstall_stops_the_relay(self):
+        log_stream.install()
+        thread = log_stream._relay_thread
+        self.assertTrue(log_stream.is_installed())
+
+        log_stream.uninstall()
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(log_stream.is_installed())
+        self.assertEquals(log_stream.stats(), None)
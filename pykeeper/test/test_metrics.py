@@ -0,0 +1,85 @@
+import threading
+import unittest
+
+import zookeeper
+
+from pykeeper import client, log_stream, metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        recorder = metrics.Metrics(buckets=(0.001, 0.01, 0.1))
+        for seconds in (0.0005, 0.001, 0.005, 0.05, 0.05, 1):
+            recorder.observe('get', 'ok', seconds)
+
+        histogram = recorder.snapshot().latencies[('get', 'ok')]
+        self.assertEquals(histogram.counts, (2, 1, 2, 1))
+        self.assertEquals(histogram.count, 6)
+        self.assertEquals(histogram.max, 1)
+        self.assertEquals(histogram.quantile(0.5), 0.01)
+        self.assertEquals(histogram.quantile(1), 1)
+
+    def test_prometheus_text(self):
+        recorder = metrics.Metrics(buckets=(0.01, 0.1))
+        recorder.observe('get', 'NoNodeException', 0.05)
+        recorder.increment('watch_fired', 'changed', 2)
+
+        text = metrics.to_prometheus(recorder.snapshot())
+        self.assertTrue('pykeeper_operation_seconds_bucket{operation="get",outcome="NoNodeException",le="0.01"} 0\n' in text)
+        self.assertTrue('pykeeper_operation_seconds_bucket{operation="get",outcome="NoNodeException",le="0.1"} 1\n' in text)
+        self.assertTrue('pykeeper_operation_seconds_count{operation="get",outcome="NoNodeException"} 1\n' in text)
+        self.assertTrue('pykeeper_watch_fired_total{label="changed"} 2\n' in text)
+
+
+class ClientMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.exported = list()
+        self.client = client.ZooKeeper('localhost:22181', metrics=metrics.Metrics(exporter=self.exported.append))
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        self.client.create('/pykeeper', '')
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def test_operations_are_timed(self):
+        self.client.metrics.reset()
+        self.client.create('/pykeeper/foo', '')
+        self.client.get('/pykeeper/foo')
+        self.assertRaises(zookeeper.NoNodeException, self.client.get, '/pykeeper/bar')
+        self.client.cached_get('/pykeeper/foo')
+        self.client.cached_get('/pykeeper/foo')
+
+        snapshot = self.client.metrics_snapshot()
+        self.assertEquals(snapshot.latencies[('create', 'ok')].count, 1)
+        # the cache miss is timed as a get as well
+        self.assertEquals(snapshot.latencies[('get', 'ok')].count, 2)
+        self.assertEquals(snapshot.latencies[('get', 'NoNodeException')].count, 1)
+        self.assertEquals((snapshot.caches['get'].hits, snapshot.caches['get'].misses), (1, 1))
+
+        self.client.export_metrics()
+        self.assertEquals(len(self.exported), 1)
+
+    def test_watch_fires_are_counted(self):
+        events = list()
+        fired = threading.Event()
+        self.client.get('/pykeeper', watcher=lambda event: (events.append(event), fired.set()))
+        self.client.set('/pykeeper', 'changed')
+        fired.wait(5)
+        self.assertEquals(events[0].type_name, 'changed')
+        self.assertEquals(self.client.metrics_snapshot().counters[('watch_fired', 'changed')], 1)
+
+    def test_disabled(self):
+        self.assertEquals(client.ZooKeeper('localhost:22181').metrics_snapshot(), None)
+
+
+__doctests__ = [metrics]
@@ -0,0 +1,101 @@
+import threading
+import unittest
+
+import zookeeper
+
+from pykeeper import log_stream, pool, retry
+
+
+class ZooKeeperPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pool.ZooKeeperPool('localhost:22181', size=3)
+        log_stream.install()
+
+        self.pool.connect()
+        for session in self.pool._sessions:
+            session.client.wait_until_connected(timeout=10)
+
+        if self.pool.exists('/pykeeper'):
+            self.pool.delete_recursive('/pykeeper', force=True)
+        self.pool.create('/pykeeper', '')
+        for i in range(10):
+            self.pool.create('/pykeeper/{0}'.format(i), str(i))
+
+    def tearDown(self):
+        self.pool.delete_recursive('/pykeeper', force=True)
+        self.pool.close()
+        log_stream.uninstall()
+
+    def test_reads_are_spread(self):
+        requests_before = [stats.requests for stats in self.pool.session_stats()]
+
+        done = threading.Semaphore(0)
+        results = list()
+
+        def callback(result):
+            results.append(result)
+            done.release()
+
+        for i in range(30):
+            self.pool.aget('/pykeeper/{0}'.format(i % 10), callback)
+        for i in range(30):
+            done.acquire()
+
+        self.assertEquals(sorted(data for data, stat in results), sorted(str(i % 10) for i in range(30)))
+        stats = self.pool.session_stats()
+        self.assertTrue(all(stats.requests > before for stats, before in zip(stats, requests_before)))
+        self.assertEquals([stats.outstanding for stats in stats], [0, 0, 0])
+
+    def test_watches_and_writes_use_the_primary(self):
+        events = list()
+        self.pool.get('/pykeeper/0', watcher=events.append)
+        self.assertEquals(self.pool.primary.watch_stats().armed, 1)
+        self.assertEquals(self.pool.create('/pykeeper/new', ''), '/pykeeper/new')
+
+        for session in self.pool._sessions[1:]:
+            self.assertEquals(session.client.watch_stats().armed, 0)
+
+    def test_cached_reads_are_routed_by_path(self):
+        paths = ['/pykeeper/{0}'.format(i) for i in range(10)]
+        results = self.pool.cached_get_many(paths)
+        self.assertEquals([data for data, stat in results], [str(i) for i in range(10)])
+        self.assertEquals(self.pool.cached_get('/pykeeper/3')[0], '3')
+
+        # every path is cached by a single session
+        self.assertEquals(self.pool.cache_stats()['get'].entries, 10)
+        self.assertEquals(self.pool.cache_stats()['get'].hits, 1)
+
+    def test_unrouted_methods_use_the_primary(self):
+        self.assertEquals(self.pool.state_name, 'connected')
+        self.assertEquals(self.pool.client_id, self.pool.primary.client_id)
+        self.assertRaises(AttributeError, getattr, self.pool, '_missing')
+
+
+class OfflineQueueTest(unittest.TestCase):
+
+    def test_sessions_have_their_own_offline_queue(self):
+        self.assertRaises(AssertionError, pool.ZooKeeperPool, 'localhost:22181', offline_queue=retry.OfflineQueue())
+
+        zk_pool = pool.ZooKeeperPool('localhost:22181', size=2, offline_queue_factory=lambda: retry.OfflineQueue(timeout=0.5))
+        self.addCleanup(zk_pool.close)
+        zk_pool.connect()
+        for session in zk_pool._sessions:
+            session.client.wait_until_connected(timeout=10)
+        primary, secondary = [session.client for session in zk_pool._sessions]
+        self.assertNotEqual(primary.offline_queue, secondary.offline_queue)
+
+        # a disconnected secondary doesn't hold up the requests of the primary
+        secondary._global_watcher(secondary.handle, zookeeper.SESSION_EVENT, zookeeper.CONNECTING_STATE, '')
+        self.assertNotEqual(primary.exists('/'), None)
+
+
+class PinningTest(unittest.TestCase):
+
+    def test_secondary_sessions_are_pinned(self):
+        zk_pool = pool.ZooKeeperPool('zk1:2181,zk2:2181/app', size=4, pin_servers=True)
+        self.assertEquals([stats.servers for stats in zk_pool.session_stats()],
+                          ['zk1:2181,zk2:2181/app', 'zk1:2181/app', 'zk2:2181/app', 'zk1:2181/app'])
+
+
+__doctests__ = [pool]
@@ -0,0 +1,231 @@
+import threading
+import time
+import unittest
+import mock
+
+import zookeeper
+
+from pykeeper import client, log_stream, recipes
+
+
+class RecipeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.ZooKeeper('localhost:22181')
+        self.other = client.ZooKeeper('localhost:22181')
+        log_stream.install()
+
+        for zk in (self.client, self.other):
+            zk.connect()
+            zk.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.other.close()
+        self.client.close()
+        log_stream.uninstall()
+
+    def start(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            time.sleep(0.01)
+
+
+class LockTest(RecipeTest):
+
+    def test_lock(self):
+        first = self.client.lock('/pykeeper/lock', 'first')
+        second = self.other.lock('/pykeeper/lock', 'second')
+
+        self.assertTrue(first.acquire())
+        self.assertEquals(first.position, 0)
+        self.assertFalse(second.acquire(blocking=False))
+        self.assertFalse(second.acquire(timeout=0.05))
+        self.assertEquals(second.node, None)
+
+        acquired = threading.Event()
+        thread = self.start(lambda: second.acquire() and acquired.set())
+        self.wait_for(lambda: first.contenders() == ['first', 'second'])
+        self.assertEquals(second.position, 1)
+        self.assertFalse(acquired.is_set())
+
+        first.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEquals(second.contenders(), ['second'])
+        second.release()
+        self.assertEquals(self.client.get_children('/pykeeper/lock'), [])
+
+    def test_contenders_raises_failed_requests(self):
+        lock = self.client.lock('/pykeeper/lock', 'first')
+        self.assertTrue(lock.acquire())
+
+        error = zookeeper.ConnectionLossException('connection loss')
+        with mock.patch.object(self.client, 'get_many', return_value=[error]):
+            self.assertRaises(zookeeper.ConnectionLossException, lock.contenders)
+        lock.release()
+
+    def test_waiters_only_watch_their_predecessor(self):
+        locks = [self.client.lock('/pykeeper/lock') for i in range(4)]
+        self.assertTrue(locks[0].acquire())
+
+        threads = [self.start(lock.acquire) for lock in locks[1:]]
+        self.wait_for(lambda: len(self.client.get_children('/pykeeper/lock')) == 4)
+        # one exists watch per waiter, each on a different node
+        self.wait_for(lambda: self.client.watch_stats().armed == 3)
+
+        for lock, thread in zip(locks, threads):
+            lock.release()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        locks[-1].release()
+
+    def test_cancel(self):
+        first, second = self.client.lock('/pykeeper/lock'), self.other.lock('/pykeeper/lock')
+        first.acquire()
+
+        results = list()
+        thread = self.start(lambda: results.append(second.acquire()))
+        self.wait_for(lambda: second.position == 1)
+        second.cancel()
+        thread.join(5)
+
+        self.assertEquals(results, [False])
+        self.assertEquals(len(self.client.get_children('/pykeeper/lock')), 1)
+        first.release()
+
+    def test_session_expiry_loses_the_lock(self):
+        lock = self.client.lock('/pykeeper/lock')
+        lost = list()
+        lock.on_lost += lost.append
+        lock.acquire()
+
+        self.client.on_state(self.client, 'expired')
+        self.assertFalse(lock.acquired)
+        self.assertEquals(lost, [lock])
+        # the lock can be acquired again once the node of the expired session is gone
+        self.client.delete_recursive('/pykeeper/lock', force=True)
+        self.assertTrue(lock.acquire(timeout=5))
+        lock.release()
+
+
+class ReadWriteLockTest(RecipeTest):
+
+    def test_readers_share_and_writers_wait(self):
+        readers = [self.client.read_write_lock('/pykeeper/rw').read_lock for i in range(2)]
+        writer = self.other.read_write_lock('/pykeeper/rw').write_lock
+
+        for reader in readers:
+            self.assertTrue(reader.acquire(blocking=False))
+        self.assertFalse(writer.acquire(timeout=0.05))
+
+        thread = self.start(writer.acquire)
+        self.wait_for(lambda: writer.position == 2)
+        # readers coming after a waiting writer wait for it
+        late_reader = self.client.read_write_lock('/pykeeper/rw').read_lock
+        self.assertFalse(late_reader.acquire(blocking=False))
+
+        for reader in readers:
+            reader.release()
+        thread.join(5)
+        self.assertTrue(writer.acquired)
+        writer.release()
+
+
+class LeaderElectionTest(RecipeTest):
+
+    def test_election(self):
+        first = self.client.leader_election('/pykeeper/election', 'first')
+        second = self.other.leader_election('/pykeeper/election', 'second')
+        leading = threading.Event()
+        resign = threading.Event()
+
+        def lead():
+            leading.set()
+            resign.wait(5)
+            return 'done'
+
+        results = list()
+        first_thread = self.start(lambda: results.append(first.run(lead)))
+        self.assertTrue(leading.wait(5))
+        self.assertTrue(first.is_leader)
+
+        second_thread = self.start(lambda: results.append(second.run(lambda: 'second')))
+        self.wait_for(lambda: first.contenders() == ['first', 'second'])
+
+        resign.set()
+        first_thread.join(5)
+        second_thread.join(5)
+        self.assertEquals(results, ['done', 'second'])
+        self.assertFalse(first.is_leader)
+
+
+class QueueTest(RecipeTest):
+
+    def test_put_and_take(self):
+        queue = self.client.queue('/pykeeper/queue')
+        self.assertEquals(queue.take(block=False), [])
+
+        queue.put_many(['a', 'b', 'c'])
+        queue.put('urgent', priority=0)
+        queue.put('later', priority=5)
+        self.assertEquals(queue.depth(), 5)
+
+        # all the items fit in a single take, so they come in order
+        self.assertEquals(queue.take(10), ['a', 'b', 'c', 'urgent', 'later'])
+        self.assertEquals(queue.stats(), recipes.QueueStats(0, 5, 5, 0))
+
+        self.assertRaises(ValueError, queue.put, 'x', priority=1000)
+
+    def test_priorities(self):
+        queue = self.client.queue('/pykeeper/queue', spread=1)
+        queue.put('low', priority=9)
+        queue.put('high', priority=1)
+
+        self.assertEquals(queue.take(), ['high'])
+        self.assertEquals(queue.take(), ['low'])
+
+    def test_idle_consumers_are_woken(self):
+        consumer = self.other.queue('/pykeeper/queue')
+        results = list()
+        thread = self.start(lambda: results.append(consumer.take(2, timeout=5)))
+        self.wait_for(lambda: self.other.watch_stats().armed == 1)
+
+        self.client.queue('/pykeeper/queue').put('item')
+        thread.join(5)
+        self.assertEquals(results, [['item']])
+
+        # giving up unsubscribes from the watch
+        self.assertEquals(consumer.take(timeout=0.05), [])
+        self.assertEquals(self.other.watch_stats().subscribed, 0)
+
+    def test_concurrent_consumers_take_every_item_once(self):
+        producer = self.client.queue('/pykeeper/queue')
+        producer.put_many([str(i) for i in range(200)])
+
+        taken = list()
+        consumers = [self.other.queue('/pykeeper/queue', spread=4) for i in range(4)]
+
+        def consume(consumer):
+            while True:
+                items = consumer.take(7, block=False)
+                if not items:
+                    return
+                taken.extend(items)
+
+        threads = [self.start(consume, consumer) for consumer in consumers]
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEquals(sorted(taken, key=int), [str(i) for i in range(200)])
+        self.assertEquals(sum(consumer.stats().taken for consumer in consumers), 200)
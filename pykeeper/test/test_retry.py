@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+import zookeeper
+
+from pykeeper import retry
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_jittered_delays_stay_below_the_ceiling(self):
+        backoff = retry.Backoff(initial=0.1, maximum=1)
+        for attempt in range(100):
+            delay = backoff.delay(attempt)
+            self.assertTrue(0 <= delay <= min(1, 0.1 * 2 ** attempt))
+
+        # a large number of attempts doesn't overflow
+        self.assertTrue(backoff.delay(10000) <= 1)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_gives_up_after_the_deadline(self):
+        attempts = list()
+
+        def failing(attempt):
+            attempts.append(attempt)
+            raise zookeeper.ConnectionLossException('connection loss')
+
+        policy = retry.RetryPolicy(deadline=0.05, backoff=retry.Backoff(initial=0.01, jitter=0))
+        self.assertRaises(zookeeper.ConnectionLossException, policy.run, failing)
+        self.assertTrue(1 < len(attempts) < 5)
+
+    def test_other_errors_are_not_retried(self):
+        attempts = list()
+
+        def failing(attempt):
+            attempts.append(attempt)
+            raise zookeeper.NoNodeException('no node')
+
+        self.assertRaises(zookeeper.NoNodeException, retry.RetryPolicy().run, failing)
+        self.assertEquals(attempts, [0])
+
+
+class OfflineQueueTest(unittest.TestCase):
+
+    def test_waiting_times_out(self):
+        queue = retry.OfflineQueue(timeout=0.01)
+        self.assertRaises(zookeeper.ConnectionLossException, queue.wait)
+        self.assertEquals(len(queue), 0)
+
+    def test_deferred_requests_are_issued_in_order(self):
+        queue = retry.OfflineQueue(max_size=2)
+        issued = list()
+        queue.defer(lambda: issued.append(1))
+        queue.defer(lambda: issued.append(2))
+        self.assertRaises(zookeeper.ConnectionLossException, queue.defer, lambda: issued.append(3))
+
+        waiter = threading.Thread(target=queue.wait)
+        waiter.start()
+        time.sleep(0.01)
+        queue.connected()
+        waiter.join(1)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertEquals(issued, [1, 2])
+        queue.defer(lambda: issued.append(4))
+        self.assertEquals(issued, [1, 2, 4])
+
+
+__doctests__ = [retry]
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import mock
+
+from pykeeper import client, log_stream, shared_cache
+
+
+class SharedTreeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.ZooKeeper('localhost:22181')
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+        self.client.create('/pykeeper', '')
+        for i in range(3):
+            self.client.create('/pykeeper/{0}'.format(i), str(i))
+
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'shared')
+        self.caches = list()
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.stop()
+        shutil.rmtree(self.directory)
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def start_cache(self):
+        cache = shared_cache.SharedTreeCache('localhost:22181', '/pykeeper', self.filename,
+                                             publish_window=0.01, poll_interval=0.01)
+        self.caches.append(cache)
+        cache.start(timeout=10)
+        return cache
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_a_single_owner_serves_every_reader(self):
+        owner, reader = self.start_cache(), self.start_cache()
+        self.assertTrue(owner.is_owner)
+        self.assertFalse(reader.is_owner)
+        self.assertEquals(reader.client, None)
+
+        self.assertEquals(len(reader), 4)
+        self.assertEquals(reader.get_children('/pykeeper'), ['0', '1', '2'])
+        data, stat = reader.get('/pykeeper/1')
+        self.assertTrue(isinstance(data, memoryview))
+        self.assertEquals(data.tobytes(), b'1')
+        self.assertEquals(stat, self.client.get('/pykeeper/1')[1])
+        self.assertEquals(reader.get('/pykeeper/missing'), None)
+
+    def test_changes_are_published_to_the_readers(self):
+        owner, reader = self.start_cache(), self.start_cache()
+        self.assertTrue(owner.is_owner)
+        changes = list()
+        reader.on_change += changes.append
+        data, stat = reader.get('/pykeeper/0')
+
+        self.client.set('/pykeeper/0', 'changed')
+        self.client.create('/pykeeper/3', 'new')
+        self.wait_for(lambda: '/pykeeper/3' in reader and reader.get('/pykeeper/0')[0].tobytes() == b'changed')
+        self.wait_for(lambda: changes and changes[-1].generation == reader.generation)
+
+        if all(change.paths is not None for change in changes):
+            # no generation was skipped, so every change was reported
+            changed = set(path for change in changes for path in change.paths)
+            self.assertTrue(set(['/pykeeper/0', '/pykeeper/3']) <= changed)
+        # views of older generations are unaffected
+        self.assertEquals(data.tobytes(), b'0')
+
+    def test_a_reader_takes_over_when_the_owner_stops(self):
+        owner, reader = self.start_cache(), self.start_cache()
+        generation = reader.generation
+
+        self.caches.remove(owner)
+        owner.stop()
+        self.wait_for(lambda: reader.is_owner)
+        self.assertTrue(reader.generation > generation)
+
+        self.client.create('/pykeeper/3', 'new')
+        self.wait_for(lambda: '/pykeeper/3' in reader)
+
+    def test_an_owner_that_cannot_connect_releases_the_lock(self):
+        with mock.patch.object(shared_cache.ZooKeeper, 'wait_until_connected', side_effect=client.TimeoutException()):
+            cache = shared_cache.SharedTreeCache('localhost:22181', '/pykeeper', self.filename,
+                                                 poll_interval=0.01, connect_timeout=0.05)
+            cache.start(timeout=0.1)
+            self.assertFalse(cache.is_owner)
+
+            # stopping doesn't wait for the connect timeout of a takeover in progress
+            cache.connect_timeout = 60
+            time.sleep(0.05)
+            started = time.time()
+            cache.stop()
+            self.assertTrue(time.time() - started < 1)
+
+        self.assertTrue(self.start_cache().is_owner)
+
+
+__doctests__ = [shared_cache]
@@ -0,0 +1,26 @@
+import io
+import unittest
+
+from pykeeper import snapshot
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        records = [('', b'', False), ('a', b'\x00\xff' * 1000, False), (u'a/\xe6', b'x', True)]
+        f = io.BytesIO()
+        self.assertEquals(snapshot.write(f, records), 3)
+
+        f.seek(0)
+        self.assertEquals(list(snapshot.read(f)), records)
+
+    def test_truncated_snapshots_are_detected(self):
+        f = io.BytesIO()
+        snapshot.write(f, [('a', b'data', False)])
+
+        truncated = io.BytesIO(f.getvalue()[:-1])
+        self.assertRaises(snapshot.SnapshotError, list, snapshot.read(truncated))
+        self.assertRaises(snapshot.SnapshotError, list, snapshot.read(io.BytesIO(b'garbage')))
+
+
+__doctests__ = [snapshot]
@@ -0,0 +1,100 @@
+import time
+import unittest
+import mock
+
+import zookeeper
+
+from pykeeper import client, log_stream, tree_cache
+
+
+class TreeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.ZooKeeper('localhost:22181')
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+
+        self.client.create('/pykeeper', '')
+        for i in range(3):
+            self.client.create('/pykeeper/{0}'.format(i), str(i))
+            self.client.create('/pykeeper/{0}/child'.format(i), '')
+
+        self.tree = tree_cache.TreeCache(self.client, '/pykeeper', window=2)
+        self.events = list()
+        self.tree.on_event += self.events.append
+        self.tree.start()
+
+    def tearDown(self):
+        self.tree.stop()
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def wait_for_events(self, count, timeout=1):
+        deadline = time.time() + timeout
+        while len(self.events) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_primed(self):
+        self.assertEquals(len(self.tree), 7)
+        self.assertEquals(set(event.type for event in self.events), set(['added']))
+
+        self.assertEquals(self.tree.get('/pykeeper/1')[0], '1')
+        self.assertEquals(self.tree.get_children('/pykeeper'), ['0', '1', '2'])
+        self.assertEquals([path for path, data, stat in self.tree.walk('/pykeeper/2')],
+                          ['/pykeeper/2', '/pykeeper/2/child'])
+
+    def test_changes_are_mirrored(self):
+        del self.events[:]
+
+        self.client.set('/pykeeper/0', 'changed')
+        self.wait_for_events(1)
+        self.assertEquals(self.events[-1][:3], ('updated', '/pykeeper/0', 'changed'))
+
+        self.client.create('/pykeeper/3', 'new')
+        self.wait_for_events(2)
+        self.assertEquals(self.events[-1][:3], ('added', '/pykeeper/3', 'new'))
+
+        self.client.delete_recursive('/pykeeper/1')
+        self.wait_for_events(4)
+        self.assertEquals([event[:2] for event in self.events[2:]],
+                          [('removed', '/pykeeper/1/child'), ('removed', '/pykeeper/1')])
+
+        self.assertEquals(self.tree.get_children('/pykeeper'), ['0', '2', '3'])
+        self.assertEquals(self.tree.get('/pykeeper/1'), None)
+
+    def test_watches_do_not_pile_up_across_expiries(self):
+        stats = self.client.watch_stats()
+
+        for i in range(3):
+            self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+            # the state of the handle doesn't change when the expiry is simulated, so tell the tree cache ourselves
+            self.client.on_state(self.client, 'expired')
+            self.client.wait_until_connected(timeout=10)
+            self.client.wait_until_revalidated(timeout=10)
+            deadline = time.time() + 1
+            while self.client.watch_stats() != stats and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEquals(self.client.watch_stats(), stats)
+
+        # the mirror is still kept current
+        del self.events[:]
+        self.client.set('/pykeeper/0', 'changed')
+        self.wait_for_events(1)
+        time.sleep(0.05)
+        self.assertEquals(self.events, [tree_cache.TreeEvent('updated', '/pykeeper/0', 'changed', self.tree.get('/pykeeper/0')[1])])
+
+    def test_the_failed_request_is_logged(self):
+        data_result = self.client.get('/pykeeper/0')
+        error = zookeeper.ConnectionLossException('connection loss')
+
+        with mock.patch.object(tree_cache.logger, 'warning') as warning:
+            self.tree._apply('/pykeeper/0', data_result, error)
+
+        self.assertEquals(warning.call_count, 1)
+        self.assertTrue(warning.call_args[0][0].endswith(': connection loss'))
@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+
+import zookeeper
+
+from pykeeper import client, log_stream, retry, watchers
+
+
+class WatchersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client.ZooKeeper('localhost:22181')
+        log_stream.install()
+
+        self.client.connect()
+        self.client.wait_until_connected(timeout=10)
+
+        if self.client.exists('/pykeeper'):
+            self.client.delete_recursive('/pykeeper', force=True)
+        self.client.create('/pykeeper', '')
+
+        self.delivered = list()
+        self.delivery = threading.Event()
+
+    def tearDown(self):
+        self.client.delete_recursive('/pykeeper', force=True)
+        self.client.close()
+        log_stream.uninstall()
+
+    def deliver(self, change):
+        self.delivered.append(change)
+        self.delivery.set()
+
+    def next_delivery(self):
+        self.assertTrue(self.delivery.wait(5))
+        self.delivery.clear()
+        return self.delivered[-1]
+
+    def test_children_watch(self):
+        self.client.create('/pykeeper/a', '')
+        watch = self.client.children_watch('/pykeeper', self.deliver, window=0.05)
+        self.assertEquals(self.next_delivery(), watchers.ChildrenDiff('/pykeeper', ['a'], []))
+
+        # a burst of changes is delivered as a single diff
+        for name in 'bcd':
+            self.client.create('/pykeeper/' + name, '')
+        self.client.delete('/pykeeper/a')
+        self.assertEquals(self.next_delivery(), watchers.ChildrenDiff('/pykeeper', ['b', 'c', 'd'], ['a']))
+        self.assertEquals(watch.fetches, 2)
+
+        # changes that cancel out aren't delivered
+        self.client.create('/pykeeper/e', '')
+        self.client.delete('/pykeeper/e')
+        time.sleep(0.2)
+        self.assertEquals(len(self.delivered), 2)
+
+        watch.stop()
+        self.client.create('/pykeeper/f', '')
+        time.sleep(0.2)
+        self.assertEquals(len(self.delivered), 2)
+
+    def test_children_watch_of_a_deleted_node(self):
+        self.client.create('/pykeeper/parent', '')
+        self.client.create('/pykeeper/parent/a', '')
+        self.client.children_watch('/pykeeper/parent', self.deliver, window=0)
+        self.next_delivery()
+
+        self.client.delete_recursive('/pykeeper/parent')
+        self.assertEquals(self.next_delivery(), watchers.ChildrenDiff('/pykeeper/parent', [], ['a']))
+
+        self.client.create('/pykeeper/parent', '')
+        self.client.create('/pykeeper/parent/b', '')
+        deadline = time.time() + 5
+        while self.delivered[-1].added != ['b'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.delivered[-1], watchers.ChildrenDiff('/pykeeper/parent', ['b'], []))
+
+    def test_changes_made_while_the_session_was_expired_are_delivered(self):
+        self.client.create('/pykeeper/data', 'first')
+        self.client.reconnect_backoff = retry.Backoff(initial=0.2, jitter=0)
+        self.client.children_watch('/pykeeper', self.deliver, window=0)
+        self.next_delivery()
+        self.client.data_watch('/pykeeper/data', self.deliver, window=0)
+        self.next_delivery()
+
+        self.client._global_watcher(self.client.handle, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        # the state of the handle doesn't change when the expiry is simulated, so tell the watches ourselves
+        self.client.on_state(self.client, 'expired')
+
+        other = client.ZooKeeper('localhost:22181')
+        other.connect()
+        other.wait_until_connected(timeout=10)
+        other.set('/pykeeper/data', 'second')
+        other.create('/pykeeper/new', '')
+        other.close()
+
+        self.client.wait_until_connected(timeout=10)
+        deadline = time.time() + 5
+        while len(self.delivered) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        missed = self.delivered[2:]
+        self.assertEquals([change for change in missed if isinstance(change, watchers.ChildrenDiff)],
+                          [watchers.ChildrenDiff('/pykeeper', ['new'], [])])
+        self.assertEquals([(change.old, change.new) for change in missed if isinstance(change, watchers.DataChange)],
+                          [('first', 'second')])
+
+    def test_data_watch(self):
+        self.client.create('/pykeeper/data', 'first')
+        self.client.data_watch('/pykeeper/data', self.deliver, window=0.05)
+        change = self.next_delivery()
+        self.assertEquals((change.old, change.new), (None, 'first'))
+
+        self.client.set('/pykeeper/data', 'second')
+        self.client.set('/pykeeper/data', 'third')
+        change = self.next_delivery()
+        self.assertEquals((change.old, change.new, change.stat['version']), ('first', 'third', 2))
+
+        # setting the same data again isn't a change
+        self.client.set('/pykeeper/data', 'third')
+        time.sleep(0.2)
+        self.assertEquals(len(self.delivered), 2)
+
+        self.client.delete('/pykeeper/data')
+        self.assertEquals(self.next_delivery(), watchers.DataChange('/pykeeper/data', 'third', None, None))
@@ -0,0 +1,93 @@
+import unittest
+
+import zookeeper
+
+from pykeeper import cache, watches
+
+
+class WatchRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = watches.WatchRegistry()
+        self.events = list()
+
+    def subscriber(self, *args):
+        self.events.append(args)
+
+    def test_one_armed_watch_per_path_and_kind(self):
+        data_watcher = self.registry.subscribe('/foo', 'data', self.subscriber)
+        self.assertNotEquals(data_watcher, None)
+        self.assertEquals(self.registry.subscribe('/foo', 'data', self.subscriber), None)
+
+        # other kinds and paths get their own watches
+        self.assertNotEquals(self.registry.subscribe('/foo', 'child', self.subscriber), None)
+        self.assertNotEquals(self.registry.subscribe('/bar', 'data', self.subscriber), None)
+
+        self.assertEquals(self.registry.stats(), watches.WatchStats(armed=3, subscribed=4))
+
+    def test_session_events_keep_the_subscribers(self):
+        watcher = self.registry.subscribe('/foo', 'data', self.subscriber)
+
+        watcher(0, zookeeper.SESSION_EVENT, zookeeper.CONNECTING_STATE, '')
+        self.assertEquals(len(self.events), 1)
+        self.assertTrue(self.registry.is_armed('/foo', 'data'))
+
+        watcher(0, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.assertEquals(len(self.events), 2)
+        self.assertFalse(self.registry.is_armed('/foo', 'data'))
+        self.assertEquals(self.registry.stats(), watches.WatchStats(armed=0, subscribed=1))
+
+    def test_subscribers_are_rearmed_after_expiry(self):
+        watcher = self.registry.subscribe('/foo', 'data', self.subscriber)
+        self.registry.expire()
+
+        # the expiry is still delivered to the subscribers
+        watcher(0, zookeeper.SESSION_EVENT, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.assertEquals(len(self.events), 1)
+
+        rearmed = self.registry.rearm()
+        self.assertEquals([(path, kind) for path, kind, new_watcher in rearmed], [('/foo', 'data')])
+        self.assertEquals(self.registry.stats(), watches.WatchStats(armed=1, subscribed=1))
+
+        # only the new watcher delivers events
+        watcher(0, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, '/foo')
+        self.assertEquals(len(self.events), 1)
+        rearmed[0][2](0, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, '/foo')
+        self.assertEquals(len(self.events), 2)
+
+    def test_versions_are_kept_while_subscribed(self):
+        self.registry.subscribe('/foo', 'data', self.subscriber)
+        self.registry.observe('/foo', 'data', 1)
+        self.registry.observe('/bar', 'data', 1)
+        self.assertEquals(self.registry.version('/foo', 'data'), 1)
+        self.assertEquals(self.registry.version('/bar', 'data'), Ellipsis)
+
+        self.registry.expire()
+        rearmed = self.registry.rearm()
+        self.assertEquals(self.registry.version('/foo', 'data'), 1)
+
+        # the version is forgotten along with the subscribers when the watch fires
+        rearmed[0][2](0, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, '/foo')
+        self.assertEquals(self.registry.version('/foo', 'data'), Ellipsis)
+
+    def test_failed_arming_request(self):
+        watcher = self.registry.subscribe('/foo', 'data', self.subscriber)
+        self.assertTrue(self.registry.unsubscribe('/foo', 'data', self.subscriber, watcher))
+        self.assertEquals(self.registry.stats(), watches.WatchStats(armed=0, subscribed=0))
+
+        # the next subscriber has to arm a new watch, and the old one should do nothing
+        self.assertNotEquals(self.registry.subscribe('/foo', 'data', self.subscriber), None)
+        watcher(0, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, '/foo')
+        self.assertEquals(self.events, [])
+
+    def test_cancelled_subscribers_are_dropped(self):
+        c = cache.LRUCache()
+        for i in range(10):
+            invalidator = cache.Invalidator(c, '/foo')
+            self.registry.subscribe('/foo', 'data', invalidator)
+            invalidator.cancel()
+
+        self.assertEquals(self.registry.stats(), watches.WatchStats(armed=1, subscribed=1))
+
+
+__doctests__ = [watches]
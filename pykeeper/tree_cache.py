@@ -0,0 +1,351 @@
+import collections
+import logging
+import threading
+
+import zookeeper
+
+from pykeeper import event
+from pykeeper.compact import Stat, intern_name
+
+
+logger = logging.getLogger(__name__)
+
+
+class TreeEvent(collections.namedtuple('TreeEvent', 'type, path, data, stat')):
+    """
+    Emitted by :class:`TreeCache` when a node is ``added``, ``updated`` or ``removed``.
+    """
+
+
+class _TreeNode(object):
+    __slots__ = ('data', 'stat', 'children')
+
+    def __init__(self):
+        self.data = None
+        self.stat = None
+        self.children = dict()
+
+
+def _child_path(path, name):
+    if path == '/':
+        return '/' + name
+    return path + '/' + name
+
+
+class TreeCache(object):
+    """ An in-memory mirror of the subtree rooted at ``path``.
+
+    :meth:`start` loads the subtree using pipelined reads, keeping at most ``window`` nodes
+    in flight. Afterwards, data and child watches keep the mirror current by re-fetching
+    only the nodes that changed. The mirror is held in a trie, so lookups and walks never
+    make round trips.
+
+    ``on_event`` is called with a :class:`TreeEvent` for every node that is added, updated
+    or removed, using the dispatcher of the client. With the default inline dispatcher, it is
+    called on the zookeeper completion thread, so it must not make synchronous zookeeper calls.
+
+    If the session expires, the mirror is re-synchronized when the client reconnects.
+    """
+
+    def __init__(self, client, path, window=None):
+        self.client = client
+        self.path = path.rstrip('/') or '/'
+        self.window = window or client.pipeline_window
+
+        self.on_event = event.Event()
+        self.initialized = threading.Event()
+
+        self._root = None
+        self._size = 0
+        self._lock = threading.RLock()
+        self._running = False
+        self._expired = False
+
+    def start(self):
+        """ Loads the subtree, blocking until it is fully mirrored. """
+        self._running = True
+        self.client.on_state += self._on_state
+        self._prime()
+        self.initialized.set()
+
+    def stop(self):
+        self._running = False
+        if self._on_state in self.client.on_state:
+            self.client.on_state -= self._on_state
+        self._unwatch()
+
+    def get(self, path):
+        """ Returns the ``(data, stat)`` of ``path``, or ``None`` if it isn't in the tree. """
+        with self._lock:
+            node = self._find(path)
+            if node is None:
+                return None
+            return node.data, node.stat
+
+    def get_children(self, path):
+        """ Returns the sorted names of the children of ``path``, or ``None`` if it isn't in the tree. """
+        with self._lock:
+            node = self._find(path)
+            if node is None:
+                return None
+            return sorted(node.children)
+
+    def walk(self, path=None):
+        """ Yields ``(path, data, stat)`` for ``path`` (the root by default) and all its descendants,
+        parents before their children. """
+        path = path or self.path
+        with self._lock:
+            node = self._find(path)
+            if node is None:
+                return
+            # take a snapshot of the subtree, so the lock isn't held while the caller iterates
+            snapshot = list()
+            stack = [(path, node)]
+            while stack:
+                node_path, node = stack.pop()
+                snapshot.append((node_path, node.data, node.stat))
+                for name in sorted(node.children, reverse=True):
+                    stack.append((_child_path(node_path, name), node.children[name]))
+
+        for item in snapshot:
+            yield item
+
+    def __contains__(self, path):
+        with self._lock:
+            return self._find(path) is not None
+
+    def __len__(self):
+        return self._size
+
+    def _segments(self, path):
+        if path == self.path:
+            return []
+        prefix = '' if self.path == '/' else self.path
+        if not path.startswith(prefix + '/'):
+            raise ValueError('{0!r} is not below {1!r}'.format(path, self.path))
+        return path[len(prefix) + 1:].split('/')
+
+    def _find(self, path):
+        node = self._root
+        for name in self._segments(path):
+            if node is None:
+                return None
+            node = node.children.get(name)
+        return node
+
+    def _prime(self):
+        # breadth first, issuing the requests from this thread while the results are applied on
+        # the completion thread, in the same order as the watch notifications.
+        window = threading.Semaphore(self.window)
+        condition = threading.Condition()
+        queue = collections.deque([self.path])
+        outstanding = [0]
+
+        def done(children):
+            with condition:
+                queue.extend(children)
+                outstanding[0] -= 1
+                condition.notify()
+            window.release()
+
+        while True:
+            with condition:
+                while not queue and outstanding[0]:
+                    condition.wait()
+                if not queue:
+                    break
+                path = queue.popleft()
+                outstanding[0] += 1
+
+            window.acquire()
+            self._fetch(path, done)
+
+    def _fetch(self, path, done=None):
+        """ Fetches the data and children of ``path``. If ``done`` is given, it is called with the paths of
+        all the children, otherwise the children that aren't in the tree yet are fetched as well. """
+        results = dict()
+
+        def completed(kind, result):
+            results[kind] = result
+            if len(results) < 2:
+                return
+
+            children, new_children = list(), list()
+            try:
+                children, new_children = self._apply(path, results['data'], results['children'])
+            finally:
+                if done is not None:
+                    done(children)
+            if done is None:
+                for child in new_children:
+                    self._fetch(child)
+
+        self.client.aget(path, lambda result: completed('data', result), watcher=self._data_watcher)
+        self.client.aget_children(path, lambda result: completed('children', result), watcher=self._child_watcher)
+
+    def _apply(self, path, data_result, children_result):
+        events = list()
+        children, new_children = list(), list()
+
+        with self._lock:
+            if not self._running:
+                return children, new_children
+
+            if isinstance(data_result, zookeeper.NoNodeException) or isinstance(children_result, zookeeper.NoNodeException):
+                self._remove(path, events)
+            elif isinstance(data_result, Exception) or isinstance(children_result, Exception):
+                error = data_result if isinstance(data_result, Exception) else children_result
+                logger.warning('{0}: Unable to refresh {1!r}: {2}'.format(self, path, error))
+            else:
+                node = self._update(path, data_result, events)
+                if node is not None:
+                    names = set(children_result)
+                    for name in list(node.children):
+                        if name not in names:
+                            self._remove(_child_path(path, name), events)
+
+                    children = [_child_path(path, name) for name in children_result]
+                    new_children = [_child_path(path, name) for name in children_result if name not in node.children]
+
+        self._emit(events)
+        return children, new_children
+
+    def _update(self, path, data_result, events):
+        data, stat = data_result[0], Stat.from_dict(data_result[1])
+
+        if path == self.path:
+            node = self._root
+            if node is None:
+                node = self._root = _TreeNode()
+        else:
+            parent_path, name = path.rsplit('/', 1)
+            parent = self._find(parent_path or '/')
+            if parent is None:
+                # the parent was removed while we were fetching
+                return None
+            node = parent.children.get(name)
+            if node is None:
+                node = parent.children[intern_name(name)] = _TreeNode()
+
+        if node.stat is None:
+            self._size += 1
+            events.append(TreeEvent('added', path, data, stat))
+        elif node.stat['mzxid'] != stat['mzxid']:
+            events.append(TreeEvent('updated', path, data, stat))
+
+        node.data, node.stat = data, stat
+        return node
+
+    def _remove(self, path, events):
+        if path == self.path:
+            node, self._root = self._root, None
+            # get notified if the root is created (again)
+            self.client.aexists(path, lambda result: None, watcher=self._data_watcher)
+        else:
+            parent_path, name = path.rsplit('/', 1)
+            parent = self._find(parent_path or '/')
+            node = parent.children.pop(name, None) if parent is not None else None
+
+        if node is None:
+            return
+
+        stack = [(path, node)]
+        removed = list()
+        while stack:
+            node_path, node = stack.pop()
+            removed.append(TreeEvent('removed', node_path, node.data, node.stat))
+            for name, child in node.children.items():
+                stack.append((_child_path(node_path, name), child))
+
+        self._size -= len(removed)
+        # children are reported before their parents
+        events.extend(reversed(removed))
+
+    def _unwatch(self):
+        # the root is watched with exists while it doesn't exist
+        paths = set([self.path])
+        paths.update(path for path, data, stat in self.walk())
+        for path in paths:
+            self.client.unwatch(path, self._data_watcher)
+            self.client.unwatch(path, self._child_watcher)
+
+    def _resync(self):
+        # the client keeps our subscriptions across the expiry, and priming subscribes again
+        self._unwatch()
+        self._prime()
+
+    def _emit(self, events):
+        for tree_event in events:
+            self.client.dispatcher.dispatch(tree_event.path, self.on_event, tree_event)
+
+    def _on_data(self, path, result):
+        if isinstance(result, zookeeper.NoNodeException):
+            events = list()
+            with self._lock:
+                self._remove(path, events)
+            self._emit(events)
+        elif isinstance(result, Exception):
+            logger.warning('{0}: Unable to refresh the data of {1!r}: {2}'.format(self, path, result))
+        else:
+            events = list()
+            with self._lock:
+                if self._running and self._find(path) is not None:
+                    self._update(path, result, events)
+            self._emit(events)
+
+    def _on_children(self, path, result):
+        if isinstance(result, Exception) and not isinstance(result, zookeeper.NoNodeException):
+            logger.warning('{0}: Unable to refresh the children of {1!r}: {2}'.format(self, path, result))
+            return
+
+        events = list()
+        new_children = list()
+        with self._lock:
+            node = self._find(path)
+            if not self._running or node is None:
+                return
+            if isinstance(result, zookeeper.NoNodeException):
+                self._remove(path, events)
+            else:
+                names = set(result)
+                for name in list(node.children):
+                    if name not in names:
+                        self._remove(_child_path(path, name), events)
+                new_children = [_child_path(path, name) for name in result if name not in node.children]
+
+        self._emit(events)
+        for child in new_children:
+            self._fetch(child)
+
+    def _data_watcher(self, client_event):
+        if not self._running:
+            return
+
+        path = client_event.path
+        if client_event.type == zookeeper.CHANGED_EVENT:
+            self.client.aget(path, lambda result: self._on_data(path, result), watcher=self._data_watcher)
+        elif client_event.type == zookeeper.CREATED_EVENT:
+            self._fetch(path)
+        elif client_event.type == zookeeper.DELETED_EVENT:
+            self._on_data(path, zookeeper.NoNodeException(path))
+
+    def _child_watcher(self, client_event):
+        if not self._running or client_event.type != zookeeper.CHILD_EVENT:
+            return
+
+        path = client_event.path
+        self.client.aget_children(path, lambda result: self._on_children(path, result), watcher=self._child_watcher)
+
+    def _on_state(self, client, state):
+        if state == 'expired':
+            # the server side watches are gone, so the mirror has to be compared against the server again
+            self._expired = True
+        elif state == 'connected' and self._expired and self._running:
+            self._expired = False
+            # this is called on the completion thread, which must not wait for our own requests
+            thread = threading.Thread(target=self._resync)
+            thread.daemon = True
+            thread.start()
+
+    def __repr__(self):
+        return 'TreeCache(path={0!r}, nodes={1})'.format(self.path, self._size)
@@ -0,0 +1,207 @@
+import collections
+import logging
+import threading
+
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+# how long to wait after a watch fired before fetching, so a burst of changes is fetched once
+DEFAULT_COALESCE_WINDOW = 0.1
+
+# how long to wait before fetching again after a request failed, such as during a disconnect
+RETRY_DELAY = 1.0
+
+
+class ChildrenDiff(collections.namedtuple('ChildrenDiff', 'path, added, removed')):
+    """
+    Delivered by :class:`ChildrenWatch`. ``added`` and ``removed`` are sorted lists of names.
+    """
+
+
+class DataChange(collections.namedtuple('DataChange', 'path, old, new, stat')):
+    """
+    Delivered by :class:`DataWatch`. ``stat`` is the stat of the new data, both ``new`` and
+    ``stat`` are ``None`` if the node was deleted.
+    """
+
+
+class _CoalescingWatch(object):
+    """ Keeps a watch on ``path`` armed, fetching the node at most once per ``window`` seconds.
+
+    When the watch fires, the node is fetched after ``window`` seconds, which arms the watch again.
+    Changes made during the window fire no further events, as the watch is only armed by the next
+    fetch, so a burst of changes results in a single fetch. There is never more than one fetch
+    in flight. After the session expired, the node is fetched again once we've reconnected, which
+    delivers the changes made in the meantime.
+    """
+
+    def __init__(self, client, path, func, window=DEFAULT_COALESCE_WINDOW):
+        self.client = client
+        self.path = path
+        self.func = func
+        self.window = window
+
+        self.initialized = threading.Event()
+        self.fetches = 0
+        self.deliveries = 0
+
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._running = False
+        self._expired = False
+        self._timer = None
+
+    def start(self, timeout=None):
+        """ Fetches the node and delivers its current state, waiting at most ``timeout`` seconds for it. """
+        self._running = True
+        self.client.on_state += self._on_state
+        self._schedule(0)
+        self.initialized.wait(timeout)
+
+    def stop(self):
+        self._running = False
+        if self._on_state in self.client.on_state:
+            self.client.on_state -= self._on_state
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self._unwatch()
+
+    def _unwatch(self):
+        for kind in self.kinds:
+            self.client.unwatch(self.path, self._on_event, kind)
+
+    def _on_event(self, event):
+        if event.type_name != 'session':
+            self._schedule(self.window)
+
+    def _on_state(self, client, state):
+        if state == 'expired':
+            # the changes made until we've reconnected fire no events
+            self._expired = True
+        elif state == 'connected' and self._expired and self._running:
+            self._expired = False
+            # the client keeps our subscriptions across the expiry, and the fetch subscribes again
+            self._unwatch()
+            self._schedule(0)
+
+    def _schedule(self, delay):
+        with self._lock:
+            if self._scheduled or not self._running:
+                return
+            self._scheduled = True
+            # never fetch on the completion thread, which may be running the watchers
+            self._timer = threading.Timer(delay, self._fetch)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fetch(self):
+        if not self._running:
+            self._done()
+            return
+        # events for watches armed by earlier fetches are ignored until this one completes, any
+        # change made after it has read the node fires the watch it arms.
+        self.fetches += 1
+        self._issue()
+
+    def _done(self):
+        with self._lock:
+            self._scheduled = False
+
+    def _completed(self, change):
+        self._done()
+        if change is not None and self._running:
+            self.deliveries += 1
+            self.client.dispatcher.dispatch(self.path, self.func, change)
+        self.initialized.set()
+
+    def _failed(self, error):
+        logger.debug('{0!r}: Fetching failed, retrying: {1!r}'.format(self, error))
+        self._done()
+        self._schedule(RETRY_DELAY)
+
+    def _watch_creation(self):
+        """ The node doesn't exist, so watch for it to be created instead. """
+        def exists_fetched(stat):
+            if isinstance(stat, Exception):
+                self._failed(stat)
+            elif stat is not None:
+                # created in the meantime
+                self._schedule(0)
+
+        self.client.aexists(self.path, exists_fetched, self._on_event)
+
+    def __repr__(self):
+        return '{0}(path={1!r})'.format(self.__class__.__name__, self.path)
+
+
+class ChildrenWatch(_CoalescingWatch):
+    """ Calls ``func`` with a :class:`ChildrenDiff` whenever the children of ``path`` change.
+
+    The first delivery has all the current children as added. Changes made within ``window``
+    seconds of each other are delivered as a single diff, and nothing is delivered if the children
+    are the same as before, such as when a node was added and removed again. If the node is
+    deleted, all the children are delivered as removed, and they are added again when the node
+    is created again. ``func`` is called using the dispatcher of the client.
+
+        >>> watch = client.children_watch('/services/web', update_members) # doctest: +SKIP
+    """
+    kinds = ('child', 'exists')
+
+    def __init__(self, client, path, func, window=DEFAULT_COALESCE_WINDOW):
+        super(ChildrenWatch, self).__init__(client, path, func, window)
+        self.children = frozenset()
+
+    def _issue(self):
+        self.client.aget_children(self.path, self._fetched, self._on_event)
+
+    def _fetched(self, children):
+        if isinstance(children, zookeeper.NoNodeException):
+            children = ()
+            self._watch_creation()
+        elif isinstance(children, Exception):
+            return self._failed(children)
+
+        children = frozenset(children)
+        previous, self.children = self.children, children
+        added, removed = children - previous, previous - children
+        if added or removed or not self.initialized.is_set():
+            self._completed(ChildrenDiff(self.path, sorted(added), sorted(removed)))
+        else:
+            self._completed(None)
+
+
+class DataWatch(_CoalescingWatch):
+    """ Calls ``func`` with a :class:`DataChange` whenever the data of ``path`` changes.
+
+    The first delivery has ``None`` as the old data. Changes made within ``window`` seconds of each
+    other are delivered as a single change, and nothing is delivered if the data is the same as
+    before. ``func`` is called using the dispatcher of the client.
+    """
+    kinds = ('data', 'exists')
+
+    def __init__(self, client, path, func, window=DEFAULT_COALESCE_WINDOW):
+        super(DataWatch, self).__init__(client, path, func, window)
+        self.data = None
+        self.stat = None
+
+    def _issue(self):
+        self.client.aget(self.path, self._fetched, self._on_event)
+
+    def _fetched(self, result):
+        if isinstance(result, zookeeper.NoNodeException):
+            data, stat = None, None
+            self._watch_creation()
+        elif isinstance(result, Exception):
+            return self._failed(result)
+        else:
+            data, stat = result
+
+        previous, existed = self.data, self.stat is not None
+        self.data, self.stat = data, stat
+        if data != previous or (stat is not None) != existed or not self.initialized.is_set():
+            self._completed(DataChange(self.path, previous, data, stat))
+        else:
+            self._completed(None)
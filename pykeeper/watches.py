@@ -0,0 +1,190 @@
+import collections
+import logging
+import threading
+
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+WATCH_KINDS = ('data', 'child', 'exists')
+
+
+class WatchStats(collections.namedtuple('WatchStats', 'armed, subscribed')):
+    """ ``armed`` is the number of watches registered with the server, ``subscribed``
+    the number of local subscribers sharing them. """
+
+
+class WatchRegistry(object):
+    """ Keeps at most one armed server watch per ``(path, kind)`` and fans each event out to
+    all the local subscribers of that watch.
+
+    Subscribers are zkpython-style watchers, called with ``(handle, event_type, conn_state, path)``.
+    Like zookeeper watches, a subscription is removed when its watch fires, except for session
+    events. When the session expires, the subscriptions are kept and :meth:`rearm` returns the
+    watches that must be armed again in the new session. The version of the node seen by the
+    requests that armed a watch is kept with :meth:`observe`, so the re-armed watch can tell
+    whether the node changed in the meantime.
+
+        >>> registry = WatchRegistry()
+        >>> events = list()
+        >>> watcher = registry.subscribe('/foo', 'data', lambda *args: events.append(args))
+        >>> registry.subscribe('/foo', 'data', lambda *args: events.append(args)) is None
+        True
+        >>> registry.stats()
+        WatchStats(armed=1, subscribed=2)
+        >>> watcher(0, zookeeper.CHANGED_EVENT, zookeeper.CONNECTED_STATE, '/foo')
+        >>> len(events)
+        2
+        >>> registry.stats()
+        WatchStats(armed=0, subscribed=0)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = dict()
+        self._armed = dict()
+        # watchers of an expired session, which should still deliver the expiry to their subscribers
+        self._expired = dict()
+        # the version of the node last seen by the requests arming each watch
+        self._versions = dict()
+
+    def subscribe(self, path, kind, subscriber):
+        """ Adds ``subscriber`` to the watch on ``(path, kind)``.
+
+        Returns the watcher that must be passed along with the request that arms the server
+        watch, or ``None`` if it is already armed.
+        """
+        assert kind in WATCH_KINDS, 'unknown watch kind: {0!r}'.format(kind)
+        key = (path, kind)
+        with self._lock:
+            # drop subscribers that have been cancelled in the meantime, such as invalidators of
+            # evicted cache entries, so that re-subscribing to a quiet path doesn't grow without bounds.
+            subscribers = [existing for existing in self._subscribers.get(key, ()) if getattr(existing, 'active', True)]
+            subscribers.append(subscriber)
+            self._subscribers[key] = subscribers
+
+            if key in self._armed:
+                return None
+
+            watcher = self._armed[key] = self._make_watcher(key)
+            return watcher
+
+    def unsubscribe(self, path, kind, subscriber, armed_watcher=None):
+        """ Removes ``subscriber`` from the watch on ``(path, kind)``. Returns whether it was subscribed.
+
+        ``armed_watcher`` should be given if the request that should have armed the server watch with it failed.
+        The server watch itself cannot be removed, but firing it does nothing if there are no subscribers.
+        """
+        key = (path, kind)
+        with self._lock:
+            if armed_watcher is not None and self._armed.get(key) is armed_watcher:
+                del self._armed[key]
+
+            subscribers = self._subscribers.get(key, ())
+            remaining = [existing for existing in subscribers
+                         if existing != subscriber and getattr(existing, 'watcher', None) != subscriber]
+            if remaining:
+                self._subscribers[key] = remaining
+            else:
+                self._subscribers.pop(key, None)
+                self._versions.pop(key, None)
+            return len(remaining) != len(subscribers)
+
+    def observe(self, path, kind, version):
+        """ Records the ``version`` of the node seen by a request that armed the watch on ``(path, kind)``. """
+        key = (path, kind)
+        with self._lock:
+            if key in self._subscribers:
+                self._versions[key] = version
+
+    def version(self, path, kind):
+        """ Returns the version recorded by :meth:`observe`, or ``Ellipsis`` if there is none. """
+        with self._lock:
+            return self._versions.get((path, kind), Ellipsis)
+
+    def disarm(self, path, kind, watcher):
+        """ Forgets that ``watcher`` is armed, for example because the request arming it failed. """
+        with self._lock:
+            if self._armed.get((path, kind)) is watcher:
+                del self._armed[(path, kind)]
+
+    def expire(self):
+        """ Forgets all the armed watches because the session expired, keeping their subscribers. """
+        with self._lock:
+            self._expired.update(self._armed)
+            self._armed.clear()
+
+    def rearm(self):
+        """ Arms new watchers for every watch that has active subscribers but no armed watch,
+        which is the case for all of them after the session expired.
+
+        Returns a list of ``(path, kind, watcher)``, the watchers must be passed along with a
+        request that sets a watch of the right kind.
+        """
+        rearmed = list()
+        with self._lock:
+            for key, subscribers in list(self._subscribers.items()):
+                subscribers = [existing for existing in subscribers if getattr(existing, 'active', True)]
+                if not subscribers:
+                    del self._subscribers[key]
+                    self._versions.pop(key, None)
+                    continue
+
+                self._subscribers[key] = subscribers
+                if key not in self._armed:
+                    watcher = self._armed[key] = self._make_watcher(key)
+                    rearmed.append(key + (watcher,))
+        return rearmed
+
+    def is_armed(self, path, kind):
+        return (path, kind) in self._armed
+
+    def subscribers(self, path, kind):
+        with self._lock:
+            return list(self._subscribers.get((path, kind), ()))
+
+    def stats(self):
+        with self._lock:
+            return WatchStats(len(self._armed), sum(len(subscribers) for subscribers in self._subscribers.values()))
+
+    def clear(self):
+        with self._lock:
+            self._armed.clear()
+            self._expired.clear()
+            self._subscribers.clear()
+            self._versions.clear()
+
+    def _make_watcher(self, key):
+        def watcher(handle, event_type, conn_state, path):
+            self._fire(key, watcher, handle, event_type, conn_state, path)
+        return watcher
+
+    def _fire(self, key, watcher, handle, event_type, conn_state, path):
+        with self._lock:
+            if self._armed.get(key) is not watcher:
+                if event_type == zookeeper.SESSION_EVENT and self._expired.get(key) is watcher:
+                    # let the subscribers know about the expiry, the last thing this watcher delivers
+                    if conn_state == zookeeper.EXPIRED_SESSION_STATE:
+                        del self._expired[key]
+                    subscribers = list(self._subscribers.get(key, ()))
+                else:
+                    # this watch has been disarmed or replaced
+                    return
+
+            elif event_type == zookeeper.SESSION_EVENT:
+                subscribers = list(self._subscribers.get(key, ()))
+                if conn_state == zookeeper.EXPIRED_SESSION_STATE:
+                    # the server has forgotten the watch, but the subscribers are kept until it is re-armed
+                    del self._armed[key]
+            else:
+                del self._armed[key]
+                subscribers = self._subscribers.pop(key, ())
+                self._versions.pop(key, None)
+
+        for subscriber in subscribers:
+            try:
+                subscriber(handle, event_type, conn_state, path)
+            except Exception as e:
+                # a failing subscriber should not prevent the others from seeing the event
+                logger.exception('Exception in watcher for {0!r}: {1}'.format(key, e))